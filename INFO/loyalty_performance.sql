@@ -0,0 +1,336 @@
+-- =====================================================
+-- SISTEMA DE FIDELIZACIÓN CAFÉ-VT - MIGRACIONES DE RENDIMIENTO
+-- =====================================================
+-- Base de datos: ethos_bd (MariaDB 10.6+)
+-- Descripción: Cambios de esquema que necesita el backend de fidelización
+-- para mantener estado incremental. Se aplica sobre loyalty_system_final.sql
+-- y es idempotente: puede ejecutarse más de una vez.
+-- =====================================================
+
+-- =====================================================
+-- 1. ESTADO INCREMENTAL DEL SCORE
+-- =====================================================
+-- Visitas, gasto y última visita ya viven en loyalty_users. Se añaden los
+-- contadores que faltaban para que el score no necesite COUNT(*) sobre
+-- referidos ni parsear favorite_products en cada lectura.
+
+ALTER TABLE `loyalty_users`
+  ADD COLUMN IF NOT EXISTS `referral_count` INT NOT NULL DEFAULT 0 COMMENT 'Usuarios referidos (se incrementa en cada referido)',
+  ADD COLUMN IF NOT EXISTS `product_sketch` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Bitmap de productos distintos: bit CRC32(producto) % 64';
+
+-- Rellenar referidos desde referred_by
+UPDATE `loyalty_users` u
+JOIN (
+    SELECT referred_by, COUNT(*) AS referral_count
+    FROM loyalty_users
+    WHERE referred_by IS NOT NULL
+    GROUP BY referred_by
+) r ON r.referred_by = u.referral_code
+SET u.referral_count = r.referral_count;
+
+-- Rellenar el bitmap desde favorite_products (misma función que
+-- services.loyalty_engine.product_sketch)
+UPDATE `loyalty_users` u
+JOIN (
+    SELECT lu.user_id, BIT_OR(1 << (CRC32(jt.product) % 64)) AS sketch
+    FROM loyalty_users lu,
+         JSON_TABLE(lu.favorite_products, '$[*]' COLUMNS (product VARCHAR(255) PATH '$')) jt
+    WHERE lu.favorite_products IS NOT NULL
+    GROUP BY lu.user_id
+) p ON p.user_id = u.user_id
+SET u.product_sketch = p.sketch;
+
+-- =====================================================
+-- 2. IDEMPOTENCIA DE ACUMULACIONES Y CANJES
+-- =====================================================
+-- Una fila por operación confirmada con clave de idempotencia (order_id o
+-- cabecera Idempotency-Key). La operación reclama la clave con INSERT IGNORE
+-- dentro de su transacción: un reintento concurrente espera al COMMIT de la
+-- original y recibe la respuesta guardada en lugar de abonar dos veces.
+-- Formato de la clave: '<operación>:<user_id>:<clave del cliente>'.
+
+CREATE TABLE IF NOT EXISTS `loyalty_request_keys` (
+  `request_key` VARCHAR(100) NOT NULL,
+  `user_id` INT NOT NULL,
+  `response` LONGTEXT DEFAULT NULL COMMENT 'Respuesta original (JSON)' CHECK (JSON_VALID(`response`)),
+  `created_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`request_key`),
+  KEY `idx_request_keys_created` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Los reintentos llegan en segundos; basta conservar las claves unos días:
+-- DELETE FROM loyalty_request_keys WHERE created_at < NOW() - INTERVAL 30 DAY;
+
+-- =====================================================
+-- 3. RUTA RÁPIDA DE ACUMULACIÓN DE PUNTOS
+-- =====================================================
+-- POST /earn-points (checkout del CartController) en un solo CALL: alta del
+-- usuario si no existe (con puntos de bienvenida), saldo, contadores de
+-- score (visitas, total gastado y productos), subida de nivel según loyalty_tier_config y libro de transacciones,
+-- todo en una transacción. Devuelve una fila con el resultado.
+-- Con p_request_key, un duplicado devuelve la fila de la operación original
+-- (duplicate = TRUE) sin escribir nada.
+
+DROP PROCEDURE IF EXISTS `loyalty_earn_points`;
+
+DELIMITER //
+CREATE PROCEDURE `loyalty_earn_points`(
+    IN p_user_id INT,
+    IN p_points INT,
+    IN p_order_id INT,
+    IN p_description TEXT,
+    IN p_product_bits BIGINT UNSIGNED,
+    IN p_purchase_amount DECIMAL(10,2),
+    IN p_welcome_points INT,
+    IN p_referral_code VARCHAR(20),
+    IN p_points_expiry_date DATETIME,
+    IN p_request_key VARCHAR(100)
+)
+proc: BEGIN
+    DECLARE v_created BOOLEAN DEFAULT FALSE;
+    DECLARE v_balance INT DEFAULT NULL;
+    DECLARE v_balance_after INT;
+    DECLARE v_tier VARCHAR(20) DEFAULT NULL;
+    DECLARE v_new_tier VARCHAR(20) DEFAULT NULL;
+
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    -- Reclamar la clave antes de bloquear al usuario (mismo orden en todas las
+    -- rutas de acumulación): si ya existe (o está en curso en otra
+    -- transacción, que bloquea hasta su COMMIT) se devuelve el resultado
+    -- guardado, leído con bloqueo para ver el último confirmado
+    IF p_request_key IS NOT NULL THEN
+        INSERT IGNORE INTO `loyalty_request_keys` (`request_key`, `user_id`, `created_at`)
+        VALUES (p_request_key, p_user_id, NOW());
+
+        IF ROW_COUNT() = 0 THEN
+            SELECT JSON_VALUE(`response`, '$.balance_before'),
+                   JSON_VALUE(`response`, '$.new_balance'),
+                   JSON_VALUE(`response`, '$.previous_tier'),
+                   JSON_VALUE(`response`, '$.current_tier'),
+                   JSON_VALUE(`response`, '$.points')
+            INTO v_balance, v_balance_after, v_tier, v_new_tier, p_points
+            FROM `loyalty_request_keys` WHERE `request_key` = p_request_key
+            FOR UPDATE;
+
+            IF v_balance_after IS NULL THEN
+                SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Operación con esta clave sin terminar';
+            END IF;
+            COMMIT;
+
+            SELECT v_balance AS balance_before,
+                   v_balance_after AS new_balance,
+                   v_tier AS previous_tier,
+                   v_new_tier AS current_tier,
+                   p_points AS points,
+                   FALSE AS created,
+                   TRUE AS duplicate;
+            LEAVE proc;
+        END IF;
+    END IF;
+
+    -- Alta con puntos de bienvenida; si ya existe no hace nada
+    INSERT IGNORE INTO `loyalty_users` (
+        `user_id`, `total_points`, `current_tier`, `score`, `join_date`,
+        `total_visits`, `total_spent`, `referral_code`, `points_expiry_date`
+    ) VALUES (
+        p_user_id, p_welcome_points, 'cafe_bronze', 0, NOW(),
+        0, 0, p_referral_code, p_points_expiry_date
+    );
+    SET v_created = ROW_COUNT() > 0;
+
+    IF v_created THEN
+        INSERT INTO `loyalty_transactions`
+        (`user_id`, `transaction_type`, `points_amount`, `order_id`, `description`, `balance_before`, `balance_after`, `created_at`)
+        VALUES (p_user_id, 'bonus', p_welcome_points, NULL,
+                'Puntos de bienvenida al programa de fidelización', 0, p_welcome_points, NOW());
+    END IF;
+
+    SELECT `total_points`, `current_tier` INTO v_balance, v_tier
+    FROM `loyalty_users` WHERE `user_id` = p_user_id FOR UPDATE;
+
+    -- INSERT IGNORE también ignora la FK a Usuario: sin fila no hay a quién abonar
+    IF v_balance IS NULL THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Usuario de fidelización no encontrado';
+    END IF;
+
+    SET v_balance_after = v_balance + p_points;
+
+    -- Solo ascensos: el nivel más alto alcanzado por encima del actual
+    SELECT `tier_name` INTO v_new_tier
+    FROM `loyalty_tier_config`
+    WHERE `points_required` <= v_balance_after
+      AND `points_required` > COALESCE(
+          (SELECT `points_required` FROM `loyalty_tier_config` WHERE `tier_name` = v_tier), -1)
+    ORDER BY `points_required` DESC
+    LIMIT 1;
+
+    UPDATE `loyalty_users`
+    SET `total_points` = v_balance_after,
+        `current_tier` = COALESCE(v_new_tier, v_tier),
+        `total_visits` = `total_visits` + 1,
+        `total_spent` = `total_spent` + COALESCE(p_purchase_amount, 0),
+        `product_sketch` = `product_sketch` | p_product_bits,
+        `last_visit` = NOW(),
+        `updated_at` = NOW()
+    WHERE `user_id` = p_user_id;
+
+    INSERT INTO `loyalty_transactions`
+    (`user_id`, `transaction_type`, `points_amount`, `order_id`, `description`, `balance_before`, `balance_after`, `created_at`)
+    VALUES (p_user_id, 'earn', p_points, p_order_id, p_description, v_balance, v_balance_after, NOW());
+
+    SET v_new_tier = COALESCE(v_new_tier, v_tier);
+
+    IF p_request_key IS NOT NULL THEN
+        UPDATE `loyalty_request_keys`
+        SET `response` = JSON_OBJECT(
+            'balance_before', v_balance, 'new_balance', v_balance_after,
+            'previous_tier', v_tier, 'current_tier', v_new_tier, 'points', p_points)
+        WHERE `request_key` = p_request_key;
+    END IF;
+
+    COMMIT;
+
+    SELECT v_balance AS balance_before,
+           v_balance_after AS new_balance,
+           v_tier AS previous_tier,
+           v_new_tier AS current_tier,
+           p_points AS points,
+           v_created AS created,
+           FALSE AS duplicate;
+END //
+DELIMITER ;
+
+-- =====================================================
+-- 4. VERSIÓN OPTIMISTA DEL SALDO
+-- =====================================================
+-- Canjes y ajustes leen el saldo sin bloquear y lo escriben con
+-- UPDATE ... SET balance_version = balance_version + 1
+--            WHERE user_id = ? AND balance_version = <leída>;
+-- si otra escritura llegó antes el UPDATE no afecta filas y el backend
+-- reintenta. El trigger incrementa la versión en cualquier cambio de
+-- total_points (incluidos el procedimiento de acumulación y
+-- after_compra_complete), así ningún escritor se la salta.
+
+ALTER TABLE `loyalty_users`
+  ADD COLUMN IF NOT EXISTS `balance_version` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Se incrementa con cada cambio de total_points';
+
+DROP TRIGGER IF EXISTS `before_loyalty_users_balance_update`;
+
+DELIMITER //
+CREATE TRIGGER `before_loyalty_users_balance_update`
+BEFORE UPDATE ON `loyalty_users`
+FOR EACH ROW
+BEGIN
+    IF NOT (NEW.`total_points` <=> OLD.`total_points`) THEN
+        SET NEW.`balance_version` = OLD.`balance_version` + 1;
+    END IF;
+END //
+DELIMITER ;
+
+-- =====================================================
+-- 5. ÍNDICES PARA PAGINACIÓN POR CLAVE
+-- =====================================================
+-- Los listados ordenan por (created_at DESC, id DESC) y paginan con
+-- "created_at < ? OR (created_at = ? AND id < ?)": con estos índices cada
+-- página es un rango del índice, sin leer y descartar las anteriores.
+
+CREATE INDEX IF NOT EXISTS idx_loyalty_transactions_user_created ON loyalty_transactions(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_loyalty_users_created ON loyalty_users(created_at, user_id);
+CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_created ON loyalty_coupons(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_user_created ON loyalty_coupons(user_id, created_at, id);
+
+-- =====================================================
+-- 6. RESUMEN MATERIALIZADO DEL LIBRO POR USUARIO
+-- =====================================================
+-- Totales por tipo de transacción, número de canjes y última transacción,
+-- para que resúmenes y perfil sean una lectura por clave primaria en lugar
+-- de recorrer todo el historial. El trigger lo actualiza en la misma
+-- transacción que cada INSERT en loyalty_transactions, venga del backend,
+-- del procedimiento de acumulación, del búfer del libro o de
+-- after_compra_complete. Para recalcularlo desde el libro:
+--     python scripts/rebuild_ledger_summary.py
+
+CREATE TABLE IF NOT EXISTS `loyalty_user_summary` (
+  `user_id` INT NOT NULL,
+  `total_earned` INT NOT NULL DEFAULT 0 COMMENT 'Puntos por compras (earn/purchase)',
+  `total_redeemed` INT NOT NULL DEFAULT 0 COMMENT 'Puntos canjeados, en positivo',
+  `total_bonus` INT NOT NULL DEFAULT 0,
+  `total_referrals` INT NOT NULL DEFAULT 0,
+  `total_adjustments` INT NOT NULL DEFAULT 0,
+  `net_points` INT NOT NULL DEFAULT 0 COMMENT 'Suma de points_amount de todas las transacciones',
+  `redemption_count` INT UNSIGNED NOT NULL DEFAULT 0,
+  `transaction_count` INT UNSIGNED NOT NULL DEFAULT 0,
+  `last_transaction_id` INT DEFAULT NULL,
+  `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`user_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+DROP TRIGGER IF EXISTS `after_loyalty_transaction_insert`;
+
+DELIMITER //
+CREATE TRIGGER `after_loyalty_transaction_insert`
+AFTER INSERT ON `loyalty_transactions`
+FOR EACH ROW
+BEGIN
+    INSERT INTO `loyalty_user_summary`
+        (`user_id`, `total_earned`, `total_redeemed`, `total_bonus`, `total_referrals`,
+         `total_adjustments`, `net_points`, `redemption_count`, `transaction_count`, `last_transaction_id`)
+    VALUES (
+        NEW.`user_id`,
+        IF(NEW.`transaction_type` IN ('earn', 'purchase'), NEW.`points_amount`, 0),
+        IF(NEW.`transaction_type` IN ('redeem', 'redemption'), ABS(NEW.`points_amount`), 0),
+        IF(NEW.`transaction_type` = 'bonus', NEW.`points_amount`, 0),
+        IF(NEW.`transaction_type` = 'referral', NEW.`points_amount`, 0),
+        IF(NEW.`transaction_type` = 'adjustment', NEW.`points_amount`, 0),
+        NEW.`points_amount`,
+        IF(NEW.`transaction_type` IN ('redeem', 'redemption'), 1, 0),
+        1,
+        NEW.`id`
+    )
+    ON DUPLICATE KEY UPDATE
+        `total_earned` = `total_earned` + VALUES(`total_earned`),
+        `total_redeemed` = `total_redeemed` + VALUES(`total_redeemed`),
+        `total_bonus` = `total_bonus` + VALUES(`total_bonus`),
+        `total_referrals` = `total_referrals` + VALUES(`total_referrals`),
+        `total_adjustments` = `total_adjustments` + VALUES(`total_adjustments`),
+        `net_points` = `net_points` + VALUES(`net_points`),
+        `redemption_count` = `redemption_count` + VALUES(`redemption_count`),
+        `transaction_count` = `transaction_count` + 1,
+        `last_transaction_id` = GREATEST(COALESCE(`last_transaction_id`, 0), VALUES(`last_transaction_id`));
+END //
+DELIMITER ;
+
+-- Carga inicial desde el libro existente
+INSERT INTO `loyalty_user_summary`
+    (`user_id`, `total_earned`, `total_redeemed`, `total_bonus`, `total_referrals`,
+     `total_adjustments`, `net_points`, `redemption_count`, `transaction_count`, `last_transaction_id`)
+SELECT
+    `user_id`,
+    SUM(IF(`transaction_type` IN ('earn', 'purchase'), `points_amount`, 0)),
+    SUM(IF(`transaction_type` IN ('redeem', 'redemption'), ABS(`points_amount`), 0)),
+    SUM(IF(`transaction_type` = 'bonus', `points_amount`, 0)),
+    SUM(IF(`transaction_type` = 'referral', `points_amount`, 0)),
+    SUM(IF(`transaction_type` = 'adjustment', `points_amount`, 0)),
+    SUM(`points_amount`),
+    SUM(`transaction_type` IN ('redeem', 'redemption')),
+    COUNT(*),
+    MAX(`id`)
+FROM `loyalty_transactions`
+GROUP BY `user_id`
+ON DUPLICATE KEY UPDATE
+    `total_earned` = VALUES(`total_earned`),
+    `total_redeemed` = VALUES(`total_redeemed`),
+    `total_bonus` = VALUES(`total_bonus`),
+    `total_referrals` = VALUES(`total_referrals`),
+    `total_adjustments` = VALUES(`total_adjustments`),
+    `net_points` = VALUES(`net_points`),
+    `redemption_count` = VALUES(`redemption_count`),
+    `transaction_count` = VALUES(`transaction_count`),
+    `last_transaction_id` = VALUES(`last_transaction_id`);
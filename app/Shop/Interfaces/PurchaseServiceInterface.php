@@ -10,9 +10,9 @@ interface PurchaseServiceInterface
      * Crea una nueva compra a partir del carrito del usuario
      * 
      * @param string $userId
-     * @return bool
+     * @return int ID de la compra creada
      */
-    public function createPurchase(string $userId): bool;
+    public function createPurchase(string $userId): int;
     
     /**
      * Obtiene las compras de un usuario
@@ -35,10 +35,10 @@ class PurchaseService implements PurchaseServiceInterface
      * Crea una nueva compra a partir del carrito del usuario
      * 
      * @param string $userId
-     * @return bool
+     * @return int ID de la compra creada
      * @throws CheckoutException
      */
-    public function createPurchase(string $userId): bool
+    public function createPurchase(string $userId): int
     {
         $conn = $this->db->getConnection();
         
@@ -137,7 +137,7 @@ class PurchaseService implements PurchaseServiceInterface
             
             // Confirmar la transacción
             $conn->commit();
-            return true;
+            return (int) $purchaseId;
             
         } catch (\Exception $e) {
             // Revertir la transacción en caso de error
@@ -253,9 +253,9 @@ class CartController extends BaseController
             $totalAmount = $this->cartService->getTotal($userEmail);
             
             // Procesar la compra
-            $result = $this->purchaseService->createPurchase($userEmail);
+            $purchaseId = $this->purchaseService->createPurchase($userEmail);
             
-            if ($result) {
+            if ($purchaseId) {
                 // Obtener el ID del usuario para el sistema de fidelización
                 $userId = $this->getUserIdFromEmail($userEmail);
                 
@@ -266,7 +266,10 @@ class CartController extends BaseController
                         $loyaltyResponse = $loyaltyController->awardPointsForPurchase(
                             $userId,
                             $totalAmount,
-                            "Compra normal desde carrito - Total: $" . number_format($totalAmount, 0, ',', '.') . " CLP"
+                            "Compra normal desde carrito - Total: $" . number_format($totalAmount, 0, ',', '.') . " CLP",
+                            null,
+                            // El pedido identifica el abono: un reintento del checkout no abona dos veces
+                            $purchaseId
                         );
                         
                         if ($loyaltyResponse['success']) {
@@ -357,7 +357,8 @@ class CustomCoffeeController extends BaseController
                     $loyaltyResponse = $loyaltyController->awardPointsForPurchase(
                         $usuarioId,
                         $precioTotal,
-                        "Compra de café personalizado #{$pedidoId}"
+                        "Compra de café personalizado #{$pedidoId}",
+                        "custom-order-{$pedidoId}"
                     );
                     error_log("[CustomCoffeeController::placeOrder] Respuesta de LoyaltyController: " . print_r($loyaltyResponse, true));
                     
@@ -64,8 +64,13 @@ class LoyaltyController extends BaseController
         }
         
         $user_id = $_SESSION['user_id'];
-        $user_profile = $this->getUserProfile($user_id);
-        $rewards = $this->getRewards();
+        // Perfil y catálogo en una sola petición a la API
+        list($profile, $catalog) = $this->fetchBatch([
+            ['op' => 'profile', 'user_id' => $user_id],
+            ['op' => 'rewards']
+        ]);
+        $user_profile = $profile['data'] ?? $this->getUserProfile($user_id);
+        $rewards = $catalog['data'] ?? $this->getRewards();
         
         $data = [
             'title' => 'Recompensas - Fidelización',
@@ -112,8 +117,13 @@ class LoyaltyController extends BaseController
         }
         
         $user_id = $_SESSION['user_id'];
-        $user_profile = $this->getUserProfile($user_id);
-        $transactions = $this->getUserTransactions($user_id);
+        // Perfil y primera página de transacciones en una sola petición a la API
+        list($profile, $page) = $this->fetchBatch([
+            ['op' => 'profile', 'user_id' => $user_id],
+            ['op' => 'transactions', 'user_id' => $user_id]
+        ]);
+        $user_profile = $profile['data'] ?? $this->getUserProfile($user_id);
+        $transactions = $page['data'] ?? $this->getUserTransactions($user_id);
         
         $data = [
             'title' => 'Transacciones - Fidelización',
@@ -198,7 +208,7 @@ class LoyaltyController extends BaseController
     public function getRewards()
     {
         try {
-            $response = $this->makeApiRequest("GET", "/api/v1/loyalty/rewards");
+            $response = $this->getRewardsCatalog();
             
             if ($response && isset($response['success']) && $response['success']) {
                 return $response['data'];
@@ -230,43 +240,172 @@ class LoyaltyController extends BaseController
         }
     }
     
+    /**
+     * Catálogo de recompensas con petición condicional.
+     *
+     * La última respuesta y su ETag se guardan en un fichero temporal
+     * compartido por todas las peticiones PHP; se reenvía el ETag en
+     * If-None-Match y con un 304 se reutiliza el catálogo guardado sin
+     * descargarlo ni decodificarlo de nuevo.
+     */
+    private function getRewardsCatalog()
+    {
+        $cacheFile = sys_get_temp_dir() . '/loyalty_rewards_catalog.json';
+        $cached = is_readable($cacheFile) ? json_decode(file_get_contents($cacheFile), true) : null;
+        $etag = $cached['etag'] ?? null;
+        
+        $result = $this->makeConditionalGet("/api/v1/loyalty/rewards", $etag);
+        if ($result['status'] === 304 && $cached) {
+            return $cached['response'];
+        }
+        
+        $response = json_decode($result['body'], true);
+        if (json_last_error() !== JSON_ERROR_NONE) {
+            throw new \Exception('Error decodificando respuesta JSON');
+        }
+        
+        if ($result['etag'] && !empty($response['success'])) {
+            file_put_contents(
+                $cacheFile,
+                json_encode(['etag' => $result['etag'], 'response' => $response]),
+                LOCK_EX
+            );
+        }
+        
+        return $response;
+    }
+    
+    /**
+     * GET con If-None-Match: devuelve estado HTTP, ETag y cuerpo sin decodificar
+     */
+    private function makeConditionalGet($endpoint, $etag = null)
+    {
+        $headers = ['Accept: application/json'];
+        if ($etag) {
+            $headers[] = 'If-None-Match: ' . $etag;
+        }
+        
+        $responseEtag = null;
+        $ch = curl_init();
+        curl_setopt_array($ch, [
+            CURLOPT_URL => $this->api_url . $endpoint,
+            CURLOPT_RETURNTRANSFER => true,
+            CURLOPT_TIMEOUT => 10,
+            CURLOPT_HTTPHEADER => $headers,
+            CURLOPT_HEADERFUNCTION => function ($ch, $header) use (&$responseEtag) {
+                if (stripos($header, 'ETag:') === 0) {
+                    $responseEtag = trim(substr($header, 5));
+                }
+                return strlen($header);
+            }
+        ]);
+        
+        $body = curl_exec($ch);
+        $http_code = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+        
+        curl_close($ch);
+        
+        if ($body === false) {
+            throw new \Exception('Error de conexión con la API');
+        }
+        
+        if ($http_code >= 400) {
+            throw new \Exception('Error HTTP: ' . $http_code);
+        }
+        
+        return ['status' => $http_code, 'etag' => $responseEtag, 'body' => $body];
+    }
+    
     /**
      * Obtener transacciones del usuario
      */
     public function getUserTransactions($user_id, $page = 1)
+    {
+        return $this->getUserTransactionsPage($user_id, $page)['data'];
+    }
+    
+    /**
+     * Obtener una página de transacciones y el cursor de la siguiente.
+     * Con $cursor (el next_cursor de la página anterior) la API pagina por
+     * clave y cualquier página cuesta lo mismo que la primera. $limit
+     * (filas por página, la API lo acota) evita recorrer muchas páginas.
+     */
+    public function getUserTransactionsPage($user_id, $page = 1, $cursor = null, $limit = null)
     {
         try {
-            $response = $this->makeApiRequest("GET", "/api/v1/loyalty/transactions/{$user_id}?page={$page}");
+            $query = $cursor ? 'cursor=' . urlencode($cursor) : "page={$page}";
+            if ($limit) {
+                $query .= '&limit=' . (int) $limit;
+            }
+            $response = $this->makeApiRequest("GET", "/api/v1/loyalty/transactions/{$user_id}?{$query}");
             
             if ($response && isset($response['success']) && $response['success']) {
-                return $response['data'];
+                return ['data' => $response['data'], 'next_cursor' => $response['next_cursor'] ?? null];
             }
             
-            return [];
+            return ['data' => [], 'next_cursor' => null];
             
         } catch (\Exception $e) {
             error_log("Error obteniendo transacciones: " . $e->getMessage());
-            return [];
+            return ['data' => [], 'next_cursor' => null];
+        }
+    }
+    
+    /**
+     * Varias lecturas en una sola petición a /batch (la API las atiende en
+     * paralelo). Devuelve la respuesta de cada subpetición en el mismo orden,
+     * o null en las que fallaron; quien llama usa entonces la petición
+     * individual, que tiene sus propios valores por defecto.
+     *
+     * @param array $requests Subpeticiones: ['op' => 'profile'|'rewards'|'transactions', 'user_id' => ..., 'page' => ..., 'cursor' => ...]
+     * @return array
+     */
+    private function fetchBatch(array $requests)
+    {
+        $results = array_fill(0, count($requests), null);
+        try {
+            $response = $this->makeApiRequest("POST", "/api/v1/loyalty/batch", ['requests' => $requests]);
+            
+            if ($response && !empty($response['success'])) {
+                foreach ($response['results'] as $i => $result) {
+                    if (!empty($result['success'])) {
+                        $results[$i] = $result;
+                    }
+                }
+            }
+        } catch (\Exception $e) {
+            error_log("Error en petición por lotes: " . $e->getMessage());
         }
+        
+        return $results;
     }
     
     /**
      * Realizar petición a la API
+     *
+     * Con $idempotencyKey se envía la cabecera Idempotency-Key y, si la
+     * conexión falla (p.ej. timeout), se reintenta una vez con la misma
+     * clave: la API devuelve la respuesta original en vez de repetir la operación.
      */
-    private function makeApiRequest($method, $endpoint, $data = null)
+    private function makeApiRequest($method, $endpoint, $data = null, $idempotencyKey = null)
     {
         $url = $this->api_url . $endpoint;
         
+        $headers = [
+            'Content-Type: application/json',
+            'Accept: application/json'
+        ];
+        if ($idempotencyKey) {
+            $headers[] = 'Idempotency-Key: ' . $idempotencyKey;
+        }
+        
         $ch = curl_init();
         
         $options = [
             CURLOPT_URL => $url,
             CURLOPT_RETURNTRANSFER => true,
             CURLOPT_TIMEOUT => 10,
-            CURLOPT_HTTPHEADER => [
-                'Content-Type: application/json',
-                'Accept: application/json'
-            ]
+            CURLOPT_HTTPHEADER => $headers
         ];
         
         if ($method === 'POST') {
@@ -286,6 +425,9 @@ class LoyaltyController extends BaseController
         curl_setopt_array($ch, $options);
         
         $response = curl_exec($ch);
+        if ($response === false && $idempotencyKey) {
+            $response = curl_exec($ch);
+        }
         $http_code = curl_getinfo($ch, CURLINFO_HTTP_CODE);
         
         curl_close($ch);
@@ -371,6 +513,8 @@ class LoyaltyController extends BaseController
     {
         $user_id = $params['id'] ?? null;
         $page = $_GET['page'] ?? 1;
+        $cursor = $_GET['cursor'] ?? null;
+        $limit = $_GET['limit'] ?? null;
         
         if (!$user_id) {
             $this->json(['success' => false, 'message' => 'ID de usuario requerido'], 400);
@@ -378,8 +522,12 @@ class LoyaltyController extends BaseController
         }
         
         try {
-            $transactions = $this->getUserTransactions($user_id, $page);
-            $this->json(['success' => true, 'data' => $transactions]);
+            $transactions = $this->getUserTransactionsPage($user_id, $page, $cursor, $limit);
+            $this->json([
+                'success' => true,
+                'data' => $transactions['data'],
+                'next_cursor' => $transactions['next_cursor']
+            ]);
         } catch (\Exception $e) {
             $this->json(['success' => false, 'message' => $e->getMessage()], 500);
         }
@@ -423,7 +571,7 @@ class LoyaltyController extends BaseController
             $response = $this->makeApiRequest("POST", "/api/v1/loyalty/redeem-reward", [
                 'user_id' => $user_id,
                 'reward_id' => $reward_id
-            ]);
+            ], $input['request_key'] ?? null);
             error_log("[DEBUG][redeem] Respuesta de la API: " . var_export($response, true));
             
             // Asegurar que la respuesta sea un array
@@ -494,9 +642,11 @@ class LoyaltyController extends BaseController
      * @param int $user_id ID del usuario
      * @param float $amount Monto de la compra
      * @param string $description Descripción de la compra
+     * @param string|null $idempotencyKey Clave única de la compra (evita abonar dos veces al reintentar)
+     * @param int|null $orderId ID de la compra; si se indica es la clave de idempotencia del abono
      * @return array Respuesta de la API
      */
-    public function awardPointsForPurchase($user_id, $amount, $description = '')
+    public function awardPointsForPurchase($user_id, $amount, $description = '', $idempotencyKey = null, $orderId = null)
     {
         try {
             error_log("[LoyaltyController::awardPointsForPurchase] Otorgando puntos - Usuario: $user_id, Monto: $amount, Descripción: $description");
@@ -508,10 +658,13 @@ class LoyaltyController extends BaseController
                 'user_id' => $user_id,
                 'points_amount' => $points,
                 'transaction_type' => 'earn',
+                // Importe para total_spent (score del usuario)
+                'purchase_amount' => $amount,
+                'order_id' => $orderId,
                 'description' => $description ?: "Puntos ganados por compra de $" . number_format($amount, 0, ',', '.') . " CLP"
             ];
             
-            $response = $this->makeApiRequest("POST", "/api/v1/loyalty/earn-points", $data);
+            $response = $this->makeApiRequest("POST", "/api/v1/loyalty/earn-points", $data, $idempotencyKey);
             
             if ($response && isset($response['success']) && $response['success']) {
                 error_log("[LoyaltyController::awardPointsForPurchase] Puntos otorgados exitosamente: " . $points);
@@ -536,4 +689,55 @@ class LoyaltyController extends BaseController
             ];
         }
     }
+    
+    /**
+     * Otorgar puntos por varias compras en una sola petición y transacción
+     * @param array $awards Compras: ['user_id' => ..., 'amount' => ..., 'order_id' => ..., 'description' => ...]
+     * @return array Un resultado por compra, en el mismo orden (como awardPointsForPurchase)
+     */
+    public function awardPointsBatch(array $awards)
+    {
+        $items = [];
+        foreach ($awards as $award) {
+            // Calcular puntos (1 punto por cada $100 CLP)
+            $amount = $award['amount'];
+            $items[] = [
+                'user_id' => $award['user_id'],
+                'points_amount' => floor($amount / 100),
+                'transaction_type' => 'earn',
+                // order_id hace idempotente cada abono: reenviar el lote no abona dos veces
+                'order_id' => $award['order_id'] ?? null,
+                'purchase_amount' => $amount,
+                'description' => ($award['description'] ?? '') ?: "Puntos ganados por compra de $" . number_format($amount, 0, ',', '.') . " CLP"
+            ];
+        }
+        
+        try {
+            $response = $this->makeApiRequest("POST", "/api/v1/loyalty/earn-points/batch", ['items' => $items]);
+            
+            if (!$response || empty($response['success'])) {
+                error_log("[LoyaltyController::awardPointsBatch] Error en la API: " . json_encode($response));
+                return array_fill(0, count($awards), [
+                    'success' => false,
+                    'message' => 'No se pudieron otorgar puntos'
+                ]);
+            }
+            
+            $results = [];
+            foreach ($response['results'] as $i => $result) {
+                $points = $items[$i]['points_amount'];
+                $results[] = !empty($result['success'])
+                    ? ['success' => true, 'points_earned' => $points, 'message' => "Se otorgaron $points puntos por tu compra"]
+                    : ['success' => false, 'message' => $result['message'] ?? 'No se pudieron otorgar puntos'];
+            }
+            return $results;
+            
+        } catch (\Exception $e) {
+            error_log("[LoyaltyController::awardPointsBatch] Error: " . $e->getMessage());
+            return array_fill(0, count($awards), [
+                'success' => false,
+                'message' => 'Error al otorgar puntos: ' . $e->getMessage()
+            ]);
+        }
+    }
 } 
\ No newline at end of file
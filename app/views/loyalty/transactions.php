@@ -256,13 +256,30 @@ document.addEventListener('DOMContentLoaded', () => {
         updateSummary(processed);
     }
 
+    // Recorre las páginas con next_cursor hasta `maxRows` transacciones,
+    // en páginas grandes para hacer pocos viajes (máximo de la API: 200)
+    const TRANSACTIONS_PAGE_SIZE = 200;
+    async function loadTransactions(maxRows) {
+        let rows = [];
+        let cursor = null;
+        do {
+            const response = await api.getUserTransactions(userId, 1, cursor, TRANSACTIONS_PAGE_SIZE);
+            if (!response || !response.success) {
+                return response;
+            }
+            rows = rows.concat(response.data);
+            cursor = response.next_cursor;
+        } while (cursor && rows.length < maxRows);
+        return { success: true, data: rows };
+    }
+
     function loadInitialData() {
         isLoading = true;
         loadingState.style.display = 'block';
         listContainer.style.display = 'none';
 
         Promise.all([
-            api.getUserTransactions(userId, 1, 1000), // Cargar un lote grande para filtrar en cliente
+            loadTransactions(1000), // Cargar un lote grande para filtrar en cliente
             api.getUserProfile(userId)
         ]).then(([transactionsResponse, profileResponse]) => {
             if (transactionsResponse && transactionsResponse.success) {
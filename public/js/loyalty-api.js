@@ -75,15 +75,22 @@ if (typeof window.LoyaltyAPI === 'undefined') {
         }
         
         /**
-         * Obtener transacciones del usuario
+         * Obtener transacciones del usuario.
+         * Para la página siguiente pasar el `next_cursor` de la respuesta
+         * anterior como `cursor` (más rápido que `page` en páginas profundas).
+         * `limit`: filas por página (la API lo acota).
          */
-        async getUserTransactions(userId = null, page = 1) {
+        async getUserTransactions(userId = null, page = 1, cursor = null, limit = null) {
             const id = userId || this.userId;
             if (!id) {
                 throw new Error('User ID no disponible');
             }
             
-            return this.makeRequest(`/v1/loyalty/transactions/${id}?page=${page}`);
+            let query = cursor ? `cursor=${encodeURIComponent(cursor)}` : `page=${page}`;
+            if (limit) {
+                query += `&limit=${limit}`;
+            }
+            return this.makeRequest(`/v1/loyalty/transactions/${id}?${query}`);
         }
         
         /**
@@ -119,7 +119,7 @@ class LoyaltyDashboard {
     async loadRecentTransactions() {
         if (!this.userId) return; // No hacer nada si no hay ID de usuario
         try {
-            const response = await this.api.getUserTransactions(this.userId, 1, 5);
+            const response = await this.api.getUserTransactions(this.userId, 1);
             if (response && response.success) {
                 this.displayRecentTransactions(response.data);
             }
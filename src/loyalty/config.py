@@ -42,6 +42,7 @@ class LoyaltyConfig(BaseSettings):
         "variety": 0.15,      # Variedad de productos
         "referral": 0.10      # Referidos
     }
+    RECENCY_HALF_LIFE_DAYS: float = 21.0  # Días en que el score de recencia cae a la mitad
     
     # Configuración de referidos
     REFERRAL_BONUS_POINTS: int = 500  # Puntos por referido exitoso
@@ -141,6 +142,9 @@ class LoyaltyConfig(BaseSettings):
     
     # Configuración de caché
     CACHE_TTL_SECONDS: int = 3600  # 1 hora
+    USER_CACHE_MAX_ENTRIES: int = 10000  # Perfiles en caché por worker
+    USER_CACHE_TTL_SECONDS: int = 60  # Saldos: el trigger after_compra_complete no invalida la caché
+    STATS_CACHE_TTL_SECONDS: int = 60  # Estadísticas agregadas (sin invalidación explícita)
     
     class Config:
         env_prefix = "LOYALTY_"
@@ -157,6 +161,41 @@ settings = SimpleNamespace(
     DB_NAME=os.getenv('LOYALTY_DB_NAME', 'ethos_bd'),
     DB_POOL_MIN_SIZE=int(os.getenv('LOYALTY_DB_POOL_MIN_SIZE', 1)),
     DB_POOL_MAX_SIZE=int(os.getenv('LOYALTY_DB_POOL_MAX_SIZE', 5)),
+    DB_BULK_CHUNK_SIZE=int(os.getenv('LOYALTY_DB_BULK_CHUNK_SIZE', 1000)),
+    DB_MAX_STATEMENT_BYTES=int(os.getenv('LOYALTY_DB_MAX_STATEMENT_BYTES', 1024 * 1024)),
+    DB_STREAM_FETCH_SIZE=int(os.getenv('LOYALTY_DB_STREAM_FETCH_SIZE', 500)),
+    DB_ACQUIRE_TIMEOUT=float(os.getenv('LOYALTY_DB_ACQUIRE_TIMEOUT', 2.0)),
+    DB_POOL_MAX_WAITERS=int(os.getenv('LOYALTY_DB_POOL_MAX_WAITERS', 50)),
+    DB_REPLICA_HOST=os.getenv('LOYALTY_DB_REPLICA_HOST', ''),
+    DB_REPLICA_PORT=int(os.getenv('LOYALTY_DB_REPLICA_PORT', 3306)),
+    DB_REPLICA_USER=os.getenv('LOYALTY_DB_REPLICA_USER', os.getenv('LOYALTY_DB_USER', 'root')),
+    DB_REPLICA_PASSWORD=os.getenv('LOYALTY_DB_REPLICA_PASSWORD', os.getenv('LOYALTY_DB_PASSWORD', '')),
+    DB_REPLICA_POOL_MAX_SIZE=int(os.getenv('LOYALTY_DB_REPLICA_POOL_MAX_SIZE', 5)),
+    DB_REPLICA_MAX_LAG_SECONDS=int(os.getenv('LOYALTY_DB_REPLICA_MAX_LAG_SECONDS', 5)),
+    DB_REPLICA_LAG_CHECK_INTERVAL=float(os.getenv('LOYALTY_DB_REPLICA_LAG_CHECK_INTERVAL', 5.0)),
+    DB_READ_YOUR_WRITES_SECONDS=float(os.getenv('LOYALTY_DB_READ_YOUR_WRITES_SECONDS', 10.0)),
+    DB_STICKY_MAX_KEYS=int(os.getenv('LOYALTY_DB_STICKY_MAX_KEYS', 10000)),
+    REDIS_URL=os.getenv('LOYALTY_REDIS_URL', ''),
+    DB_SLOW_QUERY_MS=float(os.getenv('LOYALTY_DB_SLOW_QUERY_MS', 200)),
+    DB_QUERY_STATS_MAX_STATEMENTS=int(os.getenv('LOYALTY_DB_QUERY_STATS_MAX_STATEMENTS', 500)),
+    ADMIN_TOKEN=os.getenv('LOYALTY_ADMIN_TOKEN', ''),
+    ADMISSION_MAX_IN_FLIGHT=int(os.getenv('LOYALTY_ADMISSION_MAX_IN_FLIGHT', 64)),
+    ADMISSION_RESERVED_CRITICAL=int(os.getenv('LOYALTY_ADMISSION_RESERVED_CRITICAL', 16)),
+    ADMISSION_RETRY_AFTER=int(os.getenv('LOYALTY_ADMISSION_RETRY_AFTER', 1)),
+    LEDGER_WRITE_BEHIND=os.getenv('LOYALTY_LEDGER_WRITE_BEHIND', '0') == '1',
+    LEDGER_FLUSH_INTERVAL_MS=int(os.getenv('LOYALTY_LEDGER_FLUSH_INTERVAL_MS', 50)),
+    LEDGER_FLUSH_MAX_ROWS=int(os.getenv('LOYALTY_LEDGER_FLUSH_MAX_ROWS', 500)),
+    LEDGER_MAX_PENDING=int(os.getenv('LOYALTY_LEDGER_MAX_PENDING', 20000)),
+    LEDGER_SPOOL_DIR=os.getenv('LOYALTY_LEDGER_SPOOL_DIR', ''),
+    IDEMPOTENCY_CACHE_SIZE=int(os.getenv('LOYALTY_IDEMPOTENCY_CACHE_SIZE', 20000)),
+    IDEMPOTENCY_CACHE_TTL=float(os.getenv('LOYALTY_IDEMPOTENCY_CACHE_TTL', 3600)),
+    IDEMPOTENCY_BLOOM_CAPACITY=int(os.getenv('LOYALTY_IDEMPOTENCY_BLOOM_CAPACITY', 200000)),
+    USER_LOCK_STRIPES=int(os.getenv('LOYALTY_USER_LOCK_STRIPES', 1024)),
+    BALANCE_CAS_MAX_RETRIES=int(os.getenv('LOYALTY_BALANCE_CAS_MAX_RETRIES', 5)),
+    BALANCE_CAS_RETRY_DELAY=float(os.getenv('LOYALTY_BALANCE_CAS_RETRY_DELAY', 0.005)),
+    PROFILE_SINGLE_QUERY=os.getenv('LOYALTY_PROFILE_SINGLE_QUERY', '1') == '1',
+    FAST_JSON=os.getenv('LOYALTY_FAST_JSON', '0') == '1',
+    BATCH_MAX_REQUESTS=int(os.getenv('LOYALTY_BATCH_MAX_REQUESTS', 50)),
     DEBUG=os.getenv('LOYALTY_DEBUG', '1') == '1',
     SECRET_KEY=os.getenv('LOYALTY_SECRET_KEY', 'supersecret'),
     EMAIL_FROM=os.getenv('LOYALTY_EMAIL_FROM', 'noreply@cafe-vt.com'),
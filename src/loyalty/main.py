@@ -12,9 +12,17 @@ import logging
 from datetime import datetime
 
 from config import settings
-from routes import loyalty_routes
+from routes import loyalty_routes, admin_routes
 from services.loyalty_service import LoyaltyService
-from utils.database import init_db, close_db
+from utils.database import init_db, close_db, get_pool_stats
+from utils.admission import admission_controller
+from utils.cache import cache_manager
+from utils.tier_table import load_tier_table
+from services.scoring_model import load_scoring_model
+from services.ledger_buffer import ledger_buffer
+from utils.idempotency import idempotency_cache
+from utils.locks import user_locks
+from utils.singleflight import single_flight
 
 # Configurar logging
 logging.basicConfig(
@@ -30,11 +38,21 @@ async def lifespan(app: FastAPI):
     logger.info("🚀 Iniciando Sistema de Fidelización Café-VT...")
     await init_db()
     logger.info("✅ Base de datos inicializada")
+    await cache_manager.start(settings.REDIS_URL)
+    logger.info("✅ Caché inicializada")
+    await load_tier_table()
+    await load_scoring_model()
+    logger.info("✅ Tabla de niveles y modelo de scoring cargados")
+    if settings.LEDGER_WRITE_BEHIND:
+        await ledger_buffer.start()
     
     yield
     
     # Shutdown
     logger.info("🛑 Cerrando Sistema de Fidelización...")
+    # Confirmar el libro diferido mientras la base de datos sigue abierta
+    await ledger_buffer.stop()
+    await cache_manager.stop()
     await close_db()
     logger.info("✅ Base de datos cerrada")
 
@@ -59,6 +77,7 @@ app.add_middleware(
 
 # Incluir rutas
 app.include_router(loyalty_routes.router, prefix="/api/v1/loyalty", tags=["Loyalty"])
+app.include_router(admin_routes.router, prefix="/admin", tags=["Admin"])
 
 @app.get("/")
 async def root():
@@ -80,7 +99,14 @@ async def health_check():
         "status": "healthy",
         "service": "loyalty-system",
         "components": {
-            "database": "connected"
+            "database": "connected",
+            "database_pool": get_pool_stats(),
+            "admission": admission_controller.stats(),
+            "cache": cache_manager.stats(),
+            "ledger_buffer": ledger_buffer.stats(),
+            "idempotency": idempotency_cache.stats(),
+            "user_locks": user_locks.stats(),
+            "single_flight": single_flight.stats()
         },
         "timestamp": datetime.now().isoformat()
     }
@@ -94,7 +120,8 @@ async def http_exception_handler(request, exc):
             "error": exc.detail,
             "timestamp": datetime.now().isoformat(),
             "path": str(request.url)
-        }
+        },
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(Exception)
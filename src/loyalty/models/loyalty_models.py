@@ -40,6 +40,8 @@ class LoyaltyUser(BaseModel):
     favorite_products: Optional[str] = None
     referral_code: Optional[str] = None
     referred_by: Optional[str] = None
+    referral_count: Optional[int] = 0
+    product_sketch: Optional[int] = 0
     points_expiry_date: Optional[datetime] = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
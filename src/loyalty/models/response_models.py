@@ -0,0 +1,92 @@
+"""
+Modelos de respuesta de las rutas para PHP
+Café-VT - FastAPI + PHP
+
+Las rutas los construyen con ``model_construct`` (los datos ya vienen
+tipados de la BD o del servicio) y se serializan en una sola pasada con
+utils.serialization.json_response.
+"""
+
+from datetime import datetime
+from typing import Any, List, Optional, Union
+from pydantic import BaseModel
+
+
+class ErrorResponse(BaseModel):
+    """Respuesta de error con HTTP 200 que espera el controlador PHP"""
+    success: bool = False
+    message: str
+
+
+class ProfileData(BaseModel):
+    """Perfil de fidelización mostrado en el panel PHP"""
+    user_name: str
+    current_points: int
+    total_points: int
+    current_tier: str
+    score: float
+    progress_percentage: float
+    next_tier: str
+    points_to_next_tier: int
+    current_benefits: List[str]
+    next_benefits: List[str]
+    join_date: str
+    last_visit: str
+    total_visits: int
+    total_spent: float
+    rewards_redeemed: int
+
+
+class ProfileResponse(BaseModel):
+    success: bool = True
+    data: ProfileData
+
+
+class TransactionItem(BaseModel):
+    """Fila de loyalty_transactions tal como la lista /transactions"""
+    id: int
+    user_id: int
+    transaction_type: str
+    points_amount: int
+    order_id: Optional[int] = None
+    description: Optional[str] = None
+    balance_before: Optional[int] = None
+    balance_after: Optional[int] = None
+    created_at: datetime
+
+
+class TransactionsPageResponse(BaseModel):
+    success: bool = True
+    data: List[TransactionItem]
+    next_cursor: Optional[str] = None
+
+
+class EarnPointsData(BaseModel):
+    user_id: int
+    points_earned: int
+    new_balance: int
+    current_tier: str
+    tier_status: Optional[dict] = None
+    message: str
+
+
+class EarnPointsResponse(BaseModel):
+    success: bool = True
+    data: EarnPointsData
+
+
+class BatchErrorItem(ErrorResponse):
+    """Subpetición de /batch que falló, con el código HTTP que habría devuelto sola"""
+    status: int
+
+
+class BatchResponse(BaseModel):
+    """Respuestas de /batch, en el orden de las subpeticiones"""
+    success: bool = True
+    results: List[Any]
+
+
+class EarnPointsBatchResponse(BaseModel):
+    """Resultado de /earn-points/batch por abono, en el orden de la petición"""
+    success: bool = True
+    results: List[Union[EarnPointsResponse, ErrorResponse]]
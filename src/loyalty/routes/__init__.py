@@ -6,6 +6,7 @@ __version__ = "1.0.0"
 __author__ = "Café-VT Development Team"
 
 from .loyalty_routes import router as loyalty_router
+from .admin_routes import router as admin_router
 
 # Incluir todas las rutas
-__all__ = ['loyalty_router'] 
\ No newline at end of file
+__all__ = ['loyalty_router', 'admin_router'] 
\ No newline at end of file
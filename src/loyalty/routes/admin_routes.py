@@ -0,0 +1,78 @@
+"""
+Rutas de administración y diagnóstico del sistema de fidelización
+"""
+
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+
+from config import settings
+from utils.query_stats import query_stats
+from utils.tier_table import reload_tier_table
+from services.scoring_model import reload_scoring_model
+from routes.loyalty_routes import loyalty_service
+
+ORDER_FIELDS = ("total_ms", "avg_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms", "count", "rows", "errors")
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """
+    Exigir la cabecera X-Admin-Token. Sin LOYALTY_ADMIN_TOKEN configurado
+    /admin/* queda cerrado: el log de consultas lentas incluye parámetros.
+    """
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="Administración desactivada: LOYALTY_ADMIN_TOKEN no configurado")
+    if not hmac.compare_digest(x_admin_token or "", settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Token de administración inválido")
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/query-stats")
+async def get_query_stats(
+    order_by: str = Query("total_ms", description="Campo de ordenación (mayor a menor)"),
+    limit: int = Query(50, ge=1, le=500, description="Número máximo de sentencias")
+):
+    """Estadísticas por sentencia SQL de este worker (latencias p50/p95/p99, filas, errores)"""
+    if order_by not in ORDER_FIELDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"order_by debe ser uno de: {', '.join(ORDER_FIELDS)}"
+        )
+    return {
+        "success": True,
+        "data": query_stats.snapshot(order_by=order_by, limit=limit)
+    }
+
+
+@router.delete("/query-stats")
+async def reset_query_stats():
+    """Reiniciar las estadísticas de sentencias de este worker"""
+    query_stats.reset()
+    return {"success": True, "message": "Estadísticas de consultas reiniciadas"}
+
+
+@router.post("/tier-table/reload")
+async def reload_tiers():
+    """Recompilar la tabla de niveles desde loyalty_tier_config en todos los workers"""
+    table = await reload_tier_table()
+    return {"success": True, "data": table.as_dict()}
+
+
+@router.post("/scoring-model/reload")
+async def reload_scoring():
+    """Recompilar el modelo de scoring desde loyalty_config en todos los workers"""
+    model = await reload_scoring_model()
+    return {"success": True, "data": model.as_dict()}
+
+
+@router.post("/rewards/reload")
+async def reload_rewards():
+    """Regenerar el catálogo de recompensas (y su ETag) en todos los workers tras editar loyalty_rewards"""
+    # La instancia que sirve /rewards: se regenera su catálogo, no el de una copia
+    await loyalty_service.invalidate_rewards_cache()
+    etag, _ = await loyalty_service.get_rewards_catalog()
+    return {"success": True, "data": {"etag": etag}}
@@ -2,146 +2,131 @@
 Rutas para el sistema de fidelización
 """
 
-from fastapi import APIRouter, HTTPException, Depends, status, Query
-from typing import List, Optional, Dict, Any
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Depends, status, Query, Header, Response
+from typing import List, Literal, Optional, Dict, Any
 from datetime import datetime, timedelta
 from pydantic import BaseModel
 
 from models.loyalty_models import LoyaltyUser, LoyaltyUserCreate, LoyaltyUserUpdate, LoyaltyUserOut
 from models.reward_models import Reward
 from models.transaction_models import Transaction
+from models.response_models import (
+    ErrorResponse, ProfileData, ProfileResponse, TransactionItem, TransactionsPageResponse,
+    EarnPointsData, EarnPointsResponse, BatchErrorItem, BatchResponse, EarnPointsBatchResponse
+)
+from config import settings
 from services.loyalty_service import LoyaltyService
 from services.reward_service import RewardService
-from utils.database import get_db, execute_query, execute_single_query
+from utils.database import get_db, execute_query, execute_single_query, PoolExhaustedError
+from utils.admission import admission_controller, critical_request, non_critical_request
+from utils.tier_table import get_tier_table
+from utils.pagination import InvalidCursorError, next_cursor
+from utils.serialization import dumps, json_response
 
 router = APIRouter()
 
 # Inicializar servicios
 loyalty_service = LoyaltyService()
 
+TRANSACTIONS_PAGE_SIZE = 10
+TRANSACTIONS_MAX_PAGE_SIZE = 200
+
 # =====================================================
 # RUTAS ESENCIALES PARA EL CONTROLADOR PHP
 # =====================================================
 
-@router.get("/profile/{user_id}")
+# Beneficios por nivel (se construyen una vez, no en cada petición)
+TIER_BENEFITS = {
+    "cafe_bronze": [
+        "1 punto por cada $1 gastado",
+        "Descuento del 5% en cumpleaños",
+        "Acceso a recompensas básicas"
+    ],
+    "cafe_plata": [
+        "1.2 puntos por cada $1 gastado",
+        "Descuento del 10% en cumpleaños",
+        "Recompensas exclusivas",
+        "Prioridad en pedidos"
+    ],
+    "cafe_oro": [
+        "1.5 puntos por cada $1 gastado",
+        "Descuento del 15% en cumpleaños",
+        "Envío gratis",
+        "Soporte prioritario",
+        "Ofertas exclusivas"
+    ],
+    "cafe_diamante": [
+        "2 puntos por cada $1 gastado",
+        "Descuento del 20% en cumpleaños",
+        "Envío gratis",
+        "Soporte VIP",
+        "Ofertas premium",
+        "Acceso anticipado a nuevos productos"
+    ]
+}
+
+@router.get("/profile/{user_id}", responses={200: {"model": ProfileResponse}},
+            dependencies=[Depends(non_critical_request)])
 async def get_user_profile(user_id: int):
     """Obtener perfil de fidelización de un usuario (para PHP)"""
     try:
-        user = await loyalty_service.get_user_by_id(user_id)
-        if not user:
+        # Usuario, nombre y canjes en un solo viaje a la base de datos
+        profile = await loyalty_service.get_user_profile(user_id)
+        if not profile:
             # Crear perfil por defecto si no existe
-            return {
-                "success": True,
-                "data": {
-                    "current_points": 0,
-                    "total_points": 0,
-                    "current_tier": "cafe_bronze",
-                    "progress_percentage": 0,
-                    "next_tier": "cafe_plata",
-                    "points_to_next_tier": 1000,
-                    "current_benefits": [
-                        "1 punto por cada $1 gastado",
-                        "Descuento del 5% en cumpleaños",
-                        "Acceso a recompensas básicas"
-                    ],
-                    "next_benefits": [
-                        "1.2 puntos por cada $1 gastado",
-                        "Descuento del 10% en cumpleaños",
-                        "Recompensas exclusivas",
-                        "Prioridad en pedidos"
-                    ],
-                    "join_date": datetime.now().strftime("%Y-%m-%d"),
-                    "last_visit": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "total_visits": 0,
-                    "total_spent": 0.0,
-                    "rewards_redeemed": 0
-                }
-            }
+            tier_progress = get_tier_table().progress("cafe_bronze", 0)
+            return json_response(ProfileResponse.model_construct(data=ProfileData.model_construct(
+                user_name="Usuario",
+                current_points=0,
+                total_points=0,
+                current_tier="cafe_bronze",
+                score=0.0,
+                progress_percentage=0.0,
+                next_tier=tier_progress["next_tier"] or "cafe_bronze",
+                points_to_next_tier=tier_progress["points_needed"],
+                current_benefits=TIER_BENEFITS["cafe_bronze"],
+                next_benefits=TIER_BENEFITS["cafe_plata"],
+                join_date=datetime.now().strftime("%Y-%m-%d"),
+                last_visit=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                total_visits=0,
+                total_spent=0.0,
+                rewards_redeemed=0
+            )))
 
-        # Obtener umbrales de la base de datos
-        tier_config_query = "SELECT tier_name, points_required FROM loyalty_tier_config ORDER BY points_required"
-        tier_configs = await execute_query(tier_config_query)
-        tier_thresholds = {row['tier_name']: row['points_required'] for row in tier_configs}
-        
-        # Orden de niveles
-        tier_order = ["cafe_bronze", "cafe_plata", "cafe_oro", "cafe_diamante"]
-        current_tier = user.current_tier
-        current_points = user.total_points
-        idx = tier_order.index(current_tier)
-        next_tier = tier_order[min(idx+1, len(tier_order)-1)]
-        current_threshold = tier_thresholds[current_tier]
-        next_threshold = tier_thresholds[next_tier] if next_tier != current_tier else current_threshold
-        points_needed = max(0, next_threshold - current_points) if next_tier != current_tier else 0
-        if next_threshold == current_threshold:
-            progress = 100
-        else:
-            progress = min(100, max(0, ((current_points - current_threshold) / (next_threshold - current_threshold)) * 100))
+        user = profile["user"]
+        current_tier = getattr(user.current_tier, "value", user.current_tier)
+        # Progreso según la tabla de niveles compilada (sin consultar loyalty_tier_config)
+        tier_progress = get_tier_table().progress(user.current_tier, user.total_points)
+        # En el nivel máximo el "siguiente" nivel es el propio
+        next_tier = tier_progress["next_tier"] or current_tier
+        points_needed = tier_progress["points_needed"]
+        progress = tier_progress["progress_percentage"]
 
-        # Definir beneficios por nivel (puedes mejorarlo si tienes tabla de beneficios)
-        benefits = {
-            "cafe_bronze": [
-                "1 punto por cada $1 gastado",
-                "Descuento del 5% en cumpleaños",
-                "Acceso a recompensas básicas"
-            ],
-            "cafe_plata": [
-                "1.2 puntos por cada $1 gastado",
-                "Descuento del 10% en cumpleaños",
-                "Recompensas exclusivas",
-                "Prioridad en pedidos"
-            ],
-            "cafe_oro": [
-                "1.5 puntos por cada $1 gastado",
-                "Descuento del 15% en cumpleaños",
-                "Envío gratis",
-                "Soporte prioritario",
-                "Ofertas exclusivas"
-            ],
-            "cafe_diamante": [
-                "2 puntos por cada $1 gastado",
-                "Descuento del 20% en cumpleaños",
-                "Envío gratis",
-                "Soporte VIP",
-                "Ofertas premium",
-                "Acceso anticipado a nuevos productos"
-            ]
-        }
-
-        # Obtener nombre de usuario y estadísticas
-        user_details = await loyalty_service.get_user_details(user_id)
-        total_visits = user.total_visits
-        total_spent = user.total_spent
-        # Contar canjes
-        redemptions_query = "SELECT COUNT(*) as count FROM loyalty_redemptions WHERE user_id = %s"
-        redemptions_result = await execute_single_query(redemptions_query, (user_id,))
-        rewards_redeemed = redemptions_result['count'] if redemptions_result else 0
-
-        return {
-            "success": True,
-            "data": {
-                "user_name": user_details.get("name", "Usuario"),
-                "current_points": user.total_points,
-                "total_points": user.total_points,
-                "current_tier": user.current_tier,
-                "progress_percentage": round(progress, 1),
-                "next_tier": next_tier,
-                "points_to_next_tier": points_needed,
-                "current_benefits": benefits.get(user.current_tier, []),
-                "next_benefits": benefits.get(next_tier, []),
-                "join_date": user.join_date.strftime("%Y-%m-%d") if user.join_date else datetime.now().strftime("%Y-%m-%d"),
-                "last_visit": user.last_visit.strftime("%Y-%m-%d %H:%M:%S") if user.last_visit else datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "total_visits": total_visits,
-                "total_spent": float(total_spent),
-                "rewards_redeemed": rewards_redeemed
-            }
-        }
+        return json_response(ProfileResponse.model_construct(data=ProfileData.model_construct(
+            user_name=profile["name"] or "Usuario",
+            current_points=user.total_points,
+            total_points=user.total_points,
+            current_tier=current_tier,
+            score=loyalty_service.score_user(user),
+            progress_percentage=round(progress, 1),
+            next_tier=next_tier,
+            points_to_next_tier=points_needed,
+            current_benefits=TIER_BENEFITS.get(current_tier, []),
+            next_benefits=TIER_BENEFITS.get(next_tier, []),
+            join_date=user.join_date.strftime("%Y-%m-%d") if user.join_date else datetime.now().strftime("%Y-%m-%d"),
+            last_visit=user.last_visit.strftime("%Y-%m-%d %H:%M:%S") if user.last_visit else datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            total_visits=user.total_visits,
+            total_spent=float(user.total_spent),
+            rewards_redeemed=profile["rewards_redeemed"]
+        )))
+    except PoolExhaustedError:
+        raise admission_controller.overloaded()
     except Exception as e:
         import logging
         logging.error(f"Error en get_user_profile para user_id={user_id}: {e}", exc_info=True)
-        return {
-            "success": False,
-            "message": f"Error obteniendo perfil: {str(e)}"
-        }
+        return json_response(ErrorResponse.model_construct(message=f"Error obteniendo perfil: {str(e)}"))
 
 @router.get("/referrals/{user_id}")
 async def get_user_referrals(user_id: int):
@@ -165,116 +150,231 @@ async def get_user_referrals(user_id: int):
             "message": f"Error obteniendo referidos: {str(e)}"
         }
 
-@router.get("/rewards")
-async def get_available_rewards():
-    """Obtener recompensas disponibles (para PHP)"""
-    try:
-        print("🔍 DEBUG: Petición a /v1/loyalty/rewards recibida.")
-        rewards = await loyalty_service.get_all_rewards()
-        print(f"🔍 DEBUG: Recompensas obtenidas del servicio: {len(rewards)} items.")
-        
-        # Para ver qué datos se están obteniendo exactamente
-        if rewards:
-            print(f"🔍 DEBUG: Primera recompensa: {rewards[0].__dict__}")
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Comparación débil de If-None-Match (lista de ETags, "*" o prefijo W/)"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates)
 
-        return {
-            "success": True,
-            "data": rewards
-        }
+@router.get("/rewards", dependencies=[Depends(non_critical_request)])
+async def get_available_rewards(if_none_match: Optional[str] = Header(None)):
+    """
+    Obtener recompensas disponibles (para PHP).
+    Se envía el catálogo ya serializado con su ETag; con If-None-Match
+    vigente responde 304 sin cuerpo ni consultas.
+    """
+    try:
+        etag, body = await loyalty_service.get_rewards_catalog()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+    except PoolExhaustedError:
+        raise admission_controller.overloaded()
     except Exception as e:
         # Usamos logger para un error más formal
         import logging
         logger = logging.getLogger(__name__)
         logger.error(f"❌ ERROR en /rewards: {e}", exc_info=True)
-        return {
-            "success": False,
-            "message": f"Error obteniendo recompensas: {str(e)}"
-        }
+        return json_response(ErrorResponse.model_construct(message=f"Error obteniendo recompensas: {str(e)}"))
 
-@router.get("/transactions/{user_id}")
-async def get_user_transactions_api(user_id: int, page: int = 1):
-    """Obtener transacciones de un usuario (para PHP)"""
+@router.get("/transactions/{user_id}", responses={200: {"model": TransactionsPageResponse}},
+            dependencies=[Depends(non_critical_request)])
+async def get_user_transactions_api(user_id: int, page: int = 1, cursor: Optional[str] = None,
+                                    limit: int = TRANSACTIONS_PAGE_SIZE):
+    """
+    Obtener transacciones de un usuario (para PHP).
+    `next_cursor` pide la página siguiente con coste constante; `page` se
+    mantiene por compatibilidad (OFFSET) y se ignora si llega `cursor`.
+    `limit` (hasta TRANSACTIONS_MAX_PAGE_SIZE) deja cargar más filas por viaje.
+    """
     try:
-        skip = (page - 1) * 10
-        transactions = await loyalty_service.get_user_transactions(user_id, skip=skip, limit=10)
+        limit = max(1, min(limit, TRANSACTIONS_MAX_PAGE_SIZE))
+        skip = (page - 1) * limit
+        transactions = await loyalty_service.get_user_transactions(
+            user_id, skip=skip, limit=limit, cursor=cursor
+        )
         
-        return {
-            "success": True,
-            "data": transactions
-        }
+        return json_response(TransactionsPageResponse.model_construct(
+            data=[TransactionItem.model_construct(**tx) for tx in transactions],
+            next_cursor=next_cursor(
+                transactions, limit, key=lambda tx: (tx['created_at'], tx['id'])
+            )
+        ))
+    except InvalidCursorError as e:
+        return json_response(ErrorResponse.model_construct(message=str(e)))
+    except PoolExhaustedError:
+        raise admission_controller.overloaded()
     except Exception as e:
-        return {
-            "success": False,
-            "message": f"Error obteniendo transacciones: {str(e)}"
-        }
+        return json_response(ErrorResponse.model_construct(message=f"Error obteniendo transacciones: {str(e)}"))
+
+class BatchSubRequest(BaseModel):
+    op: Literal["profile", "rewards", "transactions"]
+    user_id: Optional[int] = None
+    page: int = 1
+    cursor: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    requests: List[BatchSubRequest]
+
+async def _batch_read(request: BatchSubRequest) -> Any:
+    """
+    Respuesta de una subpetición de /batch con la misma ruta que la atendería
+    sola. Un error (p.ej. el 503 por sobrecarga) queda en su elemento con su
+    código y no hace fallar las demás subpeticiones.
+    """
+    try:
+        if request.op == "rewards":
+            return await get_available_rewards(None)
+        if request.user_id is None:
+            return BatchErrorItem.model_construct(
+                status=status.HTTP_400_BAD_REQUEST, message=f"'{request.op}' requiere user_id"
+            )
+        if request.op == "profile":
+            return await get_user_profile(request.user_id)
+        return await get_user_transactions_api(request.user_id, request.page, request.cursor)
+    except HTTPException as e:
+        return BatchErrorItem.model_construct(status=e.status_code, message=str(e.detail))
+    except Exception as e:
+        import logging
+        logger = logging.getLogger(__name__)
+        logger.error(f"❌ ERROR en /batch ({request.op}): {e}", exc_info=True)
+        return BatchErrorItem.model_construct(
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR, message=f"Error en la subpetición: {str(e)}"
+        )
+
+@router.post("/batch", responses={200: {"model": BatchResponse}},
+             dependencies=[Depends(non_critical_request)])
+async def batch_read_api(request: BatchRequest):
+    """
+    Varias lecturas (profile, rewards, transactions) en una petición (para PHP).
+    Las subpeticiones se atienden en paralelo, como mucho tantas a la vez
+    como conexiones tiene el pool, y cada resultado es el cuerpo
+    que devolvería su ruta, en el mismo orden; el catálogo ya serializado de
+    /rewards se inserta tal cual.
+    """
+    if len(request.requests) > settings.BATCH_MAX_REQUESTS:
+        return json_response(ErrorResponse.model_construct(
+            message=f"Máximo {settings.BATCH_MAX_REQUESTS} subpeticiones por lote"
+        ))
+    # Un lote no debe acaparar el pool ni llenar su cola de espera
+    slots = asyncio.Semaphore(max(1, settings.DB_POOL_MAX_SIZE))
+
+    async def bounded(sub: BatchSubRequest) -> Any:
+        async with slots:
+            return await _batch_read(sub)
+
+    results = await asyncio.gather(*(bounded(sub) for sub in request.requests))
+    bodies = (result.body if isinstance(result, Response) else dumps(result) for result in results)
+    return Response(
+        content=b'{"success":true,"results":[' + b",".join(bodies) + b"]}",
+        media_type="application/json"
+    )
 
 class RedeemRewardRequest(BaseModel):
     user_id: int
     reward_id: int
 
-@router.post("/redeem-reward")
-async def redeem_reward_api(request: RedeemRewardRequest):
-    """Canjear una recompensa (para PHP)"""
+@router.post("/redeem-reward", dependencies=[Depends(critical_request)])
+async def redeem_reward_api(request: RedeemRewardRequest,
+                            idempotency_key: Optional[str] = Header(None, max_length=64)):
+    """Canjear una recompensa (para PHP). Con ``Idempotency-Key`` un reintento no canjea dos veces."""
     try:
-        result = await loyalty_service.redeem_reward(request.user_id, request.reward_id)
-        return {
+        result = await loyalty_service.redeem_reward(request.user_id, request.reward_id, idempotency_key)
+        return json_response({
             "success": True,
             "data": result
-        }
+        })
     except ValueError as e:
-        return {"success": False, "message": str(e)}
+        return json_response(ErrorResponse.model_construct(message=str(e)))
     except Exception as e:
         import logging
         logger = logging.getLogger(__name__)
         logger.error(f"❌ ERROR en /redeem-reward: {e}", exc_info=True)
-        return {
-            "success": False,
-            "message": f"Error inesperado canjeando recompensa: {str(e)}"
-        }
+        return json_response(ErrorResponse.model_construct(message=f"Error inesperado canjeando recompensa: {str(e)}"))
 
 class EarnPointsRequest(BaseModel):
     user_id: int
     points_amount: int
     transaction_type: str = "earn"
     description: str = ""
+    products: Optional[List[str]] = None
+    order_id: Optional[int] = None
+    purchase_amount: float = 0
 
-@router.post("/earn-points")
-async def earn_points_api(request: EarnPointsRequest):
-    """Otorgar puntos a un usuario (para PHP)"""
+@router.post("/earn-points", responses={200: {"model": EarnPointsResponse}},
+             dependencies=[Depends(critical_request)])
+async def earn_points_api(request: EarnPointsRequest,
+                          idempotency_key: Optional[str] = Header(None, max_length=64)):
+    """
+    Otorgar puntos a un usuario (para PHP). Crea el perfil si no existe.
+    Idempotente por `order_id` o, sin pedido, por la cabecera
+    ``Idempotency-Key``: un reintento devuelve la respuesta original sin
+    abonar de nuevo.
+    """
     try:
-        print(f"🔍 DEBUG: Petición a /earn-points recibida - Usuario: {request.user_id}, Puntos: {request.points_amount}")
-        
-        # Verificar que el usuario existe
-        user = await loyalty_service.get_user_by_id(request.user_id)
-        if not user:
-            # Crear usuario si no existe
-            user = await loyalty_service.create_user(LoyaltyUserCreate(user_id=request.user_id))
-            print(f"🔍 DEBUG: Usuario creado - ID: {request.user_id}")
-        
-        # Otorgar puntos
         result = await loyalty_service.earn_points(
             request.user_id, 
             request.points_amount, 
-            None,  # order_id opcional
-            request.description
+            request.order_id,
+            request.description,
+            request.products,
+            idempotency_key,
+            request.purchase_amount
         )
         
-        print(f"🔍 DEBUG: Puntos otorgados exitosamente - Usuario: {request.user_id}, Puntos: {request.points_amount}")
-        
-        return {
-            "success": True,
-            "data": {
-                "user_id": request.user_id,
-                "points_earned": request.points_amount,
-                "new_balance": result.get("new_balance", 0),
-                "message": f"Se otorgaron {request.points_amount} puntos exitosamente"
-            }
-        }
+        return json_response(EarnPointsResponse.model_construct(data=EarnPointsData.model_construct(
+            user_id=request.user_id,
+            points_earned=result["points_earned"],
+            new_balance=result["new_balance"],
+            current_tier=result["current_tier"],
+            tier_status=result.get("tier_status"),
+            message=f"Se otorgaron {result['points_earned']} puntos exitosamente"
+        )))
     except Exception as e:
         import logging
         logger = logging.getLogger(__name__)
         logger.error(f"❌ ERROR en /earn-points: {e}", exc_info=True)
-        return {
-            "success": False,
-            "message": f"Error otorgando puntos: {str(e)}"
-        } 
\ No newline at end of file
+        return json_response(ErrorResponse.model_construct(message=f"Error otorgando puntos: {str(e)}"))
+
+
+class EarnPointsBatchRequest(BaseModel):
+    items: List[EarnPointsRequest]
+
+@router.post("/earn-points/batch", responses={200: {"model": EarnPointsBatchResponse}},
+             dependencies=[Depends(critical_request)])
+async def earn_points_batch_api(request: EarnPointsBatchRequest):
+    """
+    Otorgar puntos por varias compras en una sola transacción (para PHP).
+    Crea los perfiles que no existan. Idempotente por `order_id` de cada
+    abono; el resultado de cada uno va en `results`, en el mismo orden.
+    """
+    if len(request.items) > settings.BATCH_MAX_REQUESTS:
+        return json_response(ErrorResponse.model_construct(
+            message=f"Máximo {settings.BATCH_MAX_REQUESTS} abonos por lote"
+        ))
+    try:
+        results = await loyalty_service.earn_points_batch([
+            (item.user_id, item.points_amount, item.order_id, item.description, item.products,
+             item.purchase_amount)
+            for item in request.items
+        ])
+        return json_response(EarnPointsBatchResponse.model_construct(results=[
+            ErrorResponse.model_construct(message=f"Error otorgando puntos: {result['error']}")
+            if "error" in result else
+            EarnPointsResponse.model_construct(data=EarnPointsData.model_construct(
+                user_id=item.user_id,
+                points_earned=result["points_earned"],
+                new_balance=result["new_balance"],
+                current_tier=result["current_tier"],
+                tier_status=result.get("tier_status"),
+                message=f"Se otorgaron {result['points_earned']} puntos exitosamente"
+            ))
+            for item, result in zip(request.items, results)
+        ]))
+    except Exception as e:
+        import logging
+        logger = logging.getLogger(__name__)
+        logger.error(f"❌ ERROR en /earn-points/batch: {e}", exc_info=True)
+        return json_response(ErrorResponse.model_construct(message=f"Error otorgando puntos: {str(e)}"))
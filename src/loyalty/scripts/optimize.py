@@ -16,16 +16,18 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 class LoyaltyOptimizer:
-    def __init__(self):
+    def __init__(self, api_url="http://localhost:8000", admin_token=None, top=10):
         self.project_root = Path(__file__).parent.parent
+        self.api_url = api_url
+        self.admin_token = admin_token or os.getenv('LOYALTY_ADMIN_TOKEN', '')
+        self.top = top
+        self.query_report = {}
         
     def optimize_database_queries(self):
         """Optimizar consultas de base de datos"""
         logger.info("🗄️  Optimizando consultas de base de datos...")
         
         try:
-            from utils.database import get_database_connection
-            
             # Verificar índices existentes
             self._check_database_indexes()
             
@@ -56,7 +58,12 @@ class LoyaltyOptimizer:
                 "CREATE INDEX IF NOT EXISTS idx_loyalty_transactions_created_at ON loyalty_transactions(created_at)",
                 "CREATE INDEX IF NOT EXISTS idx_loyalty_rewards_tier_required ON loyalty_rewards(tier_required)",
                 "CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_user_id ON loyalty_coupons(user_id)",
-                "CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_valid_until ON loyalty_coupons(valid_until)"
+                "CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_valid_until ON loyalty_coupons(valid_until)",
+                # Paginación por clave (created_at, id)
+                "CREATE INDEX IF NOT EXISTS idx_loyalty_transactions_user_created ON loyalty_transactions(user_id, created_at, id)",
+                "CREATE INDEX IF NOT EXISTS idx_loyalty_users_created ON loyalty_users(created_at, user_id)",
+                "CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_created ON loyalty_coupons(created_at, id)",
+                "CREATE INDEX IF NOT EXISTS idx_loyalty_coupons_user_created ON loyalty_coupons(user_id, created_at, id)"
             ]
             
             for index_sql in indexes:
@@ -70,15 +77,48 @@ class LoyaltyOptimizer:
             logger.error(f"❌ Error verificando índices: {e}")
     
     def _optimize_frequent_queries(self):
-        """Optimizar consultas frecuentes"""
-        logger.info("⚡ Optimizando consultas frecuentes...")
+        """Analizar las consultas más costosas a partir de /admin/query-stats"""
+        logger.info("⚡ Analizando consultas frecuentes...")
+        
+        # Las estadísticas son por worker: la petición las toma del worker que la atienda
+        import requests
+        
+        headers = {"X-Admin-Token": self.admin_token} if self.admin_token else {}
+        try:
+            response = requests.get(
+                f"{self.api_url}/admin/query-stats",
+                params={"order_by": "total_ms", "limit": self.top},
+                headers=headers,
+                timeout=10
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudieron obtener estadísticas de consultas: {e}")
+            return
+        
+        data = response.json()["data"]
+        statements = data["statements"]
         
-        # Aquí irían optimizaciones específicas como:
-        # - Crear vistas materializadas
-        # - Optimizar consultas de scoring
-        # - Implementar caché para consultas frecuentes
+        logger.info(
+            f"📊 {data['tracked_statements']} sentencias registradas, "
+            f"{data['slow_queries']} lentas (umbral {data['slow_threshold_ms']} ms)"
+        )
+        for stmt in statements:
+            logger.info(
+                f"  {stmt['total_ms']:>10.1f} ms total | {stmt['count']:>7} llamadas | "
+                f"p50 {stmt['p50_ms']:.1f} / p95 {stmt['p95_ms']:.1f} / p99 {stmt['p99_ms']:.1f} ms | "
+                f"{stmt['avg_rows']} filas/llamada | {stmt['query'][:120]}"
+            )
+        
+        slow = [s for s in statements if data['slow_threshold_ms'] and s['p95_ms'] >= data['slow_threshold_ms']]
+        self.query_report = {
+            "slow_threshold_ms": data["slow_threshold_ms"],
+            "slow_queries": data["slow_queries"],
+            "top_statements": statements,
+            "slow_statements": [s["query"] for s in slow]
+        }
         
-        logger.info("✅ Consultas optimizadas")
+        logger.info("✅ Análisis de consultas completado")
     
     def _cleanup_old_data(self):
         """Limpiar datos antiguos"""
@@ -178,6 +218,7 @@ class LoyaltyOptimizer:
                 "scoring": "completed", 
                 "api": "completed"
             },
+            "queries": self.query_report,
             "recommendations": [
                 "Implementar Redis para caché de scores",
                 "Configurar índices adicionales según uso",
@@ -235,10 +276,16 @@ def main():
     parser = argparse.ArgumentParser(description="Script de optimización del sistema de fidelización")
     parser.add_argument("--type", choices=["database", "scoring", "api", "full"], default="full",
                        help="Tipo de optimización")
+    parser.add_argument("--api-url", default="http://localhost:8000",
+                       help="URL de la API de fidelización")
+    parser.add_argument("--admin-token", default=None,
+                       help="Token de administración (por defecto LOYALTY_ADMIN_TOKEN)")
+    parser.add_argument("--top", type=int, default=10,
+                       help="Número de sentencias a analizar")
     
     args = parser.parse_args()
     
-    optimizer = LoyaltyOptimizer()
+    optimizer = LoyaltyOptimizer(api_url=args.api_url, admin_token=args.admin_token, top=args.top)
     
     if args.type == "database":
         optimizer.optimize_database_queries()
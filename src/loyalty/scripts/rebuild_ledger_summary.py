@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Recálculo del resumen del libro por usuario - Sistema de Fidelización
+
+Rehace loyalty_user_summary desde loyalty_transactions. El trigger lo mantiene
+al día; este comando sirve tras cargas manuales del libro o para verificarlo:
+    cd /app && python scripts/rebuild_ledger_summary.py --chunk-size 1000
+"""
+
+import sys
+import time
+import asyncio
+import logging
+from pathlib import Path
+
+# Permitir ejecutar el script desde cualquier directorio
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import settings
+from utils.database import init_db, close_db
+from services.loyalty_service import LoyaltyService
+
+# Configurar logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+async def rebuild(chunk_size: int) -> int:
+    """Recalcular el resumen de todos los usuarios de loyalty_users"""
+    await init_db()
+    try:
+        return await LoyaltyService().rebuild_ledger_summaries(chunk_size=chunk_size)
+    finally:
+        await close_db()
+
+
+def main():
+    """Función principal"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Recalcular loyalty_user_summary desde el libro de transacciones")
+    parser.add_argument("--chunk-size", type=int, default=settings.DB_BULK_CHUNK_SIZE,
+                       help="Usuarios por bloque (y por transacción)")
+    
+    args = parser.parse_args()
+    
+    logger.info("📒 Iniciando recálculo del resumen del libro...")
+    start_time = time.time()
+    
+    try:
+        processed = asyncio.run(rebuild(args.chunk_size))
+    except Exception as e:
+        logger.error(f"❌ Error recalculando resúmenes: {e}")
+        sys.exit(1)
+    
+    logger.info(f"✅ {processed} usuarios recalculados en {time.time() - start_time:.2f} segundos")
+
+if __name__ == "__main__":
+    main()
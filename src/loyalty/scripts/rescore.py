@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Recálculo nocturno de scores - Sistema de Fidelización
+
+Ejemplo de cron (3 AM diario):
+    0 3 * * * cd /app && python scripts/rescore.py --chunk-size 1000
+"""
+
+import sys
+import time
+import asyncio
+import logging
+from pathlib import Path
+
+# Permitir ejecutar el script desde cualquier directorio
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import settings
+from utils.database import init_db, close_db
+from services.loyalty_service import LoyaltyService
+
+# Configurar logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+async def rescore(chunk_size: int) -> int:
+    """Recalcular el score de toda la tabla loyalty_users"""
+    await init_db()
+    try:
+        return await LoyaltyService().rescore_all_users(chunk_size=chunk_size)
+    finally:
+        await close_db()
+
+
+def main():
+    """Función principal"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Recalcular el score de fidelización de todos los usuarios")
+    parser.add_argument("--chunk-size", type=int, default=settings.DB_BULK_CHUNK_SIZE,
+                       help="Usuarios por bloque de lectura/escritura")
+    
+    args = parser.parse_args()
+    
+    logger.info("🧮 Iniciando recálculo de scores...")
+    start_time = time.time()
+    
+    try:
+        processed = asyncio.run(rescore(args.chunk_size))
+    except Exception as e:
+        logger.error(f"❌ Error recalculando scores: {e}")
+        sys.exit(1)
+    
+    logger.info(f"✅ {processed} usuarios recalculados en {time.time() - start_time:.2f} segundos")
+
+if __name__ == "__main__":
+    main()
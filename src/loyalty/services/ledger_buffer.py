@@ -0,0 +1,420 @@
+"""
+Buffer de escritura diferida (write-behind) para el libro de puntos
+
+Las acumulaciones se encolan en memoria y una tarea de fondo las confirma en
+grupo: un INSERT multi-fila en loyalty_transactions y un UPDATE agregado por
+usuario en loyalty_users, en una sola transacción, cada N ms o N filas.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import settings
+from utils.cache import cache_manager
+from utils.database import UnitOfWork, mark_recent_write, transaction
+from utils.tier_table import get_tier_table
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_INSERT_QUERY = """
+    INSERT INTO loyalty_transactions (
+        user_id, transaction_type, points_amount, order_id,
+        description, balance_before, balance_after, created_at
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+_SPOOL_FILE = re.compile(r"^ledger-(\d+)(?:-\d+)?\.spool$")
+
+
+class LedgerEntry:
+    """Acumulación pendiente de confirmar"""
+
+    __slots__ = ("user_id", "transaction_type", "points", "order_id", "description",
+                 "product_bits", "created_at", "amount")
+
+    def __init__(self, user_id: int, transaction_type: str, points: int, order_id: Optional[int],
+                 description: str, product_bits: int = 0, created_at: Optional[datetime] = None,
+                 amount: float = 0):
+        self.user_id = user_id
+        self.transaction_type = transaction_type
+        self.points = points
+        self.order_id = order_id
+        self.description = description
+        self.product_bits = product_bits
+        self.created_at = created_at or datetime.now()
+        self.amount = amount
+
+    def to_json(self) -> str:
+        return json.dumps([
+            self.user_id, self.transaction_type, self.points, self.order_id,
+            self.description, self.product_bits, self.created_at.isoformat(), self.amount
+        ])
+
+    @classmethod
+    def from_json(cls, line: str) -> "LedgerEntry":
+        # Los spools anteriores no guardan el importe
+        user_id, transaction_type, points, order_id, description, product_bits, created_at, *amount = json.loads(line)
+        return cls(user_id, transaction_type, points, order_id, description, product_bits,
+                   datetime.fromisoformat(created_at), amount[0] if amount else 0)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _chunks(items: List[Any], size: int) -> Iterable[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def lock_balances(uow: UnitOfWork, user_ids: List[int]) -> Dict[int, Tuple[int, str]]:
+    """
+    ``user_id -> (saldo, nivel)`` de los usuarios existentes, bloqueados
+    FOR UPDATE en orden de user_id para no cruzarse con otros grupos
+    """
+    balances: Dict[int, Tuple[int, str]] = {}
+    for chunk in _chunks(user_ids, settings.DB_BULK_CHUNK_SIZE):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        rows = await uow.execute_query(
+            f"SELECT user_id, total_points, current_tier FROM loyalty_users "
+            f"WHERE user_id IN ({placeholders}) ORDER BY user_id",
+            tuple(chunk), for_update=True
+        )
+        for row in rows:
+            balances[row['user_id']] = (row['total_points'] or 0, row['current_tier'])
+    return balances
+
+
+async def apply_entries(uow: UnitOfWork, entries: List[LedgerEntry],
+                        balances: Dict[int, Tuple[int, str]]) -> List[Optional[Tuple[int, int, str, str]]]:
+    """
+    Escribir `entries` con un INSERT multi-fila en el libro y un UPDATE
+    agregado por usuario (saldo, visitas, productos, última visita, total
+    gastado y nivel).
+    `balances` viene de lock_balances y se actualiza con los nuevos saldos.
+
+    Devuelve por entrada ``(saldo antes, saldo después, nivel antes, nivel
+    después)``, o None si el usuario no está en `balances` (no se escribe).
+    """
+    table = get_tier_table()
+    chunk_size = settings.DB_BULK_CHUNK_SIZE
+
+    outcomes: List[Optional[Tuple[int, int, str, str]]] = []
+    ledger_rows = []
+    totals: Dict[int, List[Any]] = {}
+    for entry in entries:
+        if entry.user_id not in balances:
+            outcomes.append(None)
+            continue
+        before, tier = balances[entry.user_id]
+        after = before + entry.points
+        # Solo ascensos, como en el procedimiento de acumulación
+        new_tier = table.tier_for_points(after)
+        new_tier = new_tier if table.is_upgrade(tier, new_tier) else tier
+        balances[entry.user_id] = (after, new_tier)
+        outcomes.append((before, after, tier, new_tier))
+        ledger_rows.append((
+            entry.user_id, entry.transaction_type, entry.points, entry.order_id,
+            entry.description, before, after, entry.created_at
+        ))
+        # delta, visitas, bits de producto, última visita, importe
+        total = totals.setdefault(entry.user_id, [0, 0, 0, entry.created_at, 0])
+        total[0] += entry.points
+        total[1] += 1
+        total[2] |= entry.product_bits
+        total[3] = max(total[3], entry.created_at)
+        total[4] += entry.amount or 0
+
+    if not ledger_rows:
+        return outcomes
+    await uow.execute_many(TRANSACTION_INSERT_QUERY, ledger_rows)
+
+    now = datetime.now()
+    for chunk in _chunks(list(totals.items()), chunk_size):
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        placeholders = ", ".join(["%s"] * len(chunk))
+        params: List[Any] = []
+        for column in range(5):
+            for user_id, total in chunk:
+                params.extend((user_id, total[column]))
+        for user_id, _ in chunk:
+            params.extend((user_id, balances[user_id][1]))
+        params.append(now)
+        params.extend(user_id for user_id, _ in chunk)
+        await uow.execute_update(
+            f"UPDATE loyalty_users SET "
+            f"total_points = total_points + CASE user_id {cases} END, "
+            f"total_visits = total_visits + CASE user_id {cases} END, "
+            f"product_sketch = product_sketch | CASE user_id {cases} END, "
+            f"last_visit = CASE user_id {cases} END, "
+            f"total_spent = total_spent + CASE user_id {cases} END, "
+            f"current_tier = CASE user_id {cases} END, "
+            f"updated_at = %s "
+            f"WHERE user_id IN ({placeholders})",
+            tuple(params)
+        )
+    return outcomes
+
+
+class LedgerBuffer:
+    """
+    Cola en memoria de acumulaciones con confirmación en grupo.
+
+    Durabilidad: ``stop()`` vacía la cola al apagar. Con `spool_dir` cada
+    entrada se añade además a un archivo local (``ledger-<pid>.spool``) y se
+    sincroniza a disco antes de aceptarse; al confirmar un grupo se borran sus segmentos y al arrancar
+    se reprocesan los de workers que ya no existen. La garantía es "al menos
+    una vez": una caída entre el COMMIT y el borrado del segmento repite esas
+    entradas.
+    """
+
+    def __init__(self, flush_interval_ms: int, max_rows: int, max_pending: int,
+                 spool_dir: str = ""):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.spool_dir = spool_dir
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self.rejected = 0
+        self.replayed = 0
+        self._pending: List[LedgerEntry] = []
+        self._pending_delta: Dict[int, int] = {}
+        # Deltas del grupo que se está confirmando, hasta invalidar la caché
+        self._inflight_delta: Dict[int, int] = {}
+        # Impar mientras un grupo se está confirmando
+        self._commit_sequence = 0
+        self._segments: List[str] = []
+        self._spool = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def pending_delta(self, user_id: int) -> int:
+        """
+        Puntos de `user_id` que la caché de usuarios aún no refleja: encolados
+        o en un grupo cuyo COMMIT e invalidación de caché no han terminado
+        """
+        return self._pending_delta.get(user_id, 0) + self._inflight_delta.get(user_id, 0)
+
+    @property
+    def commit_sequence(self) -> int:
+        """Cambia al empezar y al terminar cada confirmación (impar = en curso)"""
+        return self._commit_sequence
+
+    def uncommitted_delta(self, user_id: int) -> int:
+        """
+        Puntos de `user_id` encolados que el primario aún no tiene. Solo es
+        exacto si `commit_sequence` es par y no cambió durante la lectura.
+        """
+        return self._pending_delta.get(user_id, 0)
+
+    def add(self, entry: LedgerEntry) -> bool:
+        """
+        Encolar una acumulación. Devuelve False si el buffer no está activo o
+        está lleno (p.ej. con la base de datos caída): el llamador debe
+        escribir de forma síncrona.
+        """
+        if not self.running or len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            return False
+        if self._spool is not None:
+            self._spool.write(entry.to_json() + "\n")
+            self._spool.flush()
+            # Aceptar la entrada solo cuando ya sobrevive a una caída del sistema
+            os.fsync(self._spool.fileno())
+        self._enqueue(entry)
+        if len(self._pending) >= self.max_rows:
+            self._wakeup.set()
+        return True
+
+    def _enqueue(self, entry: LedgerEntry):
+        self._pending.append(entry)
+        self._pending_delta[entry.user_id] = self._pending_delta.get(entry.user_id, 0) + entry.points
+
+    # ----- Archivo de spool -----
+
+    def _spool_path(self, segment: bool = False) -> str:
+        # Los segmentos llevan un sufijo único para no pisar nunca un archivo existente
+        suffix = f"-{time.time_ns()}" if segment else ""
+        return os.path.join(self.spool_dir, f"ledger-{os.getpid()}{suffix}.spool")
+
+    def _open_spool(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._spool = open(self._spool_path(), "a", encoding="utf-8")
+
+    def _rotate_spool(self):
+        """Cerrar el archivo activo como segmento pendiente de confirmar y abrir uno nuevo"""
+        if self._spool is None:
+            return
+        self._spool.close()
+        segment = self._spool_path(segment=True)
+        os.replace(self._spool_path(), segment)
+        self._segments.append(segment)
+        self._open_spool()
+
+    def _replay_spool(self):
+        """Reclamar y encolar los segmentos de workers que ya no existen (y los propios)"""
+        for name in sorted(os.listdir(self.spool_dir)):
+            match = _SPOOL_FILE.match(name)
+            if not match:
+                continue
+            pid = int(match.group(1))
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            segment = self._spool_path(segment=True)
+            try:
+                os.replace(os.path.join(self.spool_dir, name), segment)
+            except FileNotFoundError:
+                continue  # Otro worker lo reclamó primero
+            with open(segment, encoding="utf-8") as spool:
+                for line in spool:
+                    if line.strip():
+                        self._enqueue(LedgerEntry.from_json(line))
+                        self.replayed += 1
+            self._segments.append(segment)
+        if self.replayed:
+            logger.warning(f"Libro diferido: {self.replayed} entradas recuperadas del spool")
+
+    # ----- Ciclo de vida -----
+
+    async def start(self):
+        """Recuperar el spool (si hay) y arrancar la tarea de confirmación"""
+        if self.running:
+            return
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._replay_spool()
+            self._open_spool()
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"Libro diferido activo: cada {self.flush_interval * 1000:.0f} ms o {self.max_rows} filas"
+        )
+
+    async def stop(self):
+        """Detener la tarea de fondo y confirmar lo pendiente"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Libro diferido: {len(self._pending)} entradas sin confirmar al apagar: {e}")
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Error confirmando el libro diferido ({len(self._pending)} pendientes): {e}")
+                await asyncio.sleep(self.flush_interval)
+
+    # ----- Confirmación en grupo -----
+
+    async def flush(self) -> int:
+        """Confirmar todas las entradas encoladas. Devuelve las filas escritas."""
+        # Una cancelación (p.ej. la de stop()) no corta el grupo entre el COMMIT
+        # y el borrado de sus segmentos: eso lo repetiría al arrancar
+        return await asyncio.shield(self._flush())
+
+    async def _flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, []
+            self._inflight_delta, self._pending_delta = self._pending_delta, {}
+            self._rotate_spool()
+            self._commit_sequence += 1
+            try:
+                written = await self._write(batch)
+            except BaseException:
+                # Devolver el grupo a la cola por delante de lo llegado mientras tanto
+                self._pending[:0] = batch
+                for user_id, delta in self._inflight_delta.items():
+                    self._pending_delta[user_id] = self._pending_delta.get(user_id, 0) + delta
+                self._inflight_delta = {}
+                raise
+            finally:
+                self._commit_sequence += 1
+
+            for segment in self._segments:
+                try:
+                    os.remove(segment)
+                except FileNotFoundError:
+                    pass
+            self._segments = []
+            self.flushes += 1
+            self.flushed_rows += written
+
+            # Los deltas siguen contando hasta que la caché deja de servir el saldo anterior
+            user_ids = list(self._inflight_delta)
+            try:
+                for user_id in user_ids:
+                    mark_recent_write(user_id)
+                await cache_manager.invalidate("users", user_ids)
+            finally:
+                self._inflight_delta = {}
+        return written
+
+    async def _write(self, batch: List[LedgerEntry]) -> int:
+        """Libro multi-fila y UPDATE agregado por usuario en una transacción"""
+        async with transaction() as uow:
+            balances = await lock_balances(uow, sorted({entry.user_id for entry in batch}))
+            outcomes = await apply_entries(uow, batch, balances)
+        for entry, outcome in zip(batch, outcomes):
+            if outcome is None:
+                logger.warning(f"Libro diferido: usuario {entry.user_id} no existe, se descarta la entrada")
+        return sum(outcome is not None for outcome in outcomes)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas del buffer"""
+        return {
+            "running": self.running,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+            "rejected": self.rejected,
+            "replayed": self.replayed,
+            "spool": bool(self.spool_dir)
+        }
+
+
+# Instancia global por worker; solo se arranca con LOYALTY_LEDGER_WRITE_BEHIND=1
+ledger_buffer = LedgerBuffer(
+    flush_interval_ms=settings.LEDGER_FLUSH_INTERVAL_MS,
+    max_rows=settings.LEDGER_FLUSH_MAX_ROWS,
+    max_pending=settings.LEDGER_MAX_PENDING,
+    spool_dir=settings.LEDGER_SPOOL_DIR
+)
@@ -2,30 +2,53 @@
 Motor de fidelización para el sistema Café-VT
 """
 
+import math
 import random
 import string
+import zlib
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterable, List, Mapping, Optional, Any, Sequence, Union
+
+import numpy as np
+
+from utils.tier_table import get_tier_table
+from .scoring_model import SCORE_COMPONENTS, ScoringModel, get_scoring_model
+
+# Bits del bitmap de productos distintos (columna BIGINT UNSIGNED product_sketch)
+PRODUCT_SKETCH_BITS = 64
+
+ArrayLike = Union[Sequence, np.ndarray]
+
+
+def product_sketch(products: Iterable[Any]) -> int:
+    """
+    Bitmap de productos: un bit por ``CRC32(producto) % 64``. Se acumula con
+    ``product_sketch = product_sketch | %s`` y coincide con ``CRC32()`` de MySQL,
+    así que la migración puede rellenarlo en SQL.
+    """
+    sketch = 0
+    for product in products or ():
+        sketch |= 1 << (zlib.crc32(str(product).encode()) % PRODUCT_SKETCH_BITS)
+    return sketch
+
+
+def estimate_distinct_products(sketch: int) -> int:
+    """Productos distintos estimados por conteo lineal sobre el bitmap"""
+    empty = PRODUCT_SKETCH_BITS - bin(sketch or 0).count("1")
+    if empty == 0:
+        return PRODUCT_SKETCH_BITS
+    return round(math.log(empty / PRODUCT_SKETCH_BITS) / math.log(1 - 1 / PRODUCT_SKETCH_BITS))
+
 
 class LoyaltyEngine:
     """Motor de scoring y gestión de fidelización"""
     
-    def __init__(self):
-        """Inicializar motor de fidelización"""
-        self.tier_thresholds = {
-            'cafe_bronze': 0,
-            'cafe_plata': 5000,
-            'cafe_oro': 25000,
-            'cafe_diamante': 75000
-        }
-        
-        self.tier_multipliers = {
-            'cafe_bronze': 1.0,
-            'cafe_plata': 1.2,
-            'cafe_oro': 1.5,
-            'cafe_diamante': 2.0
-        }
-        
+    def __init__(self, scoring_model: Optional[ScoringModel] = None):
+        """
+        Inicializar motor de fidelización. Sin `scoring_model` se usa el
+        modelo vigente (LoyaltyConfig o loyalty_config), que puede recargarse.
+        """
+        self._scoring_model = scoring_model
         self.tier_benefits = {
             'cafe_bronze': {
                 'discount_percent': 5,
@@ -49,44 +72,29 @@ class LoyaltyEngine:
             }
         }
     
+    @property
+    def scoring_model(self) -> ScoringModel:
+        """Modelo de scoring del motor"""
+        return self._scoring_model or get_scoring_model()
+    
+    @property
+    def tier_thresholds(self) -> Dict[str, int]:
+        """Umbrales de la tabla de niveles vigente"""
+        return get_tier_table().as_dict()
+    
+    @property
+    def tier_multipliers(self) -> Dict[str, float]:
+        """Multiplicadores de la tabla de niveles vigente"""
+        table = get_tier_table()
+        return dict(zip(table.names, table.multipliers))
+    
     def _get_tier_from_score(self, points: int) -> str:
         """Obtener nivel basado en puntos"""
-        if points >= self.tier_thresholds['cafe_diamante']:
-            return 'cafe_diamante'
-        elif points >= self.tier_thresholds['cafe_oro']:
-            return 'cafe_oro'
-        elif points >= self.tier_thresholds['cafe_plata']:
-            return 'cafe_plata'
-        else:
-            return 'cafe_bronze'
+        return get_tier_table().tier_for_points(points)
     
     def _get_next_tier_progress(self, current_tier: str, current_points: int) -> Dict[str, Any]:
         """Calcular progreso al siguiente nivel"""
-        tiers = list(self.tier_thresholds.keys())
-        current_index = tiers.index(current_tier)
-        
-        if current_index == len(tiers) - 1:  # Nivel máximo
-            return {
-                'current_tier': current_tier,
-                'current_points': current_points,
-                'next_tier': None,
-                'points_needed': 0,
-                'progress_percentage': 100.0
-            }
-        
-        next_tier = tiers[current_index + 1]
-        next_threshold = self.tier_thresholds[next_tier]
-        current_threshold = self.tier_thresholds[current_tier]
-        points_needed = next_threshold - current_points
-        progress = ((current_points - current_threshold) / (next_threshold - current_threshold)) * 100
-        
-        return {
-            'current_tier': current_tier,
-            'current_points': current_points,
-            'next_tier': next_tier,
-            'points_needed': points_needed,
-            'progress_percentage': min(progress, 100.0)
-        }
+        return get_tier_table().progress(current_tier, current_points)
     
     def _calculate_frequency_score(self, visits: int, days: int) -> float:
         """Calcular score por frecuencia de visitas"""
@@ -106,23 +114,13 @@ class LoyaltyEngine:
         score = min(total_spent / 100, 100)
         return round(score, 2)
     
-    def _calculate_recency_score(self, last_visit: Optional[datetime]) -> float:
+    def _calculate_recency_score(self, last_visit: Optional[datetime], now: Optional[datetime] = None) -> float:
         """Calcular score por recencia de visita"""
         if not last_visit:
             return 0
         
-        days_since_visit = (datetime.now() - last_visit).days
-        
-        if days_since_visit <= 1:
-            return 100
-        elif days_since_visit <= 7:
-            return 80
-        elif days_since_visit <= 30:
-            return 45
-        elif days_since_visit <= 90:
-            return 20
-        else:
-            return 0
+        days_since_visit = ((now or datetime.now()) - last_visit).total_seconds() / 86400
+        return round(self.scoring_model.recency(days_since_visit), 2)
     
     def _calculate_variety_score(self, products: List[str]) -> float:
         """Calcular score por variedad de productos"""
@@ -165,16 +163,82 @@ class LoyaltyEngine:
         )
         
         # Ponderación de scores
-        total_score = (
-            frequency_score * 0.3 +
-            amount_score * 0.3 +
-            recency_score * 0.2 +
-            variety_score * 0.1 +
-            referral_score * 0.1
+        total_score = self.scoring_model.combine(
+            (frequency_score, amount_score, recency_score, variety_score, referral_score)
         )
         
         return round(total_score, 2)
     
+    def score_from_state(self, state: Any, now: Optional[datetime] = None) -> Dict[str, float]:
+        """
+        Score a partir del estado acumulado de un usuario (fila, dict o LoyaltyUser).
+
+        Visitas, gasto, última visita, bitmap de productos y referidos se
+        mantienen en cada evento; aquí solo se evalúan los términos que
+        dependen de la fecha (frecuencia y recencia), sin consultas.
+        """
+        if isinstance(state, Mapping):
+            get = state.get
+        else:
+            get = lambda name: getattr(state, name, None)
+        now = now or datetime.now()
+        join_date = get('join_date')
+        
+        components = {
+            'frequency': self._calculate_frequency_score(
+                get('total_visits') or 0, (now - join_date).days if join_date else 0
+            ),
+            'amount': self._calculate_amount_score(float(get('total_spent') or 0)),
+            'recency': self._calculate_recency_score(get('last_visit'), now),
+            'variety': min(estimate_distinct_products(get('product_sketch')) * 10, 100),
+            'referral': self._calculate_referral_score(get('referral_count') or 0),
+        }
+        components['total'] = round(self.scoring_model.combine(
+            [components[name] for name in SCORE_COMPONENTS]
+        ), 2)
+        return components
+    
+    def score_batch(self, visits: ArrayLike, tenure_days: ArrayLike, spent: ArrayLike,
+                    last_visit: ArrayLike, distinct_products: ArrayLike, referrals: ArrayLike,
+                    now: Optional[datetime] = None) -> Dict[str, np.ndarray]:
+        """
+        Calcular los cinco componentes y el score total para muchos usuarios a la vez.
+
+        Recibe columnas alineadas (una posición por usuario): visitas, días de
+        antigüedad, monto gastado, última visita (datetime/None o
+        ``datetime64``), productos distintos y referidos. Aplica las mismas
+        reglas que los ``_calculate_*_score`` escalares. Devuelve un dict con
+        un array por componente y ``total``.
+        """
+        model = self.scoring_model
+        now = np.datetime64(now or datetime.now(), 's')
+        visits = np.asarray(visits, dtype=np.float64)
+        tenure_days = np.asarray(tenure_days, dtype=np.float64)
+        spent = np.asarray(spent, dtype=np.float64)
+        distinct_products = np.asarray(distinct_products, dtype=np.float64)
+        referrals = np.asarray(referrals, dtype=np.float64)
+        last_visit = np.asarray(last_visit, dtype='datetime64[s]')
+        
+        frequency = np.where(
+            visits > 0,
+            np.minimum(visits / np.maximum(tenure_days, 1) * 100, 100),
+            0.0
+        )
+        amount = np.where(spent > 0, np.minimum(spent / 100, 100), 0.0)
+        
+        # Días transcurridos (fraccionarios); NaT = sin visitas
+        has_visit = ~np.isnat(last_visit)
+        days_since = (now - np.where(has_visit, last_visit, now)).astype(np.int64) / 86400
+        recency = np.where(has_visit, model.recency_batch(days_since), 0.0)
+        
+        variety = np.minimum(distinct_products * 10, 100)
+        referral = np.minimum(referrals * 20, 100)
+        
+        components = np.round(np.vstack([frequency, amount, recency, variety, referral]), 2)
+        result = dict(zip(SCORE_COMPONENTS, components))
+        result['total'] = np.round(model.combine_batch(components), 2)
+        return result
+    
     async def _get_user_data(self, user_id: int) -> Dict[str, Any]:
         """Obtener datos del usuario (mock)"""
         return {
@@ -213,15 +277,12 @@ class LoyaltyEngine:
     
     def _apply_tier_multiplier(self, points: int, tier: str) -> int:
         """Aplicar multiplicador por nivel"""
-        multiplier = self.tier_multipliers.get(tier, 1.0)
-        return int(points * multiplier)
+        return int(points * get_tier_table().multiplier(tier))
     
     def _validate_tier_upgrade(self, old_tier: str, new_tier: str) -> bool:
         """Validar subida de nivel"""
-        tiers = list(self.tier_thresholds.keys())
-        old_index = tiers.index(old_tier)
-        new_index = tiers.index(new_tier)
-        return new_index == old_index + 1
+        table = get_tier_table()
+        return table.rank(new_tier) == table.rank(old_tier) + 1
     
     def _calculate_tier_benefits(self, tier: str) -> Dict[str, Any]:
         """Calcular beneficios por nivel"""
@@ -232,11 +293,7 @@ class LoyaltyEngine:
         if user_points < reward_cost:
             return False
         
-        tiers = list(self.tier_thresholds.keys())
-        user_index = tiers.index(user_tier)
-        reward_index = tiers.index(reward_tier)
-        
-        return user_index >= reward_index
+        return get_tier_table().can_access(user_tier, reward_tier)
     
     def _generate_transaction_description(self, trans_type: str, points: int, order_id: int = None, reward_name: str = None, reason: str = None) -> str:
         """Generar descripción de transacción"""
@@ -3,31 +3,284 @@ Servicio principal para el sistema de fidelización
 """
 
 import logging
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator, Callable, Sequence, Tuple
 from datetime import datetime, timedelta
+import hashlib
 import json
 import secrets
 import string
 import asyncio
+from decimal import Decimal
 
-from models.loyalty_models import LoyaltyUser, LoyaltyUserCreate, LoyaltyUserUpdate
+from models.loyalty_models import LoyaltyUser, LoyaltyUserCreate, LoyaltyUserUpdate, TierLevel
 from models.transaction_models import Transaction, TransactionCreate
 from models.reward_models import Reward, LoyaltyReward
-from utils.database import execute_query, execute_single_query, execute_insert, execute_update
-from config import settings
-from .loyalty_engine import LoyaltyEngine
+from utils.database import (
+    execute_query, execute_single_query, execute_single_row, execute_query_rows,
+    execute_insert, execute_update, execute_many, execute_procedure,
+    stream_query, transaction, mark_recent_write, UnitOfWork, PoolExhaustedError
+)
+from config import settings, loyalty_config
+from utils.cache import cache_manager, json_encode, MISSING
+from utils.tier_table import get_tier_table
+from utils.idempotency import idempotency_cache, order_request_key, request_key as make_request_key
+from utils.locks import VersionConflict, retry_on_conflict, user_locks
+from utils.pagination import InvalidCursorError, keyset_condition, keyset_params, next_cursor
+from utils.singleflight import single_flight
+from .loyalty_engine import LoyaltyEngine, estimate_distinct_products, product_sketch
+from .ledger_buffer import TRANSACTION_INSERT_QUERY, LedgerEntry, apply_entries, ledger_buffer, lock_balances
 from sqlalchemy import select
 from utils.database import get_db
 from sqlalchemy.ext.asyncio import AsyncSession
 
 logger = logging.getLogger(__name__)
 
+# Alta si no existe + saldo + nivel + libro en una transacción del servidor
+# (procedimiento definido en INFO/loyalty_performance.sql)
+EARN_POINTS_CALL = "CALL loyalty_earn_points(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+# Claves de idempotencia (índice único de loyalty_request_keys)
+REQUEST_KEY_CLAIM_QUERY = """
+    INSERT IGNORE INTO loyalty_request_keys (request_key, user_id, created_at)
+    VALUES (%s, %s, %s)
+"""
+REQUEST_KEY_RESPONSE_QUERY = "SELECT response FROM loyalty_request_keys WHERE request_key = %s"
+REQUEST_KEY_STORE_QUERY = "UPDATE loyalty_request_keys SET response = %s WHERE request_key = %s"
+REQUEST_KEY_RELEASE_QUERY = "DELETE FROM loyalty_request_keys WHERE request_key = %s"
+
+# Alta con bienvenida de los usuarios que faltan en un abono por lotes
+BATCH_USER_INSERT_QUERY = """
+    INSERT IGNORE INTO loyalty_users (
+        user_id, total_points, current_tier, score, join_date,
+        total_visits, total_spent, referral_code, points_expiry_date
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+COUPON_INSERT_QUERY = """
+    INSERT INTO loyalty_coupons (
+        user_id, code, discount_type, discount_value, min_order_amount,
+        max_uses, valid_from, valid_until, active, created_at
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# Resumen materializado del libro (tabla y trigger en INFO/loyalty_performance.sql)
+SUMMARY_COLUMNS = (
+    "total_earned", "total_redeemed", "total_bonus", "total_referrals",
+    "total_adjustments", "net_points", "redemption_count", "transaction_count",
+    "last_transaction_id"
+)
+SUMMARY_BY_USER_QUERY = f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM loyalty_user_summary WHERE user_id = %s"
+SUMMARY_AGGREGATE_QUERY = """
+    SELECT
+        user_id,
+        SUM(IF(transaction_type IN ('earn', 'purchase'), points_amount, 0)) AS total_earned,
+        SUM(IF(transaction_type IN ('redeem', 'redemption'), ABS(points_amount), 0)) AS total_redeemed,
+        SUM(IF(transaction_type = 'bonus', points_amount, 0)) AS total_bonus,
+        SUM(IF(transaction_type = 'referral', points_amount, 0)) AS total_referrals,
+        SUM(IF(transaction_type = 'adjustment', points_amount, 0)) AS total_adjustments,
+        SUM(points_amount) AS net_points,
+        SUM(transaction_type IN ('redeem', 'redemption')) AS redemption_count,
+        COUNT(*) AS transaction_count,
+        MAX(id) AS last_transaction_id
+    FROM loyalty_transactions
+    WHERE user_id BETWEEN %s AND %s
+    GROUP BY user_id
+"""
+SUMMARY_INSERT_QUERY = f"""
+    INSERT INTO loyalty_user_summary (user_id, {', '.join(SUMMARY_COLUMNS)})
+    VALUES (%s, {', '.join(['%s'] * len(SUMMARY_COLUMNS))})
+"""
+
+# Columnas de loyalty_users en el orden en que las lee la ruta rápida (tuplas);
+# todos los campos de LoyaltyUser, que model_construct no rellena desde la BD
+USER_COLUMNS = (
+    "user_id", "total_points", "current_tier", "join_date", "last_visit",
+    "total_visits", "total_spent", "referral_count", "product_sketch",
+    "created_at", "updated_at", "score", "favorite_products", "referral_code",
+    "referred_by", "points_expiry_date"
+)
+USER_SELECT_COLUMNS = ", ".join(USER_COLUMNS)
+USER_BY_ID_QUERY = f"SELECT {USER_SELECT_COLUMNS} FROM loyalty_users WHERE user_id = %s"
+# Modelo de lectura de /profile: usuario, nombre de la cuenta y canjes en un viaje
+PROFILE_QUERY = f"""
+    SELECT {', '.join('u.' + column for column in USER_COLUMNS)},
+           p.nombre, p.apellidos, COALESCE(s.redemption_count, 0)
+    FROM loyalty_users u
+    LEFT JOIN Usuario p ON p.usuario_ID = u.user_id
+    LEFT JOIN loyalty_user_summary s ON s.user_id = u.user_id
+    WHERE u.user_id = %s
+"""
+_TIER_BY_VALUE = {tier.value: tier for tier in TierLevel}
+
+
+def _encode_user(user: LoyaltyUser) -> bytes:
+    return user.model_dump_json().encode()
+
+
+def _decode_user(data: bytes) -> LoyaltyUser:
+    return LoyaltyUser.model_validate_json(data)
+
+
+def _encode_rewards(rewards: List[LoyaltyReward]) -> bytes:
+    return json.dumps([reward.model_dump(mode="json") for reward in rewards]).encode()
+
+
+def _decode_rewards(data: bytes) -> List[LoyaltyReward]:
+    return [LoyaltyReward.model_validate(item) for item in json.loads(data)]
+
+
+def _encode_catalog(catalog: Tuple[str, bytes]) -> bytes:
+    etag, body = catalog
+    return etag.encode() + b"\n" + body
+
+
+def _decode_catalog(data: bytes) -> Tuple[str, bytes]:
+    etag, body = data.split(b"\n", 1)
+    return etag.decode(), body
+
+
+def _user_from_row(row: tuple) -> LoyaltyUser:
+    """
+    Construir un LoyaltyUser desde una tupla en el orden de USER_COLUMNS.
+
+    Los datos vienen de columnas tipadas de la propia BD, así que se omite la
+    validación de Pydantic (``model_construct``); solo se convierten los
+    tipos que el driver no entrega como los declara el modelo.
+    """
+    (user_id, total_points, current_tier, join_date, last_visit,
+     total_visits, total_spent, referral_count, product_sketch,
+     created_at, updated_at, score, favorite_products, referral_code,
+     referred_by, points_expiry_date) = row
+    if type(total_spent) is Decimal:
+        total_spent = float(total_spent)
+    if type(score) is Decimal:
+        score = float(score)
+    return LoyaltyUser.model_construct(
+        user_id=user_id,
+        total_points=total_points,
+        current_tier=_TIER_BY_VALUE.get(current_tier, current_tier),
+        join_date=join_date,
+        last_visit=last_visit,
+        total_visits=total_visits,
+        total_spent=total_spent,
+        referral_count=referral_count,
+        product_sketch=product_sketch,
+        created_at=created_at,
+        updated_at=updated_at,
+        score=score,
+        favorite_products=favorite_products,
+        referral_code=referral_code,
+        referred_by=referred_by,
+        points_expiry_date=points_expiry_date
+    )
+
+
 class LoyaltyService:
     """Servicio para gestión de usuarios de fidelización"""
     
     def __init__(self):
         """Inicializar servicio"""
         self.engine = LoyaltyEngine()
+        # L1 propio por instancia; L2 e invalidaciones compartidos entre workers
+        self._user_cache = cache_manager.region(
+            "users", maxsize=loyalty_config.USER_CACHE_MAX_ENTRIES,
+            ttl=loyalty_config.USER_CACHE_TTL_SECONDS, encode=_encode_user, decode=_decode_user
+        )
+        self._rewards_cache = cache_manager.region(
+            "rewards", maxsize=16, ttl=loyalty_config.CACHE_TTL_SECONDS,
+            encode=_encode_rewards, decode=_decode_rewards
+        )
+        self._catalog_cache = cache_manager.region(
+            "rewards_catalog", maxsize=4, ttl=loyalty_config.CACHE_TTL_SECONDS,
+            encode=_encode_catalog, decode=_decode_catalog
+        )
+        self._config_cache = cache_manager.region(
+            "config", maxsize=128, ttl=loyalty_config.CACHE_TTL_SECONDS
+        )
+        self._stats_cache = cache_manager.region(
+            "stats", maxsize=32, ttl=loyalty_config.STATS_CACHE_TTL_SECONDS
+        )
+    
+    async def _user_written(self, user_id: int):
+        """Tras escribir un usuario: invalidar su caché en todos los workers y fijar sus lecturas al primario"""
+        mark_recent_write(user_id)
+        await self._user_cache.invalidate(user_id)
+        single_flight.forget(("get_user_by_id", user_id))
+        single_flight.forget(("get_user_profile", user_id))
+    
+    async def _replay_response(self, request_key: str,
+                               build: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+                               ) -> Optional[Dict[str, Any]]:
+        """
+        Respuesta original de una operación ya confirmada con `request_key`.
+        LRU y filtro de Bloom primero; la base de datos solo si el filtro no
+        descarta la clave. El LRU guarda lo mismo que loyalty_request_keys y
+        `build` lo convierte en la respuesta de cada ruta (las acumulaciones
+        guardan la fila de resultado de loyalty_earn_points).
+        None = ejecutar la operación (que reclama la clave).
+        """
+        response = idempotency_cache.get(request_key)
+        if response is MISSING:
+            if not idempotency_cache.maybe_seen(request_key):
+                return None
+            row = await execute_single_query(REQUEST_KEY_RESPONSE_QUERY, (request_key,), use_primary=True)
+            if not row or row['response'] is None:
+                return None
+            response = json.loads(row['response'])
+            idempotency_cache.remember(request_key, response)
+        return build(response) if build else response
+    
+    async def _claim_request_key(self, uow: UnitOfWork, request_key: str, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Reclamar `request_key` dentro de la transacción, antes de bloquear al
+        usuario (el mismo orden que loyalty_earn_points). Si ya existía
+        devuelve la respuesta guardada; si la original sigue en curso, el
+        INSERT espera a su COMMIT. La respuesta se lee con bloqueo para ver
+        la última confirmada y no la instantánea de la transacción; una clave
+        sin respuesta lanza VersionConflict (reintentar más tarde).
+        """
+        if await uow.execute_update(REQUEST_KEY_CLAIM_QUERY, (request_key, user_id, datetime.now())):
+            return None
+        row = await uow.execute_single_query(REQUEST_KEY_RESPONSE_QUERY, (request_key,), for_update=True)
+        if not row or row['response'] is None:
+            raise VersionConflict(f"La operación {request_key} sigue en curso")
+        return json.loads(row['response'])
+    
+    async def _store_response(self, uow: UnitOfWork, request_key: str, response: Dict[str, Any]):
+        """Guardar la respuesta de la operación junto a su clave (misma transacción)"""
+        await uow.execute_update(REQUEST_KEY_STORE_QUERY, (json.dumps(response, default=str), request_key))
+
+    async def _release_request_key(self, uow: UnitOfWork, request_key: str):
+        """Soltar una clave reclamada en una transacción que confirma sin abonar nada"""
+        await uow.execute_update(REQUEST_KEY_RELEASE_QUERY, (request_key,))
+    
+    async def invalidate_rewards_cache(self):
+        """Invalidar el catálogo de recompensas (tras crear, editar o desactivar una)"""
+        await self._rewards_cache.clear()
+        await self._catalog_cache.clear()
+        single_flight.forget(("get_all_rewards",))
+        single_flight.forget(("get_rewards_catalog",))
+    
+    async def invalidate_config_cache(self):
+        """Invalidar la configuración cacheada (tras editar loyalty_config)"""
+        await self._config_cache.clear()
+    
+    @property
+    def tier_thresholds(self) -> Dict[str, int]:
+        """Umbrales de la tabla de niveles vigente"""
+        return get_tier_table().as_dict()
+    
+    def _get_tier_from_score(self, points: int) -> str:
+        """Nivel que corresponde a `points`"""
+        return get_tier_table().tier_for_points(points)
+    
+    def _get_next_tier_progress(self, current_tier: str, current_points: int) -> Dict[str, Any]:
+        """Progreso de `current_points` hacia el nivel siguiente"""
+        return get_tier_table().progress(current_tier, current_points)
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché de perfiles"""
+        return self._user_cache.stats()
     
     def _map_db_result_to_loyalty_user(self, db_result: dict) -> LoyaltyUser:
         """Mapear resultado de base de datos a objeto LoyaltyUser"""
@@ -44,17 +297,25 @@ class LoyaltyService:
             'favorite_products': db_result.get('favorite_products'),
             'referral_code': db_result.get('referral_code'),
             'referred_by': db_result.get('referred_by'),
+            'referral_count': db_result.get('referral_count', 0),
+            'product_sketch': db_result.get('product_sketch', 0),
             'points_expiry_date': db_result.get('points_expiry_date'),
             'created_at': db_result.get('created_at'),
             'updated_at': db_result.get('updated_at')
         }
         return LoyaltyUser(**mapped_data)
     
-    async def get_users(self, skip: int = 0, limit: int = 100, tier: Optional[str] = None, status: Optional[str] = None) -> List[LoyaltyUser]:
-        """Obtener lista de usuarios de fidelización"""
+    async def get_users(self, skip: int = 0, limit: int = 100, tier: Optional[str] = None, status: Optional[str] = None,
+                        cursor: Optional[str] = None) -> Tuple[List[LoyaltyUser], Optional[str]]:
+        """
+        Obtener lista de usuarios de fidelización, más recientes primero, y
+        el cursor de la página siguiente (None en la última). Con `cursor`
+        (ver utils.pagination) se ignora `skip` y la página cuesta lo mismo
+        a cualquier profundidad.
+        """
         try:
-            query = """
-                SELECT * FROM loyalty_users 
+            query = f"""
+                SELECT {USER_SELECT_COLUMNS} FROM loyalty_users 
                 WHERE 1=1
             """
             params = []
@@ -67,22 +328,74 @@ class LoyaltyService:
                 query += " AND status = %s"
                 params.append(status)
             
-            query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-            params.extend([limit, skip])
+            if cursor:
+                query += f" AND {keyset_condition('user_id')}"
+                params.extend(keyset_params(cursor))
             
-            results = await execute_query(query, tuple(params))
-            return [self._map_db_result_to_loyalty_user(result) for result in results]
+            query += " ORDER BY created_at DESC, user_id DESC LIMIT %s"
+            params.append(limit)
+            if not cursor:
+                query += " OFFSET %s"
+                params.append(skip)
+            
+            rows = await execute_query_rows(query, tuple(params))
+            users = [_user_from_row(row) for row in rows]
+            return users, next_cursor(users, limit, key=lambda user: (user.created_at, user.user_id))
             
         except Exception as e:
             logger.error(f"Error al obtener usuarios: {e}")
             raise
     
-    async def get_user_by_id(self, user_id: int) -> Optional[LoyaltyUser]:
-        """Obtener un usuario por ID"""
-        query = "SELECT * FROM loyalty_users WHERE user_id = %s"
-        user_data = await execute_single_query(query, (user_id,))
-        if user_data:
-            return self._map_db_result_to_loyalty_user(user_data)
+    async def iter_users(self, tier: Optional[str] = None, status: Optional[str] = None,
+                         chunk_size: Optional[int] = None) -> AsyncIterator[LoyaltyUser]:
+        """
+        Recorrer todos los usuarios de fidelización en memoria constante
+        (exportaciones, procesos batch). Usa un cursor de servidor sin búfer.
+        """
+        query = "SELECT * FROM loyalty_users WHERE 1=1"
+        params = []
+        
+        if tier:
+            query += " AND current_tier = %s"
+            params.append(tier)
+        
+        if status:
+            query += " AND status = %s"
+            params.append(status)
+        
+        query += " ORDER BY user_id"
+        
+        async for rows in stream_query(query, tuple(params), chunk_size=chunk_size or settings.DB_STREAM_FETCH_SIZE):
+            for row in rows:
+                yield self._map_db_result_to_loyalty_user(row)
+    
+    async def get_user_by_id(self, user_id: int, use_primary: bool = False) -> Optional[LoyaltyUser]:
+        """
+        Obtener un usuario por ID. Sirve desde la caché (L1 del worker o L2
+        compartido) si la entrada está vigente; si no, lee del primario y la
+        rellena. `use_primary` (obligatorio antes de escribir un valor
+        derivado) omite la caché.
+
+        La caché solo se rellena desde el primario: una fila de la réplica
+        puede ser anterior a una escritura de otro worker y, guardada en L2,
+        se serviría en todos los workers durante todo el TTL.
+        """
+        if not use_primary:
+            cached = await self._user_cache.get(user_id)
+            if cached is not MISSING:
+                return cached
+            # Fallos de caché concurrentes del mismo usuario comparten una lectura
+            return await single_flight.do(("get_user_by_id", user_id), lambda: self._load_user(user_id))
+        return await self._load_user(user_id)
+    
+    async def _load_user(self, user_id: int) -> Optional[LoyaltyUser]:
+        # Si el usuario se escribe mientras se lee, la fila leída no se cachea
+        generation = await self._user_cache.generation(user_id)
+        row = await execute_single_row(USER_BY_ID_QUERY, (user_id,), use_primary=True)
+        if row:
+            user = _user_from_row(row)
+            await self._user_cache.set(user_id, user, generation=generation)
+            return user
         return None
     
     async def get_user_details(self, user_id: int) -> dict:
@@ -100,15 +413,41 @@ class LoyaltyService:
             logger.error(f"Error al obtener detalles del usuario {user_id}: {e}")
             return {}
     
+    async def get_user_profile(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Usuario, nombre de la cuenta y número de canjes para /profile, o None
+        si el usuario no está en el programa.
+
+        Con PROFILE_SINGLE_QUERY es una sola consulta (JOIN con Usuario y
+        loyalty_user_summary); si no, las tres lecturas van en paralelo.
+        Peticiones concurrentes del mismo perfil comparten la lectura.
+        """
+        return await single_flight.do(("get_user_profile", user_id), lambda: self._load_user_profile(user_id))
+    
+    async def _load_user_profile(self, user_id: int) -> Optional[Dict[str, Any]]:
+        if not settings.PROFILE_SINGLE_QUERY:
+            user, details, summary = await asyncio.gather(
+                self.get_user_by_id(user_id),
+                self.get_user_details(user_id),
+                self.get_transaction_summary(user_id)
+            )
+            if not user:
+                return None
+            return {"user": user, "name": details.get("name"), "rewards_redeemed": summary["redemption_count"]}
+        
+        # Lectura de la réplica: no rellena la caché de usuarios (ver get_user_by_id)
+        row = await execute_single_row(PROFILE_QUERY, (user_id,), sticky_key=user_id)
+        if not row:
+            return None
+        user = _user_from_row(row[:len(USER_COLUMNS)])
+        nombre, apellidos, redemption_count = row[len(USER_COLUMNS):]
+        name = f"{nombre or ''} {apellidos or ''}".strip() if nombre is not None else None
+        return {"user": user, "name": name, "rewards_redeemed": int(redemption_count)}
+    
     async def get_user_by_usuario_id(self, usuario_id: int) -> Optional[LoyaltyUser]:
         """Obtener un usuario por usuario_ID"""
         try:
-            query = "SELECT * FROM loyalty_users WHERE user_id = %s"
-            result = await execute_single_query(query, (usuario_id,))
-            
-            if result:
-                return self._map_db_result_to_loyalty_user(result)
-            return None
+            return await self.get_user_by_id(usuario_id)
             
         except Exception as e:
             logger.error(f"Error al obtener usuario por usuario_ID {usuario_id}: {e}")
@@ -118,49 +457,14 @@ class LoyaltyService:
         """Crear un nuevo usuario de fidelización"""
         try:
             # Verificar si el usuario ya existe
-            existing_user = await self.get_user_by_usuario_id(user_data.user_id)
+            existing_user = await self.get_user_by_id(user_data.user_id, use_primary=True)
             if existing_user:
                 raise ValueError("El usuario ya está registrado en el programa de fidelización")
             
-            # Generar código de referido único
-            referral_code = self._generate_referral_code()
-            
-            # Obtener puntos de bienvenida
-            welcome_points = await self._get_config_value('welcome_points', 200)
-            
-            # Calcular fecha de expiración de puntos
-            expiry_days = await self._get_config_value('points_expiry_days', 365)
-            points_expiry_date = datetime.now() + timedelta(days=expiry_days)
-            
-            query = """
-                INSERT INTO loyalty_users (
-                    user_id, total_points, current_tier, score,
-                    join_date, total_visits, total_spent, favorite_products,
-                    referral_code, referred_by, points_expiry_date
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            
-            params = (
-                user_data.user_id,
-                welcome_points,
-                'cafe_bronze',
-                0.0,
-                datetime.now(),
-                0,
-                0.0,
-                None,  # favorite_products no está en el modelo básico
-                referral_code,
-                None,  # referred_by no está en el modelo básico
-                points_expiry_date
-            )
-            
-            user_id = await execute_insert(query, params)
-            
-            # Registrar transacción de puntos de bienvenida
-            await self._record_transaction(
-                user_data.user_id, 'bonus', welcome_points, None, None,
-                f"Puntos de bienvenida al programa de fidelización", 0, welcome_points
-            )
+            # Alta del usuario y puntos de bienvenida en una sola transacción
+            async with transaction() as uow:
+                await self._insert_new_user(uow, user_data.user_id)
+            await self._user_written(user_data.user_id)
             
             return await self.get_user_by_id(user_data.user_id)
             
@@ -168,11 +472,59 @@ class LoyaltyService:
             logger.error(f"Error al crear usuario: {e}")
             raise
     
+    async def _insert_new_user(self, uow: UnitOfWork, user_id: int) -> int:
+        """
+        Insertar un usuario nuevo y su transacción de bienvenida dentro de `uow`.
+        Devuelve los puntos de bienvenida otorgados.
+        """
+        # Generar código de referido único
+        referral_code = self._generate_referral_code()
+        
+        # Obtener puntos de bienvenida
+        welcome_points = await self._get_config_value('welcome_points', 200, uow=uow)
+        
+        # Calcular fecha de expiración de puntos
+        expiry_days = await self._get_config_value('points_expiry_days', 365, uow=uow)
+        points_expiry_date = datetime.now() + timedelta(days=expiry_days)
+        
+        query = """
+            INSERT INTO loyalty_users (
+                user_id, total_points, current_tier, score,
+                join_date, total_visits, total_spent, favorite_products,
+                referral_code, referred_by, points_expiry_date
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        
+        params = (
+            user_id,
+            welcome_points,
+            'cafe_bronze',
+            0.0,
+            datetime.now(),
+            0,
+            0.0,
+            None,  # favorite_products no está en el modelo básico
+            referral_code,
+            None,  # referred_by no está en el modelo básico
+            points_expiry_date
+        )
+        
+        await uow.execute_insert(query, params)
+        
+        # Registrar transacción de puntos de bienvenida
+        await self._record_transaction(
+            user_id, 'bonus', welcome_points, None, None,
+            f"Puntos de bienvenida al programa de fidelización", 0, welcome_points,
+            uow=uow
+        )
+        
+        return welcome_points
+    
     async def update_user(self, user_id: int, user_data: LoyaltyUserUpdate) -> Optional[LoyaltyUser]:
         """Actualizar un usuario de fidelización"""
         try:
             # Verificar si el usuario existe
-            existing_user = await self.get_user_by_id(user_id)
+            existing_user = await self.get_user_by_id(user_id, use_primary=True)
             if not existing_user:
                 return None
             
@@ -209,6 +561,7 @@ class LoyaltyService:
             
             query = f"UPDATE loyalty_users SET {', '.join(update_fields)} WHERE user_id = %s"
             await execute_update(query, tuple(params))
+            await self._user_written(user_id)
             
             return await self.get_user_by_id(user_id)
             
@@ -221,147 +574,253 @@ class LoyaltyService:
         try:
             query = "DELETE FROM loyalty_users WHERE user_id = %s"
             affected_rows = await execute_update(query, (user_id,))
+            await self._user_written(user_id)
             return affected_rows > 0
             
         except Exception as e:
             logger.error(f"Error al eliminar usuario {user_id}: {e}")
             raise
     
-    async def redeem_reward(self, user_id: int, reward_id: int) -> dict:
+    async def redeem_reward(self, user_id: int, reward_id: int, idempotency_key: Optional[str] = None) -> dict:
         """
         Canjea una recompensa para un usuario.
         Verifica si el usuario y la recompensa existen, y si el usuario tiene puntos suficientes.
+        Con `idempotency_key` un reintento devuelve la respuesta del canje original.
+
+        Los canjes del mismo usuario se serializan en este worker (lock por
+        usuario) y el saldo se escribe con un UPDATE condicional por
+        ``balance_version``; si otro worker lo cambió entre medias, se repite.
         """
-        # Obtener usuario y recompensa en paralelo
+        request_key = make_request_key("redeem", user_id, idempotency_key) if idempotency_key else None
+        
+        if request_key:
+            replay = await self._replay_response(request_key)
+            if replay is not None:
+                return replay
+        
+        async with user_locks(user_id):
+            result, written = await retry_on_conflict(
+                lambda: self._redeem_once(user_id, reward_id, request_key),
+                settings.BALANCE_CAS_MAX_RETRIES, settings.BALANCE_CAS_RETRY_DELAY
+            )
+        if written:
+            await self._user_written(user_id)
+        if request_key:
+            idempotency_cache.remember(request_key, result)
+
+        return result
+    
+    async def _redeem_once(self, user_id: int, reward_id: int,
+                           request_key: Optional[str]) -> Tuple[Dict[str, Any], bool]:
+        """Un intento de canje. Devuelve (respuesta, si escribió); VersionConflict si el saldo cambió."""
         user_query = "SELECT * FROM loyalty_users WHERE user_id = %s"
         reward_query = "SELECT * FROM loyalty_rewards WHERE id = %s AND active = 1"
         
-        user_data, reward_data = await asyncio.gather(
-            execute_single_query(user_query, (user_id,)),
-            execute_single_query(reward_query, (reward_id,))
-        )
-
-        if not user_data:
-            raise ValueError("El usuario de fidelización no existe.")
-        if not reward_data:
-            raise ValueError("La recompensa no existe o no está activa.")
+        async with transaction() as uow:
+            # La clave antes que el usuario, y antes de cualquier lectura que fije la instantánea
+            if request_key:
+                replay = await self._claim_request_key(uow, request_key, user_id)
+                if replay is not None:
+                    return replay, False
+            
+            user_data = await uow.execute_single_query(user_query, (user_id,))
+            if not user_data:
+                raise ValueError("El usuario de fidelización no existe.")
+            
+            reward_data = await uow.execute_single_query(reward_query, (reward_id,))
+            if not reward_data:
+                raise ValueError("La recompensa no existe o no está activa.")
 
-        user = LoyaltyUser(**user_data)
-        reward = LoyaltyReward(**reward_data)
+            user = LoyaltyUser(**user_data)
+            reward = LoyaltyReward(**reward_data)
 
-        # Validar canje usando el motor de fidelización
-        if not self.engine._validate_reward_redemption(user.total_points, reward.points_cost, user.current_tier, reward.tier_required):
-            raise ValueError("No cumples con los requisitos para canjear esta recompensa (puntos o nivel insuficiente).")
+            # Validar canje usando el motor de fidelización
+            if not self.engine._validate_reward_redemption(user.total_points, reward.points_cost, user.current_tier, reward.tier_required):
+                raise ValueError("No cumples con los requisitos para canjear esta recompensa (puntos o nivel insuficiente).")
 
-        # Restar puntos
-        new_total_points = user.total_points - reward.points_cost
-        
-        # Actualizar puntos del usuario
-        update_query = "UPDATE loyalty_users SET total_points = %s, updated_at = %s WHERE user_id = %s"
-        await execute_update(update_query, (new_total_points, datetime.now(), user_id))
-        
-        # Registrar la transacción de canje
-        await self._record_transaction(
-            user_id,
-            'redeem',
-            -reward.points_cost,
-            None, # order_id no aplica aquí
-            reward.id,
-            f"Canje de recompensa: {reward.name}",
-            user.total_points,
-            new_total_points
-        )
-
-        # Registrar el canje en la tabla `loyalty_redemptions`
-        redemption_query = """
-            INSERT INTO loyalty_redemptions (user_id, reward_id, points_spent, redeemed_at)
-            VALUES (%s, %s, %s, %s)
-        """
-        await execute_insert(redemption_query, (user_id, reward_id, reward.points_cost, datetime.now()))
+            # Restar puntos
+            new_total_points = user.total_points - reward.points_cost
+            
+            # Actualizar puntos solo si nadie los cambió desde la lectura
+            update_query = """
+                UPDATE loyalty_users
+                SET total_points = %s, balance_version = balance_version + 1,
+                    last_visit = %s, updated_at = %s
+                WHERE user_id = %s AND balance_version = %s
+            """
+            now = datetime.now()
+            if not await uow.execute_update(update_query, (
+                new_total_points, now, now, user_id, user_data['balance_version']
+            )):
+                raise VersionConflict(f"El saldo del usuario {user_id} cambió durante el canje")
+            
+            # Registrar la transacción de canje
+            await self._record_transaction(
+                user_id,
+                'redeem',
+                -reward.points_cost,
+                None, # order_id no aplica aquí
+                reward.id,
+                f"Canje de recompensa: {reward.name}",
+                user.total_points,
+                new_total_points,
+                uow=uow
+            )
 
-        return {
-            "success": True, 
-            "message": "Recompensa canjeada con éxito.",
-            "new_total_points": new_total_points
-        }
+            # Registrar el canje en la tabla `loyalty_redemptions`
+            redemption_query = """
+                INSERT INTO loyalty_redemptions (user_id, reward_id, points_spent, redeemed_at)
+                VALUES (%s, %s, %s, %s)
+            """
+            await uow.execute_insert(redemption_query, (user_id, reward_id, reward.points_cost, now))
+            
+            result = {
+                "success": True, 
+                "message": "Recompensa canjeada con éxito.",
+                "new_total_points": new_total_points
+            }
+            if request_key:
+                await self._store_response(uow, request_key, result)
+        return result, True
     
     async def calculate_user_score(self, user_id: int) -> float:
         """
-        Calcula el score de fidelización de un usuario basado en varios factores.
-        Esta función ahora delega la lógica al LoyaltyEngine.
+        Calcula el score de fidelización de un usuario a partir de su estado
+        acumulado. Los contadores se actualizan en cada compra, canje y
+        referido, así que basta la fila del usuario (normalmente en caché).
         """
         try:
-            # La lógica de cálculo de score ahora reside en el LoyaltyEngine
-            user_data = await self._get_user_data(user_id) # Se obtienen los datos reales
-            
-            frequency_score = self.engine._calculate_frequency_score(
-                user_data.get('total_visits', 0), 
-                (datetime.now() - user_data.get('join_date', datetime.now())).days
-            )
-            
-            amount_score = self.engine._calculate_amount_score(
-                user_data.get('total_spent', 0)
-            )
-            
-            recency_score = self.engine._calculate_recency_score(
-                user_data.get('last_visit')
-            )
-            
-            variety_score = self.engine._calculate_variety_score(
-                json.loads(user_data.get('favorite_products', '[]'))
-            )
-            
-            referral_score = self.engine._calculate_referral_score(
-                user_data.get('referral_count', 0)
-            )
-            
-            # Ponderación de scores definida en el engine
-            total_score = (
-                frequency_score * 0.3 +
-                amount_score * 0.3 +
-                recency_score * 0.2 +
-                variety_score * 0.1 +
-                referral_score * 0.1
-            )
-            
-            return round(total_score, 2)
+            user_data = await self._get_user_data(user_id)
+            if not user_data:
+                return 0.0
+            return self.engine.score_from_state(user_data)['total']
         except Exception as e:
             logger.error(f"Error al calcular score para el usuario {user_id}: {e}")
             return 0.0
     
+    def score_user(self, user: LoyaltyUser, now: Optional[datetime] = None) -> float:
+        """Score de un usuario ya cargado, sin consultas"""
+        return self.engine.score_from_state(user, now)['total']
+    
+    async def update_scores_bulk(self, scores: Sequence[Tuple[int, float]]) -> int:
+        """
+        Escribir muchos scores en una sola sentencia ``UPDATE ... CASE``.
+        A diferencia de un upsert, nunca crea filas para usuarios borrados.
+        """
+        if not scores:
+            return 0
+        
+        cases = " ".join(["WHEN %s THEN %s"] * len(scores))
+        placeholders = ", ".join(["%s"] * len(scores))
+        query = (
+            f"UPDATE loyalty_users SET score = CASE user_id {cases} END "
+            f"WHERE user_id IN ({placeholders})"
+        )
+        params = [value for pair in scores for value in pair]
+        params.extend(user_id for user_id, _ in scores)
+        return await execute_update(query, tuple(params))
+    
+    async def rescore_all_users(self, chunk_size: Optional[int] = None, now: Optional[datetime] = None) -> int:
+        """
+        Recalcular el score de todos los usuarios (proceso nocturno).
+
+        Recorre loyalty_users con un cursor sin búfer en bloques de
+        `chunk_size`, calcula cada bloque con ``LoyaltyEngine.score_batch`` y
+        lo escribe con un único UPDATE. Referidos y productos salen de los
+        contadores de la propia fila. Devuelve el número de usuarios procesados.
+        """
+        now = now or datetime.now()
+        chunk_size = chunk_size or settings.DB_BULK_CHUNK_SIZE
+        
+        users_query = """
+            SELECT user_id, total_visits, join_date, total_spent, last_visit,
+                   referral_count, product_sketch
+            FROM loyalty_users
+            ORDER BY user_id
+        """
+        processed = 0
+        async for rows in stream_query(users_query, chunk_size=chunk_size):
+            scores = self.engine.score_batch(
+                visits=[row['total_visits'] or 0 for row in rows],
+                tenure_days=[(now - row['join_date']).days if row['join_date'] else 0 for row in rows],
+                spent=[row['total_spent'] or 0 for row in rows],
+                last_visit=[row['last_visit'] for row in rows],
+                distinct_products=[estimate_distinct_products(row['product_sketch']) for row in rows],
+                referrals=[row['referral_count'] or 0 for row in rows],
+                now=now
+            )
+            await self.update_scores_bulk(list(zip(
+                (row['user_id'] for row in rows), scores['total'].tolist()
+            )))
+            processed += len(rows)
+            logger.info(f"Scores recalculados: {processed} usuarios")
+        
+        return processed
+    
     async def adjust_points(self, user_id: int, points: int, reason: str) -> Dict[str, Any]:
-        """Ajustar puntos de un usuario (para administradores)"""
+        """
+        Ajustar puntos de un usuario (para administradores).
+        Misma escritura que los canjes: lock por usuario y UPDATE condicional por versión.
+        """
         try:
-            user = await self.get_user_by_id(user_id)
+            async with user_locks(user_id):
+                result = await retry_on_conflict(
+                    lambda: self._adjust_points_once(user_id, points, reason),
+                    settings.BALANCE_CAS_MAX_RETRIES, settings.BALANCE_CAS_RETRY_DELAY
+                )
+            await self._user_written(user_id)
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error al ajustar puntos: {e}")
+            raise
+    
+    async def _adjust_points_once(self, user_id: int, points: int, reason: str) -> Dict[str, Any]:
+        """Un intento de ajuste; VersionConflict si el saldo cambió"""
+        async with transaction() as uow:
+            user = await uow.execute_single_query(
+                "SELECT total_points, balance_version FROM loyalty_users WHERE user_id = %s", (user_id,)
+            )
             if not user:
                 raise ValueError("Usuario no encontrado")
             
-            new_points = user.total_points + points
+            previous_points = user['total_points']
+            new_points = previous_points + points
             if new_points < 0:
                 raise ValueError("Los puntos no pueden ser negativos")
             
-            await self.update_user(user_id, LoyaltyUserUpdate(total_points=new_points))
+            update_query = """
+                UPDATE loyalty_users
+                SET total_points = %s, balance_version = balance_version + 1, updated_at = %s
+                WHERE user_id = %s AND balance_version = %s
+            """
+            if not await uow.execute_update(update_query, (
+                new_points, datetime.now(), user_id, user['balance_version']
+            )):
+                raise VersionConflict(f"El saldo del usuario {user_id} cambió durante el ajuste")
             
             # Registrar transacción
             await self._record_transaction(
                 user_id, 'adjustment', points, None, None,
-                f"Ajuste manual: {reason}", user.total_points, new_points
+                f"Ajuste manual: {reason}", previous_points, new_points,
+                uow=uow
             )
-            
-            return {
-                "success": True,
-                "message": f"Puntos ajustados: {points:+d}",
-                "previous_points": user.total_points,
-                "new_points": new_points,
-                "reason": reason
-            }
-            
-        except Exception as e:
-            logger.error(f"Error al ajustar puntos: {e}")
-            raise
+        
+        return {
+            "success": True,
+            "message": f"Puntos ajustados: {points:+d}",
+            "previous_points": previous_points,
+            "new_points": new_points,
+            "reason": reason
+        }
     
     async def get_system_stats(self) -> Dict[str, Any]:
-        """Obtener estadísticas generales del sistema"""
+        """Obtener estadísticas generales del sistema (cacheadas STATS_CACHE_TTL_SECONDS)"""
+        return await single_flight.do(
+            ("get_system_stats",), lambda: self._stats_cache.get_or_load("system", self._load_system_stats)
+        )
+    
+    async def _load_system_stats(self) -> Dict[str, Any]:
         try:
             # Total de usuarios
             total_users_query = "SELECT COUNT(*) as total FROM loyalty_users WHERE status = 'activo'"
@@ -405,7 +864,10 @@ class LoyaltyService:
             raise
     
     async def get_tier_stats(self) -> List[Dict[str, Any]]:
-        """Obtener estadísticas por nivel"""
+        """Obtener estadísticas por nivel (cacheadas STATS_CACHE_TTL_SECONDS)"""
+        return await self._stats_cache.get_or_load("tiers", self._load_tier_stats)
+    
+    async def _load_tier_stats(self) -> List[Dict[str, Any]]:
         try:
             query = """
                 SELECT 
@@ -442,33 +904,63 @@ class LoyaltyService:
         """Generar código de cupón único"""
         return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(10))
     
-    async def _get_config_value(self, key: str, default_value: Any) -> Any:
-        """Obtener valor de configuración"""
+    async def _get_config_value(self, key: str, default_value: Any, uow: Optional[UnitOfWork] = None) -> Any:
+        """Obtener valor de configuración (cacheado; None en caché = clave ausente)"""
         try:
-            query = "SELECT config_value FROM loyalty_config WHERE config_key = %s"
-            result = await execute_single_query(query, (key,))
-            return result['config_value'] if result else default_value
+            value = await self._config_cache.get(key)
+            if value is MISSING:
+                query = "SELECT config_value FROM loyalty_config WHERE config_key = %s"
+                if uow:
+                    result = await uow.execute_single_query(query, (key,))
+                else:
+                    result = await execute_single_query(query, (key,))
+                value = result['config_value'] if result else None
+                await self._config_cache.set(key, value)
+            return value if value is not None else default_value
         except Exception as e:
             logger.error(f"Error al obtener valor de configuración para {key}: {e}")
             return default_value
     
     async def _record_transaction(self, user_id: int, transaction_type: str, points_amount: int, 
                                 order_id: Optional[int], reward_id: Optional[int], 
-                                description: str, balance_before: int, balance_after: int):
-        """Registrar una transacción"""
-        query = """
-            INSERT INTO loyalty_transactions (
-                user_id, transaction_type, points_amount, order_id,
-                description, balance_before, balance_after, created_at
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        
+                                description: str, balance_before: int, balance_after: int,
+                                uow: Optional[UnitOfWork] = None):
+        """Registrar una transacción (dentro de `uow` si se proporciona)"""
         params = (
             user_id, transaction_type, points_amount, order_id,
             description, balance_before, balance_after, datetime.now()
         )
         
-        await execute_insert(query, params)
+        if uow:
+            await uow.execute_insert(TRANSACTION_INSERT_QUERY, params)
+        else:
+            await execute_insert(TRANSACTION_INSERT_QUERY, params)
+    
+    async def record_transactions_bulk(self, transactions: List[Dict[str, Any]],
+                                       uow: Optional[UnitOfWork] = None) -> int:
+        """
+        Registrar muchas transacciones con INSERT multi-fila (p.ej. importación
+        diaria de compras del POS). Devuelve el número de filas insertadas.
+        """
+        now = datetime.now()
+        rows = [
+            (
+                t['user_id'], t['transaction_type'], t['points_amount'], t.get('order_id'),
+                t.get('description', ''), t['balance_before'], t['balance_after'],
+                t.get('created_at') or now
+            )
+            for t in transactions
+        ]
+        if not rows:
+            return 0
+        
+        try:
+            if uow:
+                return await uow.execute_many(TRANSACTION_INSERT_QUERY, rows)
+            return await execute_many(TRANSACTION_INSERT_QUERY, rows)
+        except Exception as e:
+            logger.error(f"Error al registrar {len(rows)} transacciones en bloque: {e}")
+            raise
     
     async def _process_referral(self, referral_code: str, new_user_id: int):
         """Procesar un código de referido y otorgar puntos."""
@@ -481,98 +973,141 @@ class LoyaltyService:
                 referrer_id = referrer_result['user_id']
                 bonus_points = await self._get_config_value('referral_bonus_points', 500)
                 
-                # Dar puntos bonus al referidor
-                referrer = await self.get_user_by_id(referrer_id)
-                new_points = referrer.total_points + bonus_points
-                await self.update_user(referrer_id, LoyaltyUserUpdate(total_points=new_points))
-                
-                # Registrar transacción
-                await self._record_transaction(
-                    referrer_id, 'referral', bonus_points, None, None,
-                    f"Puntos por referido exitoso", referrer.total_points, new_points
-                )
-                
-                # Registrar en tabla de referidos
-                referral_query = """
-                    INSERT INTO loyalty_referrals (
-                        referrer_user_ID, referred_user_ID, referral_code, status, bonus_points_given
-                    ) VALUES (%s, %s, %s, %s, %s)
+                # Dar puntos bonus al referidor y sumar el referido a su score
+                update_query = """
+                    UPDATE loyalty_users
+                    SET total_points = total_points + %s, referral_count = referral_count + 1,
+                        updated_at = %s
+                    WHERE user_id = %s
                 """
-                await execute_insert(referral_query, (referrer_id, new_user_id, referral_code, 'completed', True))
+                async with transaction() as uow:
+                    row = await uow.execute_single_query(
+                        "SELECT total_points FROM loyalty_users WHERE user_id = %s", (referrer_id,), for_update=True
+                    )
+                    balance_before = row['total_points'] or 0
+                    await uow.execute_update(update_query, (bonus_points, datetime.now(), referrer_id))
+                    
+                    # Registrar transacción
+                    await self._record_transaction(
+                        referrer_id, 'referral', bonus_points, None, None,
+                        f"Puntos por referido exitoso", balance_before, balance_before + bonus_points,
+                        uow=uow
+                    )
+                    
+                    # Registrar en tabla de referidos
+                    referral_query = """
+                        INSERT INTO loyalty_referrals (
+                            referrer_user_ID, referred_user_ID, referral_code, status, bonus_points_given
+                        ) VALUES (%s, %s, %s, %s, %s)
+                    """
+                    await uow.execute_insert(referral_query, (referrer_id, new_user_id, referral_code, 'completed', True))
+                await self._user_written(referrer_id)
                 
         except Exception as e:
             logger.error(f"Error al procesar referido para el nuevo usuario {new_user_id}: {e}")
             # No relanzar la excepción para no afectar el registro del usuario principal
     
     async def _get_user_data(self, user_id: int) -> dict:
-        """Obtener datos consolidados de un usuario para el cálculo de score."""
+        """Estado acumulado de un usuario para el cálculo de score (una sola lectura, cacheada)."""
         try:
-            # Query para obtener datos de loyalty_users
-            loyalty_query = "SELECT * FROM loyalty_users WHERE user_id = %s"
-            loyalty_data = await execute_single_query(loyalty_query, (user_id,))
-            if not loyalty_data:
-                return {}
-
-            # Query para contar referidos (ejemplo)
-            referral_query = "SELECT COUNT(*) as referral_count FROM loyalty_users WHERE referred_by = %s"
-            referral_data = await execute_single_query(referral_query, (loyalty_data['referral_code'],))
-            
-            loyalty_data['referral_count'] = referral_data.get('referral_count', 0)
-            return loyalty_data
-
+            user = await self.get_user_by_id(user_id)
+            return user.model_dump() if user else {}
         except Exception as e:
             logger.error(f"Error al obtener datos del usuario {user_id} para score: {e}")
             return {}
 
-    async def earn_points_from_purchase(self, user_id: int, purchase_amount: float, order_id: int) -> Dict[str, Any]:
+    async def earn_points_from_purchase(self, user_id: int, purchase_amount: float, order_id: int,
+                                        products: Optional[Sequence[Any]] = None) -> Dict[str, Any]:
         """
         Otorga puntos a un usuario por una compra y verifica si sube de nivel.
+        `products` (ids o nombres de la compra) alimenta el bitmap de variedad.
+
+        Idempotente por `order_id`: saldo, nivel, libro y la clave del pedido
+        se confirman juntos, y repetir el pedido devuelve la respuesta original.
+        La clave es la misma que en earn_points y earn_points_batch: un pedido
+        ya abonado por cualquiera de ellas no se abona de nuevo.
         """
+        request_key = order_request_key(user_id, order_id)
         try:
-            user = await self.get_user_by_id(user_id)
-            if not user:
-                return {"status": "error", "message": "Usuario no encontrado"}
+            replay = await self._replay_response(request_key, build=self._purchase_result)
+            if replay is not None:
+                return replay
 
-            # Calcular puntos usando el motor
-            base_points = self.engine._calculate_points_from_purchase(purchase_amount)
-            final_points = self.engine._apply_tier_multiplier(base_points, user.current_tier)
+            user_query = "SELECT total_points, current_tier FROM loyalty_users WHERE user_id = %s"
+            async with transaction() as uow:
+                # La clave antes que el usuario, como loyalty_earn_points y earn_points_batch
+                replay = await self._claim_request_key(uow, request_key, user_id)
+                if replay is not None:
+                    idempotency_cache.remember(request_key, replay)
+                    return self._purchase_result(replay)
 
-            if final_points <= 0:
-                return {"status": "no_change", "message": "No se generaron puntos para esta compra."}
+                user = await uow.execute_single_query(user_query, (user_id,), for_update=True)
+                if not user:
+                    await self._release_request_key(uow, request_key)
+                    return {"status": "error", "message": "Usuario no encontrado"}
 
-            balance_before = user.total_points
-            balance_after = balance_before + final_points
+                # Calcular puntos usando el motor
+                current_tier = user['current_tier']
+                base_points = self.engine._calculate_points_from_purchase(purchase_amount)
+                final_points = self.engine._apply_tier_multiplier(base_points, current_tier)
 
-            # Actualizar puntos y estadísticas del usuario
-            update_query = """
-                UPDATE loyalty_users 
-                SET total_points = %s, total_visits = total_visits + 1, 
-                    total_spent = total_spent + %s, last_visit = %s, updated_at = %s
-                WHERE user_id = %s
-            """
-            await execute_update(update_query, (
-                balance_after, purchase_amount, datetime.now(), datetime.now(), user_id
-            ))
+                if final_points <= 0:
+                    await self._release_request_key(uow, request_key)
+                    return {"status": "no_change", "message": "No se generaron puntos para esta compra."}
 
-            # Registrar la transacción
-            await self._record_transaction(
-                user_id, 'earn', final_points, order_id, None,
-                f"Puntos ganados por compra #{order_id}", balance_before, balance_after
-            )
+                balance_before = user['total_points']
+                balance_after = balance_before + final_points
+                new_tier = self._resolve_tier_upgrade(current_tier, balance_after)
 
-            # Verificar si el usuario sube de nivel
-            tier_upgrade_status = await self.check_tier_upgrade(user_id)
+                # Actualizar puntos, nivel y estadísticas del usuario
+                update_query = """
+                    UPDATE loyalty_users 
+                    SET total_points = %s, current_tier = %s, total_visits = total_visits + 1, 
+                        total_spent = total_spent + %s, product_sketch = product_sketch | %s,
+                        last_visit = %s, updated_at = %s
+                    WHERE user_id = %s
+                """
+                now = datetime.now()
+                await uow.execute_update(update_query, (
+                    balance_after, new_tier or current_tier, purchase_amount, product_sketch(products),
+                    now, now, user_id
+                ))
 
-            return {
-                "status": "success",
-                "points_earned": final_points,
-                "new_total_points": balance_after,
-                "tier_status": tier_upgrade_status
-            }
+                # Registrar la transacción
+                await self._record_transaction(
+                    user_id, 'earn', final_points, order_id, None,
+                    f"Puntos ganados por compra #{order_id}", balance_before, balance_after,
+                    uow=uow
+                )
+
+                # Misma fila que guardan las demás rutas de acumulación
+                row = {
+                    "balance_before": balance_before, "new_balance": balance_after,
+                    "previous_tier": current_tier, "current_tier": new_tier or current_tier,
+                    "points": final_points
+                }
+                await self._store_response(uow, request_key, row)
+
+            await self._user_written(user_id)
+            idempotency_cache.remember(request_key, row)
+            return self._purchase_result(row)
         except Exception as e:
             logger.error(f"Error al otorgar puntos por compra al usuario {user_id}: {e}")
             return {"status": "error", "message": str(e)}
 
+    def _purchase_result(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        """Respuesta de earn_points_from_purchase a partir de la fila guardada del abono"""
+        previous_tier, current_tier = row['previous_tier'], row['current_tier']
+        return {
+            "status": "success",
+            "points_earned": int(row['points']),
+            "new_total_points": int(row['new_balance']),
+            "tier_status": (
+                self._tier_upgrade_status(previous_tier, current_tier) if current_tier != previous_tier
+                else {"status": "no_change", "current_tier": current_tier}
+            )
+        }
+
     async def get_reward_by_id(self, reward_id: int) -> Optional[Reward]:
         """Obtener una recompensa por ID"""
         try:
@@ -624,15 +1159,19 @@ class LoyaltyService:
                 ORDER BY created_at DESC 
                 LIMIT %s
             """
-            results = await execute_query(query, (user_id, limit))
+            results = await execute_query(query, (user_id, limit), sticky_key=user_id)
             return results
             
         except Exception as e:
             logger.error(f"Error al obtener transacciones del usuario {user_id}: {e}")
             return []
 
-    async def get_user_transactions(self, user_id: int, skip: int = 0, limit: int = 50) -> List[dict]:
-        """Obtener transacciones del usuario con paginación"""
+    async def get_user_transactions(self, user_id: int, skip: int = 0, limit: int = 50,
+                                    cursor: Optional[str] = None) -> List[dict]:
+        """
+        Obtener transacciones del usuario con paginación, más recientes primero.
+        Con `cursor` se pagina por clave sobre (created_at, id) en lugar de OFFSET.
+        """
         try:
             # Primero verificar que el usuario existe
             user = await self.get_user_by_usuario_id(user_id)
@@ -653,18 +1192,97 @@ class LoyaltyService:
                     created_at
                 FROM loyalty_transactions 
                 WHERE user_id = %s 
-                ORDER BY created_at DESC 
-                LIMIT %s OFFSET %s
             """
-            results = await execute_query(query, (user.user_id, limit, skip))
+            params = [user.user_id]
+            if cursor:
+                query += f" AND {keyset_condition('id')}"
+                params.extend(keyset_params(cursor))
+            query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+            params.append(limit)
+            if not cursor:
+                query += " OFFSET %s"
+                params.append(skip)
+            
+            results = await execute_query(query, tuple(params), sticky_key=user.user_id)
             return results
             
+        except (PoolExhaustedError, InvalidCursorError):
+            raise
         except Exception as e:
             logger.error(f"Error al obtener transacciones del usuario {user_id}: {e}")
             return []
 
+    async def iter_transactions(self, user_id: Optional[int] = None, since: Optional[datetime] = None,
+                                chunk_size: Optional[int] = None) -> AsyncIterator[dict]:
+        """
+        Recorrer el libro de transacciones en memoria constante, opcionalmente
+        filtrado por usuario y/o fecha mínima. Usa un cursor de servidor sin búfer.
+        """
+        query = """
+            SELECT 
+                id, user_id, transaction_type, points_amount, order_id,
+                description, balance_before, balance_after, created_at
+            FROM loyalty_transactions
+            WHERE 1=1
+        """
+        params = []
+        
+        if user_id is not None:
+            query += " AND user_id = %s"
+            params.append(user_id)
+        
+        if since is not None:
+            query += " AND created_at >= %s"
+            params.append(since)
+        
+        query += " ORDER BY id"
+        
+        async for rows in stream_query(query, tuple(params), chunk_size=chunk_size or settings.DB_STREAM_FETCH_SIZE):
+            for row in rows:
+                yield row
+
+    async def get_transaction_summary(self, user_id: int) -> Dict[str, Any]:
+        """
+        Totales del libro de un usuario leídos de loyalty_user_summary (una
+        lectura por clave primaria, sin recorrer su historial). Un usuario sin
+        transacciones devuelve todo a cero.
+        """
+        row = await execute_single_query(SUMMARY_BY_USER_QUERY, (user_id,), sticky_key=user_id)
+        if not row:
+            return {**dict.fromkeys(SUMMARY_COLUMNS, 0), "last_transaction_id": None}
+        return {column: row[column] for column in SUMMARY_COLUMNS}
+
+    async def rebuild_ledger_summaries(self, chunk_size: Optional[int] = None) -> int:
+        """
+        Recalcular loyalty_user_summary desde loyalty_transactions.
+
+        Recorre loyalty_users con un cursor sin búfer en bloques de
+        `chunk_size` y rehace cada rango de user_id en una transacción: el
+        DELETE del rango bloquea sus filas de resumen (y los huecos), así una
+        transacción del libro que llegue mientras tanto espera y suma sobre el
+        valor recalculado en lugar de perderse. Devuelve los usuarios procesados.
+        """
+        chunk_size = chunk_size or settings.DB_BULK_CHUNK_SIZE
+
+        processed = 0
+        async for rows in stream_query("SELECT user_id FROM loyalty_users ORDER BY user_id", chunk_size=chunk_size):
+            first_id, last_id = rows[0]['user_id'], rows[-1]['user_id']
+            async with transaction() as uow:
+                await uow.execute_delete(
+                    "DELETE FROM loyalty_user_summary WHERE user_id BETWEEN %s AND %s", (first_id, last_id)
+                )
+                totals = await uow.execute_query(SUMMARY_AGGREGATE_QUERY, (first_id, last_id))
+                await uow.execute_many(SUMMARY_INSERT_QUERY, [
+                    (row['user_id'], *(row[column] for column in SUMMARY_COLUMNS)) for row in totals
+                ])
+            processed += len(rows)
+            logger.info(f"Resúmenes del libro recalculados: {processed} usuarios")
+
+        return processed
+
     def _calculate_transaction_summary(self, transactions: List[dict]) -> dict:
-        """Calcular resumen de transacciones"""
+        """Calcular resumen de una lista de transacciones ya cargada
+        (el resumen persistido de un usuario lo da get_transaction_summary)"""
         summary = {
             'total_purchases': 0,
             'total_redemptions': 0,
@@ -693,38 +1311,40 @@ class LoyaltyService:
         
         return summary
 
+    def _resolve_tier_upgrade(self, current_tier: str, points: int) -> Optional[str]:
+        """Devolver el nuevo nivel si `points` implica un ascenso desde `current_tier`"""
+        table = get_tier_table()
+        new_tier = table.tier_for_points(points)
+        return new_tier if table.is_upgrade(current_tier, new_tier) else None
+
+    def _tier_upgrade_status(self, old_tier: str, new_tier: str) -> Dict[str, Any]:
+        """Construir la respuesta de un ascenso de nivel"""
+        return {
+            "status": "success",
+            "old_tier": old_tier,
+            "new_tier": new_tier,
+            "message": f"¡Felicidades! Has ascendido a {new_tier.replace('_', ' ').title()}."
+        }
+
     async def check_tier_upgrade(self, user_id: int) -> Dict[str, Any]:
         """
         Verifica si un usuario ha subido de nivel y actualiza su estado.
         Devuelve información sobre el cambio de nivel si ocurre.
         """
         try:
-            user = await self.get_user_by_id(user_id)
+            user = await self.get_user_by_id(user_id, use_primary=True)
             if not user:
                 return {"status": "error", "message": "Usuario no encontrado"}
 
-            current_points = user.total_points
             current_tier = user.current_tier
+            new_tier = self._resolve_tier_upgrade(current_tier, user.total_points)
 
-            # Usa el motor de fidelización para determinar el nuevo nivel
-            new_tier = self.engine._get_tier_from_score(current_points)
-
-            if new_tier != current_tier:
-                # Valida que el cambio sea un ascenso
-                current_tier_value = self.engine.tier_thresholds.get(current_tier, 0)
-                new_tier_value = self.engine.tier_thresholds.get(new_tier, 0)
-
-                if new_tier_value > current_tier_value:
-                    # Actualiza el nivel del usuario en la base de datos
-                    update_query = "UPDATE loyalty_users SET current_tier = %s, updated_at = %s WHERE user_id = %s"
-                    await execute_update(update_query, (new_tier, datetime.now(), user_id))
-
-                    return {
-                        "status": "success",
-                        "old_tier": current_tier,
-                        "new_tier": new_tier,
-                        "message": f"¡Felicidades! Has ascendido a {new_tier.replace('_', ' ').title()}."
-                    }
+            if new_tier:
+                # Actualiza el nivel del usuario en la base de datos
+                update_query = "UPDATE loyalty_users SET current_tier = %s, updated_at = %s WHERE user_id = %s"
+                await execute_update(update_query, (new_tier, datetime.now(), user_id))
+                await self._user_written(user_id)
+                return self._tier_upgrade_status(current_tier, new_tier)
 
             return {"status": "no_change", "current_tier": current_tier}
 
@@ -736,88 +1356,317 @@ class LoyaltyService:
         """Obtener beneficios por nivel"""
         return self.engine._calculate_tier_benefits(tier)
 
-    async def earn_points(self, usuario_id: int, points: int, order_id: Optional[int], description: str) -> Dict[str, Any]:
-        """Otorga puntos a un usuario y registra la transacción."""
+    async def earn_points(self, usuario_id: int, points: int, order_id: Optional[int], description: str,
+                          products: Optional[Sequence[Any]] = None,
+                          idempotency_key: Optional[str] = None,
+                          purchase_amount: float = 0) -> Dict[str, Any]:
+        """
+        Otorga puntos a un usuario y registra la transacción.
+
+        Ruta rápida del checkout: el procedimiento ``loyalty_earn_points`` da
+        de alta al usuario si no existe (con sus puntos de bienvenida), suma
+        el saldo y los contadores de score, sube de nivel según
+        loyalty_tier_config y escribe el libro dentro de una transacción, en
+        un solo viaje a la base de datos. La configuración de bienvenida sale
+        de la caché. `purchase_amount` (importe de la compra) se suma a
+        total_spent, como en earn_points_from_purchase.
+
+        Con el libro diferido activo (LOYALTY_LEDGER_WRITE_BEHIND=1), el
+        usuario ya registrado y sin clave de idempotencia, la acumulación se
+        encola y se confirma en grupo; el saldo devuelto es el del primario
+        más lo pendiente de confirmar. Las acumulaciones con clave (todas las del
+        checkout, que envía order_id o Idempotency-Key) van siempre por el
+        procedimiento, que reclama la clave en la misma transacción.
+
+        Idempotente por `order_id` o, sin pedido, por `idempotency_key`: un
+        reintento devuelve la respuesta original sin abonar de nuevo. La clave
+        de un pedido es la misma en todas las rutas de acumulación.
+        """
+        if order_id is not None:
+            request_key = order_request_key(usuario_id, order_id)
+        elif idempotency_key:
+            request_key = make_request_key("earn", usuario_id, idempotency_key)
+        else:
+            request_key = None
         try:
-            print(f"🔍 DEBUG: earn_points iniciado - usuario_id: {usuario_id}, points: {points}")
-            
-            # Buscar usuario de fidelización por el usuario_ID de la app principal
-            user = await self.get_user_by_usuario_id(usuario_id)
-            print(f"🔍 DEBUG: Usuario encontrado en fidelización: {user is not None}")
-            
-            if not user:
-                # Si el usuario no existe en el sistema de lealtad, lo creamos
-                logger.info(f"Usuario de fidelización no encontrado para usuario_ID {usuario_id}. Creando nuevo perfil.")
-                print(f"🔍 DEBUG: Creando nuevo usuario de fidelización para usuario_ID {usuario_id}")
-                new_user_data = LoyaltyUserCreate(user_id=usuario_id)
-                user = await self.create_user(new_user_data)
-                print(f"🔍 DEBUG: Usuario creado: {user is not None}")
+            if request_key:
+                replay = await self._replay_response(request_key, build=self._earn_result)
+                if replay is not None:
+                    return replay
+            elif ledger_buffer.running:
+                # Solo sin clave: con clave hay que reclamarla en la transacción del procedimiento
+                result = await self._earn_points_queued(usuario_id, points, order_id, description, products,
+                                                        purchase_amount)
+                if result is not None:
+                    return result
 
-            balance_before = user.total_points
-            print(f"🔍 DEBUG: Balance antes: {balance_before}")
-            
-            # Actualizar puntos del usuario en la tabla loyalty_users
-            update_query = """
-                UPDATE loyalty_users 
-                SET total_points = total_points + %s, last_visit = %s 
-                WHERE user_id = %s
-            """
-            print(f"🔍 DEBUG: Ejecutando UPDATE con {points} puntos para user_id {user.user_id}")
-            await execute_update(update_query, (points, datetime.now(), user.user_id))
-            print(f"🔍 DEBUG: UPDATE ejecutado exitosamente")
-            
-            # Registrar la transacción
-            print(f"🔍 DEBUG: Registrando transacción")
-            await self._record_transaction(
-                user.user_id, 'earn', points, order_id, None,
-                description, balance_before, balance_before + points
-            )
-            print(f"🔍 DEBUG: Transacción registrada")
-            
-            # Verificar si sube de nivel
-            print(f"🔍 DEBUG: Verificando subida de nivel")
-            await self.check_tier_upgrade(user.user_id)
-            
-            new_balance = balance_before + points
-            print(f"🔍 DEBUG: Nuevo balance: {new_balance}")
+            welcome_points = int(await self._get_config_value('welcome_points', 200))
+            expiry_days = int(await self._get_config_value('points_expiry_days', 365))
             
-            return {
-                "message": "Puntos otorgados exitosamente.",
-                "points_earned": points,
-                "new_balance": new_balance
-            }
+            rows = await execute_procedure(EARN_POINTS_CALL, (
+                usuario_id, points, order_id, description, product_sketch(products), purchase_amount,
+                welcome_points, self._generate_referral_code(),
+                datetime.now() + timedelta(days=expiry_days), request_key
+            ))
+            row = rows[0]
+            if not row['duplicate']:
+                await self._user_written(usuario_id)
+            
+            if row['created']:
+                logger.info(f"Perfil de fidelización creado para usuario_ID {usuario_id}")
+            
+            if request_key:
+                idempotency_cache.remember(request_key, {
+                    field: row[field]
+                    for field in ("balance_before", "new_balance", "previous_tier", "current_tier", "points")
+                })
+            return self._earn_result(row)
         except Exception as e:
-            print(f"❌ ERROR en earn_points: {str(e)}")
             logger.error(f"Error en earn_points para usuario_ID {usuario_id}: {e}")
             raise
 
+    def _earn_result(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        """Respuesta de earn_points a partir de la fila de loyalty_earn_points"""
+        result = {
+            "message": "Puntos otorgados exitosamente.",
+            "points_earned": int(row['points']),
+            "new_balance": int(row['new_balance']),
+            "current_tier": row['current_tier']
+        }
+        if row['current_tier'] != row['previous_tier']:
+            result["tier_status"] = self._tier_upgrade_status(row['previous_tier'], row['current_tier'])
+        return result
+
+    async def _earn_points_queued(self, usuario_id: int, points: int, order_id: Optional[int],
+                                  description: str, products: Optional[Sequence[Any]],
+                                  purchase_amount: float = 0) -> Optional[Dict[str, Any]]:
+        """Encolar la acumulación en el libro diferido; None si hay que escribir en línea"""
+        # Saldo base del primario: la caché puede no reflejar escrituras de otros workers
+        sequence = ledger_buffer.commit_sequence
+        user = await self.get_user_by_id(usuario_id, use_primary=True)
+        if user is None:
+            return None  # El alta (con bienvenida) la hace el procedimiento
+        if sequence % 2 or sequence != ledger_buffer.commit_sequence:
+            return None  # Un grupo se confirmó durante la lectura: no se sabe qué incluye
+
+        balance_before = user.total_points + ledger_buffer.uncommitted_delta(usuario_id)
+        entry = LedgerEntry(usuario_id, 'earn', points, order_id, description, product_sketch(products),
+                            amount=purchase_amount)
+        if not ledger_buffer.add(entry):
+            return None
+
+        table = get_tier_table()
+        previous_tier = user.current_tier
+        new_tier = table.tier_for_points(balance_before + points)
+        current_tier = new_tier if table.is_upgrade(previous_tier, new_tier) else previous_tier
+        result = {
+            "message": "Puntos otorgados exitosamente.",
+            "points_earned": points,
+            "new_balance": balance_before + points,
+            "current_tier": current_tier,
+            "queued": True
+        }
+        if current_tier != previous_tier:
+            result["tier_status"] = self._tier_upgrade_status(previous_tier, current_tier)
+        return result
+
+    async def earn_points_batch(self, items: Sequence[Tuple[int, int, Optional[int], str,
+                                                            Optional[Sequence[Any]], float]]
+                                ) -> List[Dict[str, Any]]:
+        """
+        Abonar varias compras ``(usuario_id, puntos, order_id, descripción,
+        productos, importe)`` en una sola transacción: bloqueo de saldos, alta con
+        bienvenida de los usuarios que faltan, un INSERT multi-fila en el libro
+        y un UPDATE agregado por usuario (los mismos pasos que el libro diferido).
+
+        Idempotente por `order_id` con las mismas claves que earn_points: una
+        compra ya abonada (por esta ruta o la individual) devuelve su respuesta
+        original. Devuelve un resultado por elemento, en el mismo orden, con la
+        forma de earn_points o ``{"error": mensaje}`` si no se pudo abonar.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        keys = [
+            order_request_key(user_id, order_id) if order_id is not None else None
+            for user_id, _, order_id, _, _, _ in items
+        ]
+        # Primera aparición de cada clave; las repetidas copian su resultado
+        first: Dict[str, int] = {}
+        pending: List[int] = []
+        for index, key in enumerate(keys):
+            if key is not None:
+                cached = idempotency_cache.get(key)
+                if cached is not MISSING:
+                    results[index] = self._earn_result(cached)
+                    continue
+                if key in first:
+                    continue
+                first[key] = index
+            pending.append(index)
+
+        stored: Dict[str, Dict[str, Any]] = {}
+        replayed: Dict[str, Dict[str, Any]] = {}
+        written = set()
+        if pending:
+            welcome_points = int(await self._get_config_value('welcome_points', 200))
+            expiry_days = int(await self._get_config_value('points_expiry_days', 365))
+
+            async with transaction() as uow:
+                # Reclamar las claves antes de bloquear saldos (el orden de loyalty_earn_points);
+                # las que ya tenían respuesta son compras abonadas
+                claims = [index for index in pending if keys[index] is not None]
+                if claims:
+                    now = datetime.now()
+                    inserted = await uow.execute_many(REQUEST_KEY_CLAIM_QUERY, [
+                        (keys[index], items[index][0], now) for index in claims
+                    ])
+                    placeholders = ", ".join(["%s"] * len(claims))
+                    rows = await uow.execute_query(
+                        f"SELECT request_key, response FROM loyalty_request_keys "
+                        f"WHERE request_key IN ({placeholders})",
+                        tuple(keys[index] for index in claims),
+                        for_update=True
+                    )
+                    for row in rows:
+                        if row['response'] is not None:
+                            replayed[row['request_key']] = json.loads(row['response'])
+                    # Claves que ya existían sin respuesta: operaciones aún sin terminar
+                    if len(claims) - inserted > len(replayed):
+                        raise VersionConflict("Hay abonos del lote en curso con la misma clave")
+
+                user_ids = sorted({items[index][0] for index in pending if keys[index] not in replayed})
+                balances = await lock_balances(uow, user_ids)
+
+                missing = [user_id for user_id in user_ids if user_id not in balances]
+                if missing:
+                    now = datetime.now()
+                    await uow.execute_many(BATCH_USER_INSERT_QUERY, [
+                        (user_id, welcome_points, 'cafe_bronze', 0, now, 0, 0,
+                         self._generate_referral_code(), now + timedelta(days=expiry_days))
+                        for user_id in missing
+                    ])
+                    # INSERT IGNORE también ignora la FK a Usuario: se releen los creados
+                    created = await lock_balances(uow, missing)
+                    if created:
+                        await uow.execute_many(TRANSACTION_INSERT_QUERY, [
+                            (user_id, 'bonus', welcome_points, None,
+                             "Puntos de bienvenida al programa de fidelización", 0, welcome_points, now)
+                            for user_id in created
+                        ])
+                        balances.update(created)
+                        written.update(created)
+                        logger.info(f"Perfiles de fidelización creados en lote: {sorted(created)}")
+
+                credits: List[int] = []
+                released: List[str] = []
+                for index in pending:
+                    if keys[index] in replayed:
+                        results[index] = self._earn_result(replayed[keys[index]])
+                    elif items[index][0] not in balances:
+                        results[index] = {"error": "Usuario de fidelización no encontrado"}
+                        if keys[index] is not None:
+                            released.append(keys[index])
+                    else:
+                        credits.append(index)
+                if released:
+                    # Sin abono no queda la clave: un reintento con el usuario ya creado abona
+                    placeholders = ", ".join(["%s"] * len(released))
+                    await uow.execute_update(
+                        f"DELETE FROM loyalty_request_keys WHERE request_key IN ({placeholders})",
+                        tuple(released)
+                    )
+
+                entries = [
+                    LedgerEntry(user_id, 'earn', points, order_id, description, product_sketch(products),
+                                amount=amount)
+                    for user_id, points, order_id, description, products, amount in (items[index] for index in credits)
+                ]
+                outcomes = await apply_entries(uow, entries, balances)
+                for index, (before, after, tier, new_tier) in zip(credits, outcomes):
+                    # Misma fila que guarda el procedimiento loyalty_earn_points
+                    row = {
+                        "balance_before": before, "new_balance": after,
+                        "previous_tier": tier, "current_tier": new_tier, "points": items[index][1]
+                    }
+                    results[index] = self._earn_result(row)
+                    written.add(items[index][0])
+                    if keys[index] is not None:
+                        stored[keys[index]] = row
+
+                if stored:
+                    cases = " ".join(["WHEN %s THEN %s"] * len(stored))
+                    placeholders = ", ".join(["%s"] * len(stored))
+                    params: List[Any] = []
+                    for key, row in stored.items():
+                        params.extend((key, json.dumps(row)))
+                    params.extend(stored)
+                    await uow.execute_update(
+                        f"UPDATE loyalty_request_keys SET response = CASE request_key {cases} END "
+                        f"WHERE request_key IN ({placeholders})",
+                        tuple(params)
+                    )
+
+        for user_id in written:
+            await self._user_written(user_id)
+        for key, row in stored.items():
+            idempotency_cache.remember(key, row)
+        for key, row in replayed.items():
+            idempotency_cache.remember(key, row)
+
+        for index, key in enumerate(keys):
+            if results[index] is None:
+                results[index] = results[first[key]]
+        return results
+
     async def get_all_rewards(self) -> List[LoyaltyReward]:
-        """Obtener todas las recompensas disponibles"""
+        """Obtener todas las recompensas disponibles (catálogo cacheado)"""
         try:
-            query = "SELECT * FROM loyalty_rewards WHERE active = TRUE ORDER BY points_cost"
-            results = await execute_query(query)
-            
-            rewards = []
-            for result in results:
-                reward = LoyaltyReward(
-                    id=result['id'],
-                    name=result['name'],
-                    description=result['description'],
-                    points_cost=result['points_cost'],
-                    discount_percent=result['discount_percent'],
-                    tier_required=result['tier_required'],
-                    max_uses_per_user=result['max_uses_per_user'],
-                    active=result['active'],
-                    expiry_date=result['expiry_date'],
-                    created_at=result['created_at']
-                )
-                rewards.append(reward)
-            
-            return rewards
-            
+            return await single_flight.do(
+                ("get_all_rewards",), lambda: self._rewards_cache.get_or_load("active", self._load_active_rewards)
+            )
+        except PoolExhaustedError:
+            raise
         except Exception as e:
             logger.error(f"Error al obtener recompensas: {e}")
             return []
+    
+    async def get_rewards_catalog(self) -> Tuple[str, bytes]:
+        """
+        Respuesta de /rewards ya serializada: ``(etag, cuerpo JSON)``.
+
+        El cuerpo se genera una vez por versión del catálogo y se guarda como
+        bytes; el ETag es un hash del cuerpo, así coincide en todos los
+        workers y no cambia si el catálogo se recarga sin modificaciones.
+        A diferencia de get_all_rewards, un error se propaga: nunca se
+        guarda un catálogo vacío por un fallo de la base de datos.
+        """
+        return await single_flight.do(
+            ("get_rewards_catalog",), lambda: self._catalog_cache.get_or_load("active", self._build_rewards_catalog)
+        )
+    
+    async def _build_rewards_catalog(self) -> Tuple[str, bytes]:
+        rewards = await self._rewards_cache.get_or_load("active", self._load_active_rewards)
+        body = json_encode({"success": True, "data": rewards})
+        return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body
+    
+    async def _load_active_rewards(self) -> List[LoyaltyReward]:
+        query = "SELECT * FROM loyalty_rewards WHERE active = TRUE ORDER BY points_cost"
+        results = await execute_query(query)
+        
+        return [
+            LoyaltyReward(
+                id=result['id'],
+                name=result['name'],
+                description=result['description'],
+                points_cost=result['points_cost'],
+                discount_percent=result['discount_percent'],
+                tier_required=result['tier_required'],
+                max_uses_per_user=result['max_uses_per_user'],
+                active=result['active'],
+                expiry_date=result['expiry_date'],
+                created_at=result['created_at']
+            )
+            for result in results
+        ]
 
     # =====================================================
     # MÉTODOS PARA EL SISTEMA DE CUPONES
@@ -828,34 +1677,57 @@ class LoyaltyService:
         try:
             # Generar código único
             code = self._generate_coupon_code()
+            params = self._coupon_params(coupon_data, code, datetime.now())
             
-            query = """
-                INSERT INTO loyalty_coupons (
-                    user_id, code, discount_type, discount_value, min_order_amount,
-                    max_uses, valid_from, valid_until, active, created_at
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            
-            params = (
-                coupon_data['user_id'],
-                code,
-                coupon_data['discount_type'],
-                coupon_data['discount_value'],
-                coupon_data['min_order_amount'],
-                coupon_data['max_uses'],
-                datetime.now(),
-                coupon_data.get('valid_until'),
-                True,
-                datetime.now()
-            )
-            
-            coupon_id = await execute_insert(query, params)
+            coupon_id = await execute_insert(COUPON_INSERT_QUERY, params)
             return coupon_id
             
         except Exception as e:
             logger.error(f"Error creando cupón: {e}")
             return None
 
+    async def create_coupons_bulk(self, coupons: List[dict]) -> List[str]:
+        """
+        Crear muchos cupones con INSERT multi-fila (campañas masivas).
+        Devuelve los códigos generados, en el mismo orden que `coupons`.
+        """
+        now = datetime.now()
+        codes = []
+        seen = set()
+        rows = []
+        for coupon_data in coupons:
+            code = self._generate_coupon_code()
+            while code in seen:
+                code = self._generate_coupon_code()
+            seen.add(code)
+            codes.append(code)
+            rows.append(self._coupon_params(coupon_data, code, now))
+        
+        if not rows:
+            return []
+        
+        try:
+            await execute_many(COUPON_INSERT_QUERY, rows)
+            return codes
+        except Exception as e:
+            logger.error(f"Error creando {len(rows)} cupones en bloque: {e}")
+            raise
+
+    def _coupon_params(self, coupon_data: dict, code: str, now: datetime) -> tuple:
+        """Parámetros de inserción de un cupón"""
+        return (
+            coupon_data['user_id'],
+            code,
+            coupon_data['discount_type'],
+            coupon_data['discount_value'],
+            coupon_data['min_order_amount'],
+            coupon_data['max_uses'],
+            now,
+            coupon_data.get('valid_until'),
+            True,
+            now
+        )
+
     async def get_coupon_by_id(self, coupon_id: int) -> Optional[dict]:
         """Obtener cupón por ID"""
         try:
@@ -886,7 +1758,7 @@ class LoyaltyService:
                 AND used_count < max_uses
                 ORDER BY created_at DESC
             """
-            results = await execute_query(query, (user_id, datetime.now()))
+            results = await execute_query(query, (user_id, datetime.now()), sticky_key=user_id)
             return results
         except Exception as e:
             logger.error(f"Error obteniendo cupones activos del usuario {user_id}: {e}")
@@ -894,8 +1766,12 @@ class LoyaltyService:
 
     async def get_all_coupons(self, skip: int = 0, limit: int = 100, 
                             user_id: Optional[int] = None, active_only: bool = True,
-                            expired_only: bool = False) -> List[dict]:
-        """Obtener todos los cupones con filtros"""
+                            expired_only: bool = False, cursor: Optional[str] = None
+                            ) -> Tuple[List[dict], Optional[str]]:
+        """
+        Obtener todos los cupones con filtros y el cursor de la página
+        siguiente (`cursor`: paginación por clave; None en la última)
+        """
         try:
             conditions = []
             params = []
@@ -911,21 +1787,30 @@ class LoyaltyService:
                 conditions.append("valid_until < %s")
                 params.append(datetime.now())
             
+            if cursor:
+                conditions.append(keyset_condition('id'))
+                params.extend(keyset_params(cursor))
+            
             where_clause = " AND ".join(conditions) if conditions else "1=1"
             
             query = f"""
                 SELECT * FROM loyalty_coupons 
                 WHERE {where_clause}
-                ORDER BY created_at DESC
-                LIMIT %s OFFSET %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
             """
-            params.extend([limit, skip])
+            params.append(limit)
+            if not cursor:
+                query += " OFFSET %s"
+                params.append(skip)
             
             results = await execute_query(query, tuple(params))
-            return results
+            return results, next_cursor(results, limit, key=lambda coupon: (coupon['created_at'], coupon['id']))
+        except InvalidCursorError:
+            raise
         except Exception as e:
             logger.error(f"Error obteniendo cupones: {e}")
-            return []
+            return [], None
 
     async def update_coupon(self, coupon_id: int, update_data: dict) -> bool:
         """Actualizar cupón existente"""
@@ -1004,43 +1889,48 @@ class LoyaltyService:
             return False
 
     async def get_coupon_statistics(self) -> dict:
-        """Obtener estadísticas generales de cupones"""
+        """Obtener estadísticas generales de cupones (cacheadas STATS_CACHE_TTL_SECONDS)"""
         try:
-            # Total de cupones
-            total_query = "SELECT COUNT(*) as total FROM loyalty_coupons"
-            total_result = await execute_single_query(total_query)
-            
-            # Cupones activos
-            active_query = "SELECT COUNT(*) as active FROM loyalty_coupons WHERE active = TRUE"
-            active_result = await execute_single_query(active_query)
-            
-            # Cupones usados
-            used_query = "SELECT COUNT(*) as used FROM loyalty_coupons WHERE used_count > 0"
-            used_result = await execute_single_query(used_query)
-            
-            # Cupones expirados
-            expired_query = "SELECT COUNT(*) as expired FROM loyalty_coupons WHERE valid_until < %s"
-            expired_result = await execute_single_query(expired_query, (datetime.now(),))
-            
-            # Valor total de descuentos
-            value_query = """
-                SELECT SUM(discount_value) as total_value 
-                FROM loyalty_coupons 
-                WHERE used_count > 0
-            """
-            value_result = await execute_single_query(value_query)
-            
-            return {
-                "total_coupons": total_result.get('total', 0),
-                "active_coupons": active_result.get('active', 0),
-                "used_coupons": used_result.get('used', 0),
-                "expired_coupons": expired_result.get('expired', 0),
-                "total_discount_value": value_result.get('total_value', 0),
-                "redemption_rate": round((used_result.get('used', 0) / total_result.get('total', 1)) * 100, 2)
-            }
+            return await single_flight.do(
+                ("get_coupon_statistics",), lambda: self._stats_cache.get_or_load("coupons", self._load_coupon_statistics)
+            )
         except Exception as e:
             logger.error(f"Error obteniendo estadísticas de cupones: {e}")
             return {}
+    
+    async def _load_coupon_statistics(self) -> dict:
+        # Total de cupones
+        total_query = "SELECT COUNT(*) as total FROM loyalty_coupons"
+        total_result = await execute_single_query(total_query)
+        
+        # Cupones activos
+        active_query = "SELECT COUNT(*) as active FROM loyalty_coupons WHERE active = TRUE"
+        active_result = await execute_single_query(active_query)
+        
+        # Cupones usados
+        used_query = "SELECT COUNT(*) as used FROM loyalty_coupons WHERE used_count > 0"
+        used_result = await execute_single_query(used_query)
+        
+        # Cupones expirados
+        expired_query = "SELECT COUNT(*) as expired FROM loyalty_coupons WHERE valid_until < %s"
+        expired_result = await execute_single_query(expired_query, (datetime.now(),))
+        
+        # Valor total de descuentos
+        value_query = """
+            SELECT SUM(discount_value) as total_value 
+            FROM loyalty_coupons 
+            WHERE used_count > 0
+        """
+        value_result = await execute_single_query(value_query)
+        
+        return {
+            "total_coupons": total_result.get('total', 0),
+            "active_coupons": active_result.get('active', 0),
+            "used_coupons": used_result.get('used', 0),
+            "expired_coupons": expired_result.get('expired', 0),
+            "total_discount_value": value_result.get('total_value', 0),
+            "redemption_rate": round((used_result.get('used', 0) / total_result.get('total', 1)) * 100, 2)
+        }
 
     async def get_user_coupon_statistics(self, user_id: int) -> dict:
         """Obtener estadísticas de cupones de un usuario específico"""
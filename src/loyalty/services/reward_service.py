@@ -6,6 +6,8 @@ from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 import logging
 
+from utils.tier_table import get_tier_table
+
 logger = logging.getLogger(__name__)
 
 class RewardService:
@@ -79,17 +81,7 @@ class RewardService:
     
     def _can_user_access_reward(self, user_tier: str, required_tier: str) -> bool:
         """Verificar si un usuario puede acceder a una recompensa"""
-        tier_hierarchy = {
-            'cafe_bronze': 1,
-            'cafe_plata': 2,
-            'cafe_oro': 3,
-            'cafe_diamante': 4
-        }
-        
-        user_level = tier_hierarchy.get(user_tier, 0)
-        required_level = tier_hierarchy.get(required_tier, 0)
-        
-        return user_level >= required_level
+        return get_tier_table().can_access(user_tier, required_tier)
     
     async def validate_reward_redemption(self, user_id: int, reward_id: int, 
                                        user_points: int, user_tier: str) -> Dict[str, Any]:
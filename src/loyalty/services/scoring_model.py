@@ -0,0 +1,138 @@
+"""
+Modelo de scoring: pesos por componente y recencia con decaimiento exponencial,
+precompilados para el cálculo escalar y el vectorizado
+"""
+
+import asyncio
+import json
+import logging
+import math
+from typing import Any, Dict, Mapping, Sequence, Tuple
+
+import numpy as np
+
+from config import loyalty_config
+from utils.cache import cache_manager
+from utils.database import execute_query
+
+logger = logging.getLogger(__name__)
+
+# Componentes del score en el orden de los vectores de coeficientes
+SCORE_COMPONENTS = ('frequency', 'amount', 'recency', 'variety', 'referral')
+
+# Claves de loyalty_config que sobrescriben el modelo por defecto
+WEIGHTS_CONFIG_KEY = 'scoring_weights'
+HALF_LIFE_CONFIG_KEY = 'recency_half_life_days'
+
+
+class ScoringModel:
+    """
+    Pesos normalizados (suman 1) y tasa de decaimiento de la recencia.
+
+    La recencia es ``100 * exp(-tasa * días)`` con ``tasa = ln 2 / vida_media``:
+    vale 100 el día de la visita y la mitad cada `recency_half_life_days`.
+    Inmutable: para cambiar el modelo se compila uno nuevo y se reemplaza el global.
+    """
+
+    __slots__ = ("weights", "weight_tuple", "recency_half_life_days", "decay_rate")
+
+    def __init__(self, weights: Mapping[str, float], recency_half_life_days: float):
+        unknown = set(weights) - set(SCORE_COMPONENTS)
+        if unknown:
+            raise ValueError(f"Componentes de score desconocidos: {', '.join(sorted(unknown))}")
+        raw = [float(weights.get(name, 0.0)) for name in SCORE_COMPONENTS]
+        if any(weight < 0 for weight in raw) or sum(raw) <= 0:
+            raise ValueError("Los pesos del score deben ser no negativos y sumar más de 0")
+        if recency_half_life_days <= 0:
+            raise ValueError("La vida media de la recencia debe ser positiva")
+
+        total = sum(raw)
+        # Tupla de floats para el cálculo escalar (evita escalares de NumPy por usuario)
+        self.weight_tuple: Tuple[float, ...] = tuple(weight / total for weight in raw)
+        self.weights = np.array(self.weight_tuple)
+        self.weights.flags.writeable = False
+        self.recency_half_life_days = float(recency_half_life_days)
+        self.decay_rate = math.log(2) / self.recency_half_life_days
+
+    @classmethod
+    def from_config(cls) -> "ScoringModel":
+        """Modelo por defecto desde LoyaltyConfig"""
+        return cls(loyalty_config.SCORING_WEIGHTS, loyalty_config.RECENCY_HALF_LIFE_DAYS)
+
+    def recency(self, days: float) -> float:
+        """Score de recencia para `days` días desde la última visita"""
+        return 100 * math.exp(-self.decay_rate * max(days, 0.0))
+
+    def recency_batch(self, days: np.ndarray) -> np.ndarray:
+        """Recencia vectorizada; `days` en días (fraccionarios)"""
+        return 100 * np.exp(-self.decay_rate * np.maximum(days, 0.0))
+
+    def combine(self, components: Sequence[float]) -> float:
+        """Score total de los componentes en el orden de SCORE_COMPONENTS"""
+        return sum(weight * value for weight, value in zip(self.weight_tuple, components))
+
+    def combine_batch(self, components: np.ndarray) -> np.ndarray:
+        """Score total de una matriz componentes x usuarios"""
+        return self.weights @ components
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Pesos normalizados y vida media"""
+        return {
+            "weights": dict(zip(SCORE_COMPONENTS, self.weight_tuple)),
+            "recency_half_life_days": self.recency_half_life_days
+        }
+
+
+_model = ScoringModel.from_config()
+_reload_tasks = set()
+
+
+def get_scoring_model() -> ScoringModel:
+    """Modelo de scoring vigente en este worker"""
+    return _model
+
+
+def set_scoring_model(model: ScoringModel):
+    """Reemplazar el modelo vigente (una sola asignación)"""
+    global _model
+    _model = model
+
+
+async def load_scoring_model() -> ScoringModel:
+    """
+    Compilar el modelo con los valores de loyalty_config (``scoring_weights``
+    como JSON y ``recency_half_life_days``); lo que falte sale de LoyaltyConfig.
+    Si la consulta falla o los valores no son válidos se conserva el modelo vigente.
+    """
+    query = "SELECT config_key, config_value FROM loyalty_config WHERE config_key IN (%s, %s)"
+    try:
+        rows = await execute_query(query, (WEIGHTS_CONFIG_KEY, HALF_LIFE_CONFIG_KEY), use_primary=True)
+        values = {row['config_key']: row['config_value'] for row in rows}
+        weights = values.get(WEIGHTS_CONFIG_KEY)
+        half_life = values.get(HALF_LIFE_CONFIG_KEY)
+        set_scoring_model(ScoringModel(
+            json.loads(weights) if weights else loyalty_config.SCORING_WEIGHTS,
+            float(half_life) if half_life else loyalty_config.RECENCY_HALF_LIFE_DAYS
+        ))
+        logger.info(f"Modelo de scoring cargado: {_model.as_dict()}")
+    except Exception as e:
+        logger.error(f"Error cargando el modelo de scoring, se mantiene el actual: {e}")
+    return _model
+
+
+def _schedule_reload(keys):
+    """Otro worker cambió el modelo: recargar en segundo plano"""
+    task = asyncio.get_running_loop().create_task(load_scoring_model())
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+
+# Región sin datos: solo transporta el aviso de recarga entre workers
+_reload_signal = cache_manager.region("scoring_model", maxsize=1, ttl=1, on_invalidate=_schedule_reload)
+
+
+async def reload_scoring_model() -> ScoringModel:
+    """Recargar el modelo en este worker y avisar a los demás para que recarguen"""
+    model = await load_scoring_model()
+    await _reload_signal.clear()
+    return model
@@ -0,0 +1,46 @@
+"""
+Tests unitarios para el control de admisión de rutas
+"""
+
+import pytest
+from unittest.mock import patch
+
+from utils.admission import AdmissionController
+
+
+class TestAdmissionController:
+    """Tests de descarte de carga con capacidad reservada"""
+
+    @pytest.fixture
+    def controller(self):
+        """Controlador con 4 cupos, 2 reservados para operaciones críticas"""
+        return AdmissionController(max_in_flight=4, reserved_critical=2, retry_after=3)
+
+    @pytest.mark.unit
+    def test_non_critical_reads_are_shed_before_reserved_capacity(self, controller):
+        """Las lecturas no críticas no consumen la capacidad reservada"""
+        with patch('utils.admission.get_pool_waiters', return_value=0):
+            assert controller.try_enter(critical=False)
+            assert controller.try_enter(critical=False)
+            assert not controller.try_enter(critical=False)
+
+            # Las operaciones críticas siguen entrando en la reserva
+            assert controller.try_enter(critical=True)
+            assert controller.try_enter(critical=True)
+            assert not controller.try_enter(critical=True)
+
+        assert controller.shed == 2
+
+    @pytest.mark.unit
+    def test_non_critical_reads_fail_fast_when_pool_has_waiters(self, controller):
+        """Con corrutinas esperando conexión, las lecturas no críticas se rechazan"""
+        with patch('utils.admission.get_pool_waiters', return_value=3):
+            assert not controller.try_enter(critical=False)
+            assert controller.try_enter(critical=True)
+
+    @pytest.mark.unit
+    def test_overloaded_response_has_retry_after(self, controller):
+        """La respuesta de rechazo es 503 con Retry-After"""
+        exc = controller.overloaded()
+        assert exc.status_code == 503
+        assert exc.headers == {"Retry-After": "3"}
@@ -0,0 +1,305 @@
+"""
+Tests unitarios para la caché en memoria de perfiles
+"""
+
+import pytest
+from datetime import datetime
+from decimal import Decimal
+from unittest.mock import AsyncMock, patch
+
+from utils.cache import TTLCache, MISSING
+
+
+class FakeClock:
+    """Reloj manual para controlar la caducidad"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    """Tests para la caché LRU con TTL"""
+
+    @pytest.mark.unit
+    def test_entries_expire_after_ttl(self):
+        """Las entradas caducan al cumplirse el TTL"""
+        clock = FakeClock()
+        cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+        cache.set(1, "perfil")
+
+        clock.now = 59
+        assert cache.get(1) == "perfil"
+        clock.now = 60
+        assert cache.get(1) is MISSING
+        assert len(cache) == 0
+
+    @pytest.mark.unit
+    def test_least_recently_used_is_evicted(self):
+        """Al llenarse se desaloja la entrada usada hace más tiempo"""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+
+        assert cache.get(2) is MISSING
+        assert cache.get(1) == "a"
+        assert cache.get(3) == "c"
+        assert cache.stats()["evictions"] == 1
+
+    @pytest.mark.unit
+    def test_hit_and_miss_counters(self):
+        """Se cuentan aciertos y fallos"""
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.get(1)
+        cache.set(1, "a")
+        cache.get(1)
+        cache.invalidate(1)
+        cache.get(1)
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 2
+
+
+class TestUserCache:
+    """Tests de la caché de perfiles en LoyaltyService"""
+
+    @pytest.fixture
+    def loyalty_service(self):
+        """Instancia del servicio para tests"""
+        from services.loyalty_service import LoyaltyService
+        return LoyaltyService()
+
+    @pytest.fixture
+    def user_row(self):
+        """Fila de loyalty_users en el orden de USER_COLUMNS"""
+        now = datetime.now()
+        return (1, 500, 'cafe_bronze', now, now, 3, Decimal('1500.00'), 0, 0, now, now,
+                12.5, None, 'ABCD1234', None, now)
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_repeated_lookups_hit_cache(self, loyalty_service, user_row):
+        """La segunda lectura del mismo usuario no va a la base de datos"""
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=user_row) as mock_row:
+            first = await loyalty_service.get_user_by_id(1)
+            second = await loyalty_service.get_user_by_id(1)
+
+        assert first is second
+        mock_row.assert_awaited_once()
+        assert loyalty_service.cache_stats()["hits"] == 1
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_primary_reads_bypass_cache(self, loyalty_service, user_row):
+        """Las lecturas previas a una escritura siempre van al primario"""
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=user_row) as mock_row:
+            await loyalty_service.get_user_by_id(1)
+            await loyalty_service.get_user_by_id(1, use_primary=True)
+
+        assert mock_row.await_count == 2
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_writes_invalidate_cached_user(self, loyalty_service, user_row):
+        """Una escritura del usuario invalida su entrada"""
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=user_row) as mock_row, \
+             patch('services.loyalty_service.execute_update', new_callable=AsyncMock, return_value=1):
+            await loyalty_service.get_user_by_id(1)
+            await loyalty_service.delete_user(1)
+            await loyalty_service.get_user_by_id(1)
+
+        assert mock_row.await_count == 2
+
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_cache_filled_only_from_primary(self, loyalty_service, user_row):
+        """Un fallo de caché lee del primario; el perfil (réplica) no rellena la caché"""
+        profile_row = user_row + ('Ana', 'Pérez', 0)
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=profile_row) as mock_row:
+            await loyalty_service.get_user_profile(1)
+        assert mock_row.call_args.kwargs.get('use_primary') is not True
+        assert loyalty_service._user_cache.local.get(1) is MISSING
+
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=user_row) as mock_row:
+            await loyalty_service.get_user_by_id(1)
+        assert mock_row.call_args.kwargs['use_primary'] is True
+        assert loyalty_service._user_cache.local.get(1) is not MISSING
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_write_during_load_is_not_cached(self, loyalty_service, user_row):
+        """Una lectura que una escritura adelanta no deja la fila vieja en caché"""
+        async def read_then_write(*args, **kwargs):
+            # La escritura se confirma mientras la lectura está en vuelo
+            await loyalty_service._user_written(1)
+            return user_row
+
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   side_effect=read_then_write):
+            await loyalty_service.get_user_by_id(1)
+
+        assert loyalty_service._user_cache.local.get(1) is MISSING
+        assert loyalty_service._user_cache.stats()["stale_sets"] == 1
+
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=user_row):
+            await loyalty_service.get_user_by_id(1)
+        assert loyalty_service._user_cache.local.get(1) is not MISSING
+
+
+class TestRewardsCatalog:
+    """Tests del catálogo de recompensas serializado con ETag"""
+
+    @pytest.fixture
+    def loyalty_service(self):
+        """Instancia del servicio para tests"""
+        from services.loyalty_service import LoyaltyService
+        return LoyaltyService()
+
+    @pytest.fixture
+    def reward_rows(self):
+        return [{
+            'id': 1, 'name': 'Café Gratis', 'description': 'Un café', 'points_cost': 200,
+            'discount_percent': 100.0, 'tier_required': 'cafe_bronze', 'max_uses_per_user': 5,
+            'active': True, 'expiry_date': None, 'created_at': datetime(2024, 1, 1)
+        }]
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_not_modified_without_database_work(self, loyalty_service, reward_rows):
+        """Con If-None-Match vigente: 304 sin cuerpo ni consultas"""
+        from routes import loyalty_routes
+
+        with patch.object(loyalty_routes, 'loyalty_service', loyalty_service), \
+             patch('services.loyalty_service.execute_query', new_callable=AsyncMock,
+                   return_value=reward_rows) as mock_query:
+            first = await loyalty_routes.get_available_rewards(None)
+            etag = first.headers['etag']
+            second = await loyalty_routes.get_available_rewards(f'W/{etag}')
+
+        mock_query.assert_awaited_once()
+        assert first.status_code == 200
+        assert b'"success": true' in first.body
+        assert second.status_code == 304
+        assert second.body == b''
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_invalidation_changes_etag(self, loyalty_service, reward_rows):
+        """Editar el catálogo genera un cuerpo y un ETag nuevos"""
+        with patch('services.loyalty_service.execute_query', new_callable=AsyncMock,
+                   return_value=reward_rows):
+            etag, _ = await loyalty_service.get_rewards_catalog()
+            same_etag, _ = await loyalty_service.get_rewards_catalog()
+
+        reward_rows[0]['points_cost'] = 150
+        with patch('services.loyalty_service.execute_query', new_callable=AsyncMock,
+                   return_value=reward_rows):
+            await loyalty_service.invalidate_rewards_cache()
+            new_etag, body = await loyalty_service.get_rewards_catalog()
+
+        assert same_etag == etag
+        assert new_etag != etag
+        assert b'"points_cost": 150' in body
+
+
+class TestTwoTierCache:
+    """Tests de L1 + L2 compartido con invalidación entre workers"""
+
+    @pytest.fixture
+    async def workers(self):
+        """Dos CacheManager (workers) que comparten un L2 en memoria"""
+        from utils.cache import CacheManager
+        from utils.cache_backends import MemoryBackend
+
+        backend = MemoryBackend()
+        first, second = CacheManager(), CacheManager()
+        await first.start(backend=backend)
+        await second.start(backend=backend)
+        yield first, second
+        await first.stop()
+        await second.stop()
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_l2_shares_values_between_workers(self, workers):
+        """Lo que guarda un worker lo lee otro desde L2"""
+        first, second = workers
+        region_a = first.region("rewards", maxsize=10, ttl=60)
+        region_b = second.region("rewards", maxsize=10, ttl=60)
+
+        await region_a.set("active", [{"id": 1, "points_cost": 200}])
+
+        assert await region_b.get("active") == [{"id": 1, "points_cost": 200}]
+        assert region_b.stats()["l2_hits"] == 1
+        # La segunda lectura ya sale del L1 del worker
+        await region_b.get("active")
+        assert region_b.stats()["l2_hits"] == 1
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_invalidation_evicts_other_workers_l1(self, workers):
+        """Una escritura en un worker invalida el L1 de los demás"""
+        import asyncio
+
+        first, second = workers
+        region_a = first.region("users", maxsize=10, ttl=60)
+        region_b = second.region("users", maxsize=10, ttl=60)
+
+        await region_a.set(7, {"total_points": 100})
+        await region_b.get(7)
+        assert region_b.local.get(7) == {"total_points": 100}
+
+        await region_a.invalidate(7)
+        await asyncio.sleep(0)
+
+        assert region_b.local.get(7) is MISSING
+        assert await region_b.get(7) is MISSING
+        assert second.stats()["invalidations_received"] == 1
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_stale_load_not_written_after_other_worker_invalidates(self, workers):
+        """Una lectura que otro worker invalida en vuelo no llega a L2 ni a L1"""
+        first, second = workers
+        region_a = first.region("users", maxsize=10, ttl=60)
+        region_b = second.region("users", maxsize=10, ttl=60)
+
+        generation = await region_a.generation(7)
+        # El otro worker escribe e invalida antes de que termine la lectura
+        await region_b.invalidate(7)
+        await region_a.set(7, {"total_points": 100}, generation=generation)
+
+        assert await first.backend.get(first._l2_key("users", 7)) is None
+        assert region_a.local.get(7) is MISSING
+        assert region_a.stats()["stale_sets"] == 1
+
+        await region_a.set(7, {"total_points": 150}, generation=await region_a.generation(7))
+        assert await region_b.get(7) == {"total_points": 150}
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_without_l2_only_local_cache(self):
+        """Sin L2 configurado la caché funciona solo en memoria"""
+        from utils.cache import CacheManager
+
+        manager = CacheManager()
+        await manager.start("")
+        region = manager.region("stats", maxsize=10, ttl=60)
+        loader = AsyncMock(return_value={"total_users": 10})
+
+        assert await region.get_or_load("system", loader) == {"total_users": 10}
+        assert await region.get_or_load("system", loader) == {"total_users": 10}
+        loader.assert_awaited_once()
+        assert manager.stats()["l2"] is None
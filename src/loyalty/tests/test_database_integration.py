@@ -352,4 +352,142 @@ class TestDatabaseIntegration:
             
             # Verificar que se crearon las conexiones
             assert len(connections) == 5
-            assert mock_db.call_count == 5 
\ No newline at end of file
+            assert mock_db.call_count == 5 
+
+class _FakeCursor:
+    """Cursor mínimo para simular aiomysql en tests"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 1
+        self.lastrowid = 1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, query, params=None):
+        self.conn.executed.append((query, params))
+
+    async def fetchone(self):
+        return {'total_points': 100, 'current_tier': 'cafe_bronze'}
+
+    async def fetchall(self):
+        return [await self.fetchone()]
+
+
+class _FakeConnection:
+    """Conexión mínima que registra begin/commit/rollback"""
+
+    def __init__(self):
+        self.executed = []
+        self.events = []
+
+    def cursor(self, *args):
+        return _FakeCursor(self)
+
+    async def begin(self):
+        self.events.append('begin')
+
+    async def commit(self):
+        self.events.append('commit')
+
+    async def rollback(self):
+        self.events.append('rollback')
+
+
+class _FakePool:
+    """Pool mínimo que siempre entrega la misma conexión"""
+
+    def __init__(self):
+        self.conn = _FakeConnection()
+        self.acquired = 0
+
+    async def acquire(self):
+        self.acquired += 1
+        return self.conn
+
+    def release(self, conn):
+        pass
+
+
+class TestUnitOfWork:
+    """Tests de la unidad de trabajo transaccional"""
+
+    @pytest.mark.database
+    @pytest.mark.unit
+    async def test_transaction_commits_on_success(self):
+        """Una unidad de trabajo exitosa usa una conexión y hace commit"""
+        from utils import database
+
+        pool = _FakePool()
+        with patch.object(database, '_pool', pool):
+            async with database.transaction() as uow:
+                row = await uow.execute_single_query(
+                    "SELECT total_points FROM loyalty_users WHERE user_id = %s", (1,), for_update=True
+                )
+                await uow.execute_update("UPDATE loyalty_users SET total_points = %s WHERE user_id = %s", (200, 1))
+
+        assert row['total_points'] == 100
+        assert pool.acquired == 1
+        assert pool.conn.events == ['begin', 'commit']
+        assert pool.conn.executed[0][0].endswith("FOR UPDATE")
+
+    @pytest.mark.database
+    @pytest.mark.unit
+    async def test_transaction_rolls_back_on_error(self):
+        """Un error dentro de la unidad de trabajo revierte la transacción"""
+        from utils import database
+
+        pool = _FakePool()
+        with patch.object(database, '_pool', pool):
+            with pytest.raises(ValueError):
+                async with database.transaction() as uow:
+                    await uow.execute_update("UPDATE loyalty_users SET total_points = 0 WHERE user_id = 1")
+                    raise ValueError("Puntos insuficientes")
+
+        assert pool.conn.events == ['begin', 'rollback']
+
+
+class TestReplicaRouting:
+    """Tests del enrutamiento de lecturas a la réplica"""
+
+    @pytest.fixture
+    def replica(self):
+        """Réplica configurada, al día y sin marcas de escritura"""
+        import time
+        from utils import database
+
+        state = {"lag": 0, "checked_at": time.monotonic(), "checking": False}
+        with patch.object(database, '_replica_pool', _FakePool()), \
+             patch.object(database, '_replica_state', state), \
+             patch.object(database, '_sticky_until', {}):
+            yield database
+
+    @pytest.mark.database
+    @pytest.mark.unit
+    async def test_reads_go_to_replica_by_default(self, replica):
+        """Sin escrituras recientes las lecturas van a la réplica"""
+        assert await replica._use_replica(sticky_key=1, use_primary=False)
+        assert not await replica._use_replica(sticky_key=1, use_primary=True)
+
+    @pytest.mark.database
+    @pytest.mark.unit
+    async def test_read_your_writes_sticks_to_primary(self, replica):
+        """Tras escribir, las lecturas del mismo usuario van al primario"""
+        replica.mark_recent_write(7)
+
+        assert not await replica._use_replica(sticky_key=7, use_primary=False)
+        assert await replica._use_replica(sticky_key=8, use_primary=False)
+
+    @pytest.mark.database
+    @pytest.mark.unit
+    async def test_lagging_replica_falls_back_to_primary(self, replica):
+        """Si la réplica va atrasada (o sin dato de retraso) se usa el primario"""
+        replica._replica_state["lag"] = replica.settings.DB_REPLICA_MAX_LAG_SECONDS + 1
+        assert not await replica._use_replica(sticky_key=None, use_primary=False)
+
+        replica._replica_state["lag"] = None
+        assert not await replica._use_replica(sticky_key=None, use_primary=False)
@@ -0,0 +1,221 @@
+"""
+Tests unitarios para la idempotencia de acumulaciones y canjes
+"""
+
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from utils.idempotency import BloomFilter, IdempotencyCache, order_request_key, request_key
+from utils.locks import VersionConflict
+
+
+class TestBloomFilter:
+    """Tests del filtro de Bloom"""
+
+    @pytest.mark.unit
+    def test_no_false_negatives_and_low_false_positives(self):
+        """Toda clave añadida está; las no añadidas casi nunca"""
+        bloom = BloomFilter(capacity=10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(f"earn:1:order-{i}")
+
+        assert all(f"earn:1:order-{i}" in bloom for i in range(10000))
+        false_positives = sum(f"earn:2:order-{i}" in bloom for i in range(10000))
+        assert false_positives < 300  # ~1% esperado
+
+    @pytest.mark.unit
+    def test_cache_rotates_bloom_generations(self):
+        """Al llenarse la generación actual se conserva la anterior"""
+        cache = IdempotencyCache(maxsize=10, ttl=60, bloom_capacity=2)
+        for key in ("a", "b", "c"):
+            cache.remember(key, {"ok": key})
+
+        assert cache.maybe_seen("a") and cache.maybe_seen("c")
+        cache.remember("d", {})
+        cache.remember("e", {})
+        assert not cache.maybe_seen("a")
+        assert cache.get("e") == {}
+        assert cache.stats()["replayed"] == 1
+
+
+class TestIdempotentOperations:
+    """Tests de reintentos en el servicio"""
+
+    @pytest.fixture
+    def cache(self):
+        cache = IdempotencyCache(maxsize=100, ttl=60, bloom_capacity=100)
+        with patch("services.loyalty_service.idempotency_cache", cache):
+            yield cache
+
+    @pytest.mark.unit
+    async def test_earn_points_passes_request_key(self, loyalty_service, cache):
+        """El order_id llega al procedimiento como clave y la respuesta queda en el LRU"""
+        row = {
+            'balance_before': 100, 'new_balance': 150, 'previous_tier': 'cafe_bronze',
+            'current_tier': 'cafe_bronze', 'points': 50, 'created': 0, 'duplicate': 0
+        }
+        with patch.object(loyalty_service, '_get_config_value', new_callable=AsyncMock, side_effect=[200, 365]), \
+             patch('services.loyalty_service.execute_procedure', new_callable=AsyncMock,
+                   return_value=[row]) as mock_call, \
+             patch.object(loyalty_service, '_user_written', new_callable=AsyncMock):
+            result = await loyalty_service.earn_points(7, 50, 123, "Compra")
+
+        assert mock_call.call_args.args[1][-1] == order_request_key(7, 123)
+        # El LRU guarda la fila del abono, como loyalty_request_keys
+        assert loyalty_service._earn_result(cache.get(order_request_key(7, 123))) == result
+
+    @pytest.mark.unit
+    async def test_order_key_shared_across_earn_paths(self, loyalty_service, cache):
+        """Un pedido abonado por earn_points no se abona otra vez por compra ni por lote"""
+        row = {
+            'balance_before': 100, 'new_balance': 150, 'previous_tier': 'cafe_bronze',
+            'current_tier': 'cafe_bronze', 'points': 50, 'created': 0, 'duplicate': 0
+        }
+        with patch.object(loyalty_service, '_get_config_value', new_callable=AsyncMock, side_effect=[200, 365]), \
+             patch('services.loyalty_service.execute_procedure', new_callable=AsyncMock, return_value=[row]), \
+             patch.object(loyalty_service, '_user_written', new_callable=AsyncMock):
+            await loyalty_service.earn_points(7, 50, 123, "Compra", idempotency_key="checkout-abc")
+
+        with patch('services.loyalty_service.transaction') as mock_transaction:
+            purchase = await loyalty_service.earn_points_from_purchase(7, 5000, 123)
+            batch = await loyalty_service.earn_points_batch([(7, 50, 123, "Compra", None, 5000)])
+
+        mock_transaction.assert_not_called()
+        assert purchase['status'] == 'success'
+        assert purchase['points_earned'] == 50 and purchase['new_total_points'] == 150
+        assert batch[0]['new_balance'] == 150
+
+    @pytest.mark.unit
+    async def test_retry_answered_from_memory(self, loyalty_service, cache):
+        """Un reintento reciente no toca la base de datos"""
+        stored = {'balance_before': 100, 'new_balance': 150, 'previous_tier': 'cafe_bronze',
+                  'current_tier': 'cafe_bronze', 'points': 50}
+        original = {"message": "Puntos otorgados exitosamente.", "points_earned": 50,
+                    "new_balance": 150, "current_tier": "cafe_bronze"}
+        cache.remember(request_key("earn", 7, "abc"), stored)
+
+        with patch('services.loyalty_service.execute_procedure', new_callable=AsyncMock) as mock_call, \
+             patch('services.loyalty_service.execute_single_query', new_callable=AsyncMock) as mock_query:
+            result = await loyalty_service.earn_points(7, 50, None, "Compra", idempotency_key="abc")
+
+        assert result == original
+        mock_call.assert_not_awaited()
+        mock_query.assert_not_awaited()
+
+    @pytest.mark.unit
+    async def test_replay_lookup_only_when_bloom_matches(self, loyalty_service, cache):
+        """Sin coincidencia en el filtro no se consulta loyalty_request_keys"""
+        stored = {'balance_before': 0, 'new_balance': 80, 'previous_tier': 'cafe_bronze',
+                  'current_tier': 'cafe_bronze', 'points': 80}
+        key = request_key("earn", 9, "order-5")
+
+        with patch('services.loyalty_service.execute_single_query', new_callable=AsyncMock,
+                   return_value={'response': json.dumps(stored)}) as mock_query:
+            assert await loyalty_service._replay_response(key) is None
+            mock_query.assert_not_awaited()
+
+            # Clave vista por este worker pero ya fuera del LRU
+            cache._current.add(key)
+            result = await loyalty_service._replay_response(key, build=loyalty_service._earn_result)
+
+        mock_query.assert_awaited_once()
+        assert result["new_balance"] == 80
+        assert result["points_earned"] == 80
+
+    @pytest.mark.unit
+    async def test_earn_points_batch_one_transaction(self, loyalty_service, cache):
+        """Lote: una transacción, un INSERT en el libro y respuestas guardadas por order_id"""
+        stored = {'balance_before': 0, 'new_balance': 80, 'previous_tier': 'cafe_bronze',
+                  'current_tier': 'cafe_bronze', 'points': 80}
+        balances = {7: (900, 'cafe_bronze'), 8: (80, 'cafe_bronze')}
+
+        async def fake_query(query, params=None, for_update=False):
+            if "FROM loyalty_users" in query:
+                return [{'user_id': user_id, 'total_points': balances[user_id][0],
+                         'current_tier': balances[user_id][1]}
+                        for user_id in params if user_id in balances]
+            return [{'request_key': key,
+                     'response': json.dumps(stored) if key == request_key("earn", 8, "order-500") else None}
+                    for key in params]
+
+        uow = MagicMock()
+        uow.execute_query = AsyncMock(side_effect=fake_query)
+        # La clave del pedido 500 ya existía: el INSERT IGNORE no la cuenta
+        uow.execute_many = AsyncMock(side_effect=lambda query, rows: len(rows) - ("request_keys" in query))
+        uow.execute_update = AsyncMock(return_value=1)
+        transaction_cm = MagicMock()
+        transaction_cm.return_value.__aenter__ = AsyncMock(return_value=uow)
+        transaction_cm.return_value.__aexit__ = AsyncMock(return_value=False)
+
+        items = [
+            (7, 250, 501, "Compra", None, 25000),
+            (8, 80, 500, "Compra", None, 8000),   # ya abonada
+            (7, 100, 502, "Compra", None, 10000),
+            (7, 250, 501, "Compra", None, 25000),  # repetida en el lote
+            (9, 10, 503, "Compra", None, 1000),    # sin fila en Usuario
+        ]
+        with patch.object(loyalty_service, '_get_config_value', new_callable=AsyncMock, side_effect=[200, 365]), \
+             patch('services.loyalty_service.transaction', transaction_cm), \
+             patch.object(loyalty_service, '_user_written', new_callable=AsyncMock) as written:
+            results = await loyalty_service.earn_points_batch(items)
+
+        assert transaction_cm.call_count == 1
+        assert results[0]['new_balance'] == 1150
+        assert results[0]['tier_status']['new_tier'] == 'cafe_plata'
+        assert results[1]['new_balance'] == 80
+        assert results[2]['new_balance'] == 1250 and 'tier_status' not in results[2]
+        assert results[3] == results[0]
+        assert 'error' in results[4]
+
+        ledger = [call.args[1] for call in uow.execute_many.call_args_list
+                  if "loyalty_transactions" in call.args[0]]
+        assert [(row[0], row[2], row[3], row[5], row[6]) for row in ledger[0]] == [
+            (7, 250, 501, 900, 1150), (7, 100, 502, 1150, 1250)
+        ]
+        written.assert_awaited_once_with(7)
+        assert loyalty_service._earn_result(cache.get(order_request_key(7, 502))) == results[2]
+        store = uow.execute_update.call_args_list[-1].args
+        assert "loyalty_request_keys" in store[0]
+        assert request_key("earn", 8, "order-500") not in store[1]
+        # La clave del usuario inexistente se suelta en la misma transacción
+        release = uow.execute_update.call_args_list[0].args
+        assert release[0].startswith("DELETE FROM loyalty_request_keys")
+        assert release[1] == (order_request_key(9, 503),)
+
+    @pytest.mark.unit
+    async def test_claim_without_response_is_a_conflict(self, loyalty_service):
+        """Una clave existente sin respuesta (operación sin terminar) no se procesa otra vez"""
+        uow = MagicMock()
+        uow.execute_update = AsyncMock(return_value=0)
+        uow.execute_single_query = AsyncMock(return_value={'response': None})
+
+        with pytest.raises(VersionConflict):
+            await loyalty_service._claim_request_key(uow, order_request_key(7, 1), 7)
+        # Lectura con bloqueo: la última respuesta confirmada, no la instantánea
+        assert uow.execute_single_query.call_args.kwargs['for_update'] is True
+
+    @pytest.mark.unit
+    async def test_purchase_claims_key_before_locking_user(self, loyalty_service, cache):
+        """Clave y después usuario: el mismo orden de bloqueo que loyalty_earn_points"""
+        statements = []
+
+        async def record(query, params=None, for_update=False):
+            statements.append(query.strip())
+            return {'total_points': 100, 'current_tier': 'cafe_bronze'} if "loyalty_users" in query else 1
+
+        uow = MagicMock()
+        uow.execute_update = AsyncMock(side_effect=record)
+        uow.execute_single_query = AsyncMock(side_effect=record)
+        uow.execute_insert = AsyncMock(return_value=1)
+        transaction_cm = MagicMock()
+        transaction_cm.return_value.__aenter__ = AsyncMock(return_value=uow)
+        transaction_cm.return_value.__aexit__ = AsyncMock(return_value=False)
+
+        with patch('services.loyalty_service.transaction', transaction_cm), \
+             patch.object(loyalty_service, '_user_written', new_callable=AsyncMock):
+            result = await loyalty_service.earn_points_from_purchase(7, 5000, 123)
+
+        assert result['status'] == 'success'
+        assert statements[0].startswith("INSERT IGNORE INTO loyalty_request_keys")
+        assert statements[1].startswith("SELECT total_points, current_tier FROM loyalty_users")
@@ -0,0 +1,177 @@
+"""
+Tests unitarios para el libro de puntos diferido (write-behind)
+"""
+
+import os
+import pytest
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from services import ledger_buffer as ledger_module
+from services.ledger_buffer import LedgerBuffer, LedgerEntry
+
+
+def fake_transaction(uow):
+    """Sustituto de utils.database.transaction que entrega `uow`"""
+    @asynccontextmanager
+    async def _transaction():
+        yield uow
+    return _transaction
+
+
+def make_uow(balances):
+    """UnitOfWork simulado con saldos {user_id: (puntos, nivel)}"""
+    uow = MagicMock()
+    uow.execute_query = AsyncMock(return_value=[
+        {"user_id": user_id, "total_points": points, "current_tier": tier}
+        for user_id, (points, tier) in sorted(balances.items())
+    ])
+    uow.execute_many = AsyncMock(side_effect=lambda query, rows: len(rows))
+    uow.execute_update = AsyncMock(return_value=len(balances))
+    return uow
+
+
+@pytest.fixture
+def no_invalidation():
+    """Evitar la invalidación real de caché tras confirmar"""
+    with patch.object(ledger_module.cache_manager, "invalidate", AsyncMock()) as invalidate:
+        yield invalidate
+
+
+class TestLedgerBuffer:
+    """Tests de encolado y confirmación en grupo"""
+
+    @pytest.mark.unit
+    def test_add_rejected_when_not_running(self):
+        """Sin tarea de fondo el llamador debe escribir en línea"""
+        buffer = LedgerBuffer(flush_interval_ms=50, max_rows=10, max_pending=10)
+        assert buffer.add(LedgerEntry(1, "earn", 10, None, "compra")) is False
+        assert buffer.stats()["rejected"] == 1
+
+    @pytest.mark.unit
+    async def test_flush_groups_rows_in_one_transaction(self, no_invalidation):
+        """Varias acumulaciones: un INSERT multi-fila y un UPDATE agregado"""
+        buffer = LedgerBuffer(flush_interval_ms=60000, max_rows=100, max_pending=100)
+        await buffer.start()
+        try:
+            assert buffer.add(LedgerEntry(1, "earn", 10, None, "a", product_bits=0b01, amount=1000))
+            assert buffer.add(LedgerEntry(2, "earn", 5, None, "b"))
+            assert buffer.add(LedgerEntry(1, "earn", 20, None, "c", product_bits=0b10, amount=2000))
+            assert buffer.pending_delta(1) == 30
+
+            uow = make_uow({1: (100, "cafe_bronze"), 2: (0, "cafe_bronze")})
+            with patch.object(ledger_module, "transaction", fake_transaction(uow)):
+                assert await buffer.flush() == 3
+        finally:
+            await buffer.stop()
+
+        uow.execute_many.assert_awaited_once()
+        rows = uow.execute_many.await_args.args[1]
+        # Saldos encadenados por usuario en el orden de llegada
+        assert [(row[0], row[5], row[6]) for row in rows] == [(1, 100, 110), (2, 0, 5), (1, 110, 130)]
+
+        uow.execute_update.assert_awaited_once()
+        params = uow.execute_update.await_args.args[1]
+        assert params[:4] == (1, 30, 2, 5)          # delta de puntos
+        assert params[4:8] == (1, 2, 2, 1)          # visitas
+        assert params[8:12] == (1, 0b11, 2, 0)      # bits de producto
+        assert params[16:20] == (1, 3000, 2, 0)     # total gastado
+        assert params[-2:] == (1, 2)
+        assert buffer.pending_delta(1) == 0
+        no_invalidation.assert_awaited_once_with("users", [1, 2])
+
+    @pytest.mark.unit
+    async def test_pending_delta_counts_batch_until_cache_invalidated(self, no_invalidation):
+        """Mientras un grupo se confirma su delta sigue sumando al saldo cacheado"""
+        buffer = LedgerBuffer(flush_interval_ms=60000, max_rows=100, max_pending=100)
+        await buffer.start()
+        try:
+            buffer.add(LedgerEntry(1, "earn", 10, None, "a"))
+            buffer.add(LedgerEntry(1, "earn", 5, None, "b"))
+
+            seen = []
+            uow = make_uow({1: (100, "cafe_bronze")})
+            uow.execute_update.side_effect = lambda *args: seen.append(buffer.pending_delta(1)) or 1
+            no_invalidation.side_effect = lambda *args: seen.append(buffer.pending_delta(1))
+            with patch.object(ledger_module, "transaction", fake_transaction(uow)):
+                await buffer.flush()
+        finally:
+            await buffer.stop()
+
+        # Durante el UPDATE y durante la invalidación de la caché
+        assert seen == [15, 15]
+        assert buffer.pending_delta(1) == 0
+
+    @pytest.mark.unit
+    async def test_failed_flush_requeues_batch(self, no_invalidation):
+        """Si la transacción falla las entradas vuelven a la cola"""
+        buffer = LedgerBuffer(flush_interval_ms=60000, max_rows=100, max_pending=100)
+        await buffer.start()
+        buffer.add(LedgerEntry(1, "earn", 10, None, "a"))
+
+        uow = make_uow({1: (0, "cafe_bronze")})
+        uow.execute_many.side_effect = RuntimeError("deadlock")
+        with patch.object(ledger_module, "transaction", fake_transaction(uow)):
+            with pytest.raises(RuntimeError):
+                await buffer.flush()
+
+        assert buffer.stats()["pending"] == 1
+        assert buffer.pending_delta(1) == 10
+
+        with patch.object(ledger_module, "transaction", fake_transaction(make_uow({1: (0, "cafe_bronze")}))):
+            await buffer.stop()
+        assert buffer.stats()["pending"] == 0
+
+    @pytest.mark.unit
+    async def test_cancelled_flush_still_finishes_batch(self, tmp_path, no_invalidation):
+        """Cancelar flush() durante el COMMIT no devuelve el grupo a la cola ni deja su segmento"""
+        import asyncio
+
+        buffer = LedgerBuffer(flush_interval_ms=60000, max_rows=100, max_pending=100, spool_dir=str(tmp_path))
+        await buffer.start()
+        buffer.add(LedgerEntry(1, "earn", 10, None, "a"))
+
+        release = asyncio.Event()
+
+        async def slow_update(*args):
+            await release.wait()
+            return 1
+
+        uow = make_uow({1: (0, "cafe_bronze")})
+        uow.execute_update.side_effect = slow_update
+        with patch.object(ledger_module, "transaction", fake_transaction(uow)):
+            flushing = asyncio.create_task(buffer.flush())
+            while buffer.commit_sequence % 2 == 0:
+                await asyncio.sleep(0)
+            flushing.cancel()
+            release.set()
+            with pytest.raises(asyncio.CancelledError):
+                await flushing
+            await buffer.stop()
+
+        assert buffer.stats()["pending"] == 0
+        assert buffer.commit_sequence % 2 == 0
+        uow.execute_many.assert_awaited_once()
+        # El segmento del grupo se borró: al arrancar no se repite
+        assert os.listdir(tmp_path) == [f"ledger-{os.getpid()}.spool"]
+
+    @pytest.mark.unit
+    async def test_spool_replayed_on_start(self, tmp_path, no_invalidation):
+        """Lo pendiente de un worker caído se recupera al arrancar"""
+        dead_pid = 2 ** 22 + 1  # Fuera del rango habitual de PIDs
+        with open(tmp_path / f"ledger-{dead_pid}.spool", "w", encoding="utf-8") as spool:
+            spool.write(LedgerEntry(7, "earn", 15, 99, "compra").to_json() + "\n")
+
+        buffer = LedgerBuffer(flush_interval_ms=60000, max_rows=100, max_pending=100, spool_dir=str(tmp_path))
+        with patch.object(ledger_module, "_pid_alive", return_value=False):
+            await buffer.start()
+        assert buffer.stats()["replayed"] == 1
+        assert buffer.pending_delta(7) == 15
+
+        uow = make_uow({7: (0, "cafe_bronze")})
+        with patch.object(ledger_module, "transaction", fake_transaction(uow)):
+            await buffer.stop()
+
+        assert uow.execute_many.await_args.args[1][0][:4] == (7, "earn", 15, 99)
+        # Confirmado el grupo solo queda el spool activo (vacío) del worker
+        assert os.listdir(tmp_path) == [f"ledger-{os.getpid()}.spool"]
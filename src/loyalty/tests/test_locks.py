@@ -0,0 +1,58 @@
+"""
+Tests unitarios para los locks por usuario y los reintentos optimistas
+"""
+
+import asyncio
+import pytest
+
+from utils.locks import StripedLock, VersionConflict, retry_on_conflict
+
+
+class TestStripedLock:
+    """Tests de la tabla de locks por franjas"""
+
+    @pytest.mark.unit
+    async def test_same_key_serialized_other_keys_not_blocked(self):
+        """Un usuario espera a su propia petición anterior, no a las de otros"""
+        locks = StripedLock(64)
+        order = []
+
+        async def hold(key, label, delay):
+            async with locks(key):
+                order.append(f"{label}:in")
+                await asyncio.sleep(delay)
+                order.append(f"{label}:out")
+
+        first = asyncio.create_task(hold(1, "a", 0.02))
+        await asyncio.sleep(0)
+        await asyncio.gather(hold(1, "b", 0), hold(2, "c", 0), first)
+
+        # c (otra franja) entra mientras a está dentro; b (mismo usuario) después de a
+        assert order.index("c:in") < order.index("a:out")
+        assert order.index("b:in") > order.index("a:out")
+        assert locks.stats()["contended"] == 1
+
+
+class TestRetryOnConflict:
+    """Tests de reintentos ante conflictos de versión"""
+
+    @pytest.mark.unit
+    async def test_retries_until_success(self):
+        attempts = []
+
+        async def operation():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise VersionConflict("cambió")
+            return "ok"
+
+        assert await retry_on_conflict(operation, retries=5, base_delay=0) == "ok"
+        assert len(attempts) == 3
+
+    @pytest.mark.unit
+    async def test_gives_up_after_retries(self):
+        async def operation():
+            raise VersionConflict("siempre cambia")
+
+        with pytest.raises(VersionConflict):
+            await retry_on_conflict(operation, retries=3, base_delay=0)
@@ -315,4 +315,151 @@ class TestLoyaltyEngine:
         # Canje inválido - nivel insuficiente
         assert loyalty_service._validate_reward_redemption(
             user_points, reward_cost, 'cafe_bronze', 'cafe_oro'
-        ) == False 
\ No newline at end of file
+        ) == False 
+
+class TestScoreBatch:
+    """Tests del scoring vectorizado por columnas"""
+    
+    @pytest.fixture
+    def engine(self):
+        """Instancia del motor para tests"""
+        from services.loyalty_engine import LoyaltyEngine
+        return LoyaltyEngine()
+    
+    @pytest.mark.unit
+    def test_score_batch_matches_scalar_rules(self, engine):
+        """Cada componente y el total coinciden con las funciones escalares"""
+        from services.scoring_model import SCORE_COMPONENTS
+        
+        now = datetime(2024, 6, 1, 12, 0, 0)
+        users = [
+            # visitas, días, gastado, última visita, productos, referidos
+            (0, 30, 0, None, 0, 0),
+            (10, 30, 5000, now - timedelta(hours=20), 3, 2),
+            (50, 10, 25000, now - timedelta(days=5), 12, 7),
+            (3, 0, 150.5, now - timedelta(days=29, hours=23), 1, 0),
+            (8, 400, 900, now - timedelta(days=90), 5, 1),
+            (1, 365, 99, now - timedelta(days=400), 2, 0),
+        ]
+        columns = list(zip(*users))
+        
+        result = engine.score_batch(*columns, now=now)
+        
+        with patch('services.loyalty_engine.datetime') as mock_datetime:
+            mock_datetime.now.return_value = now
+            for i, (visits, days, spent, last_visit, products, referrals) in enumerate(users):
+                expected = {
+                    'frequency': engine._calculate_frequency_score(visits, days),
+                    'amount': engine._calculate_amount_score(spent),
+                    'recency': engine._calculate_recency_score(last_visit),
+                    'variety': engine._calculate_variety_score([f"p{n}" for n in range(products)]),
+                    'referral': engine._calculate_referral_score(referrals),
+                }
+                for component, value in expected.items():
+                    assert result[component][i] == pytest.approx(value, abs=0.01)
+                
+                total = engine.scoring_model.combine([expected[name] for name in SCORE_COMPONENTS])
+                assert result['total'][i] == pytest.approx(round(total, 2), abs=0.01)
+    
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_rescore_all_users_writes_one_update_per_chunk(self):
+        """El recálculo nocturno escribe cada bloque con un solo UPDATE"""
+        from services.loyalty_engine import product_sketch
+        from services.loyalty_service import LoyaltyService
+        
+        now = datetime(2024, 6, 1)
+        rows = [
+            {
+                'user_id': user_id, 'total_visits': user_id, 'join_date': now - timedelta(days=30),
+                'total_spent': 100 * user_id, 'last_visit': now - timedelta(days=2),
+                'referral_count': 3 if user_id == 1 else 0, 'product_sketch': product_sketch(["café", "té"])
+            }
+            for user_id in range(1, 6)
+        ]
+        
+        async def fake_stream(query, params=None, chunk_size=None, use_primary=False):
+            for start in range(0, len(rows), chunk_size):
+                yield rows[start:start + chunk_size]
+        
+        service = LoyaltyService()
+        with patch('services.loyalty_service.stream_query', new=fake_stream), \
+             patch('services.loyalty_service.execute_update', new_callable=AsyncMock, return_value=2) as mock_update:
+            processed = await service.rescore_all_users(chunk_size=2, now=now)
+        
+        assert processed == 5
+        assert mock_update.await_count == 3
+        first_query, first_params = mock_update.call_args_list[0].args
+        assert first_query.count("WHEN %s THEN %s") == 2
+        assert first_params[0] == 1 and first_params[-2:] == (1, 2)
+
+
+class TestScoreState:
+    """Tests del score a partir del estado incremental del usuario"""
+    
+    @pytest.fixture
+    def engine(self):
+        """Instancia del motor para tests"""
+        from services.loyalty_engine import LoyaltyEngine
+        return LoyaltyEngine()
+    
+    @pytest.mark.unit
+    def test_product_sketch_counts_distinct_products(self):
+        """El bitmap ignora repetidos y estima bien pocos productos"""
+        from services.loyalty_engine import estimate_distinct_products, product_sketch
+        
+        assert product_sketch(None) == 0
+        assert estimate_distinct_products(0) == 0
+        assert product_sketch(["café", "té", "café"]) == product_sketch(["té", "café"])
+        assert estimate_distinct_products(product_sketch(["café", "té", "café"])) == 2
+        # Acumulable con OR, como hace el UPDATE en cada compra
+        assert product_sketch(["café"]) | product_sketch(["té"]) == product_sketch(["café", "té"])
+        for count in range(1, 9):
+            sketch = product_sketch([f"p{n}" for n in range(count)])
+            assert estimate_distinct_products(sketch) == count
+    
+    @pytest.mark.unit
+    def test_score_from_state_matches_batch(self, engine):
+        """El score por estado coincide con el recálculo vectorizado"""
+        from services.loyalty_engine import estimate_distinct_products, product_sketch
+        from models.loyalty_models import LoyaltyUser
+        
+        now = datetime(2024, 6, 1, 12, 0, 0)
+        user = LoyaltyUser(
+            user_id=1, total_visits=12, total_spent=4500.0,
+            join_date=now - timedelta(days=40), last_visit=now - timedelta(days=3),
+            referral_count=2, product_sketch=product_sketch(["café", "té", "pastel"])
+        )
+        
+        score = engine.score_from_state(user, now)
+        batch = engine.score_batch(
+            [12], [40], [4500.0], [now - timedelta(days=3)],
+            [estimate_distinct_products(user.product_sketch)], [2], now=now
+        )
+        
+        assert score['variety'] == 30
+        assert score['recency'] == 80
+        for component in ('frequency', 'amount', 'recency', 'variety', 'referral', 'total'):
+            assert score[component] == pytest.approx(batch[component][0], abs=0.01)
+        # Un dict (p.ej. model_dump) produce el mismo resultado
+        assert engine.score_from_state(user.model_dump(), now) == score
+    
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_calculate_user_score_reads_only_user_row(self):
+        """El score de un usuario en caché no lanza consultas"""
+        from services.loyalty_service import LoyaltyService
+        
+        now = datetime.now()
+        row = (1, 500, 'cafe_bronze', now - timedelta(days=30), now, 6, 2500, 1, 0, now, now,
+               0.0, None, 'ABCD1234', None, None)
+        service = LoyaltyService()
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=row) as mock_row, \
+             patch('services.loyalty_service.execute_single_query', new_callable=AsyncMock) as mock_query:
+            first = await service.calculate_user_score(1)
+            second = await service.calculate_user_score(1)
+        
+        assert first == second > 0
+        mock_row.assert_awaited_once()
+        mock_query.assert_not_awaited()
@@ -0,0 +1,76 @@
+"""
+Tests unitarios para la paginación por clave (keyset)
+"""
+
+import pytest
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from utils.pagination import InvalidCursorError, decode_cursor, encode_cursor, next_cursor
+
+
+class TestCursor:
+    """Tests de los cursores opacos"""
+
+    @pytest.mark.unit
+    def test_round_trip(self):
+        created_at = datetime(2024, 5, 1, 12, 30, 15, 123456)
+        cursor = encode_cursor(created_at, 987)
+        assert "=" not in cursor
+        assert decode_cursor(cursor) == (created_at, 987)
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize("cursor", ["", "no-es-un-cursor", "WzFd", "bnVsbA"])
+    def test_invalid_cursor_rejected(self, cursor):
+        with pytest.raises(InvalidCursorError):
+            decode_cursor(cursor)
+
+    @pytest.mark.unit
+    def test_next_cursor_only_for_full_pages(self):
+        rows = [{"id": i, "created_at": datetime(2024, 1, 10 - i)} for i in range(3)]
+        key = lambda row: (row["created_at"], row["id"])
+
+        assert next_cursor(rows, 5, key) is None
+        assert decode_cursor(next_cursor(rows, 3, key)) == (datetime(2024, 1, 8), 2)
+
+
+class TestKeysetQueries:
+    """Tests de las consultas paginadas del servicio"""
+
+    @pytest.mark.unit
+    async def test_transactions_page_uses_keyset_not_offset(self, loyalty_service):
+        """Con cursor la consulta filtra por (created_at, id) y no usa OFFSET"""
+        cursor = encode_cursor(datetime(2024, 3, 1, 9, 0), 500)
+
+        with patch.object(loyalty_service, "get_user_by_usuario_id", AsyncMock(return_value=MagicMock(user_id=7))), \
+             patch("services.loyalty_service.execute_query", AsyncMock(return_value=[])) as mock_query:
+            await loyalty_service.get_user_transactions(7, skip=990, limit=10, cursor=cursor)
+
+        query, params = mock_query.call_args.args
+        assert "OFFSET" not in query
+        assert "ORDER BY created_at DESC, id DESC" in query
+        assert params == (7, datetime(2024, 3, 1, 9, 0), datetime(2024, 3, 1, 9, 0), 500, 10)
+
+    @pytest.mark.unit
+    async def test_page_parameter_still_supported(self, loyalty_service):
+        """Sin cursor se mantiene la paginación por página (OFFSET)"""
+        with patch.object(loyalty_service, "get_user_by_usuario_id", AsyncMock(return_value=MagicMock(user_id=7))), \
+             patch("services.loyalty_service.execute_query", AsyncMock(return_value=[])) as mock_query:
+            await loyalty_service.get_user_transactions(7, skip=20, limit=10)
+
+        query, params = mock_query.call_args.args
+        assert "OFFSET" in query
+        assert params == (7, 10, 20)
+
+    @pytest.mark.unit
+    async def test_coupons_return_next_cursor(self, loyalty_service):
+        """Una página llena de cupones trae el cursor de la siguiente; la última no"""
+        rows = [{"id": 9 - i, "created_at": datetime(2024, 3, 9 - i)} for i in range(2)]
+
+        with patch("services.loyalty_service.execute_query", AsyncMock(return_value=rows)):
+            coupons, cursor = await loyalty_service.get_all_coupons(limit=2)
+            assert coupons == rows
+            assert decode_cursor(cursor) == (datetime(2024, 3, 8), 8)
+
+            _, last = await loyalty_service.get_all_coupons(limit=5, cursor=cursor)
+            assert last is None
@@ -5,6 +5,7 @@ Tests de rendimiento para el sistema de fidelización
 import pytest
 import asyncio
 import time
+from contextlib import asynccontextmanager
 from unittest.mock import AsyncMock, patch
 from datetime import datetime, timedelta
 
@@ -272,4 +273,355 @@ class TestPerformance:
         
         # La segunda consulta debe ser más rápida
         assert second_query_time < first_query_time
-        assert second_query_time < 0.01  # Menos de 10ms con caché 
\ No newline at end of file
+        assert second_query_time < 0.01  # Menos de 10ms con caché
+    
+    @pytest.mark.performance
+    @pytest.mark.slow
+    def test_user_row_mapping_fast_path(self, loyalty_service):
+        """Micro-benchmark: tupla + model_construct frente a dict + validación Pydantic"""
+        from decimal import Decimal
+        from services.loyalty_service import USER_COLUMNS, _user_from_row
+        
+        now = datetime.now()
+        row = (1, 1500, 'cafe_plata', now, now, 12, Decimal('45990.00'), 2, 5, now, now,
+               Decimal('72.50'), '["café"]', 'ABCD1234', 'WXYZ9876', now)
+        dict_row = dict(zip(USER_COLUMNS, row))
+        iterations = 5000
+        
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            slow_user = loyalty_service._map_db_result_to_loyalty_user(dict_row)
+        slow_time = time.perf_counter() - start_time
+        
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            fast_user = _user_from_row(row)
+        fast_time = time.perf_counter() - start_time
+        
+        print(f"\nMapeo de usuario: validado {slow_time / iterations * 1e6:.2f} µs/fila, "
+              f"rápido {fast_time / iterations * 1e6:.2f} µs/fila")
+        
+        # Mismo resultado que la ruta validada
+        assert fast_user.model_dump() == slow_user.model_dump()
+        assert isinstance(fast_user.total_spent, float)
+        assert fast_user.score == 72.5 and fast_user.referral_code == 'ABCD1234'
+        assert fast_user.current_tier == 'cafe_plata'
+        assert fast_time < slow_time
+
+    @pytest.mark.asyncio
+    @pytest.mark.performance
+    async def test_profile_single_round_trip(self):
+        """Objetivo: un viaje a la base de datos por perfil"""
+        from decimal import Decimal
+        from routes import loyalty_routes
+
+        now = datetime.now()
+        row = (7, 1500, 'cafe_plata', now, now, 12, Decimal('45990.00'), 2, 5, now, now,
+               72.5, None, 'ABCD1234', None, now, 'Ana', 'Pérez', 3)
+
+        with patch('services.loyalty_service.execute_single_row', new_callable=AsyncMock,
+                   return_value=row) as mock_row, \
+             patch('services.loyalty_service.execute_single_query', new_callable=AsyncMock) as mock_single, \
+             patch('services.loyalty_service.execute_query', new_callable=AsyncMock) as mock_query:
+            response = await loyalty_routes.get_user_profile(7)
+
+        assert mock_row.await_count == 1
+        mock_single.assert_not_awaited()
+        mock_query.assert_not_awaited()
+        assert "JOIN Usuario" in mock_row.call_args.args[0]
+        data = response.data
+        assert data.user_name == "Ana Pérez"
+        assert data.rewards_redeemed == 3
+        assert data.current_benefits == loyalty_routes.TIER_BENEFITS["cafe_plata"]
+
+    @pytest.mark.asyncio
+    @pytest.mark.performance
+    async def test_batch_read_runs_subrequests_in_parallel(self):
+        """Objetivo: /batch tarda lo que la subpetición más lenta, no la suma"""
+        import json
+        from fastapi import Response
+        from routes import loyalty_routes
+
+        catalog = b'{"success":true,"data":[{"id":1}]}'
+
+        async def slow(body):
+            await asyncio.sleep(0.05)
+            return body
+
+        request = loyalty_routes.BatchRequest(requests=[
+            {"op": "profile", "user_id": 7}, {"op": "rewards"}, {"op": "transactions", "user_id": 7}
+        ])
+        with patch.object(loyalty_routes, 'get_user_profile',
+                          side_effect=lambda user_id: slow({"success": True, "data": {"user_id": user_id}})), \
+             patch.object(loyalty_routes, 'get_available_rewards',
+                          side_effect=lambda etag: slow(Response(content=catalog, media_type="application/json"))), \
+             patch.object(loyalty_routes, 'get_user_transactions_api',
+                          side_effect=lambda user_id, page, cursor: slow({"success": True, "data": []})):
+            start_time = time.perf_counter()
+            response = await loyalty_routes.batch_read_api(request)
+            elapsed = time.perf_counter() - start_time
+
+        assert elapsed < 0.12
+        assert catalog in response.body  # el catálogo ya serializado va tal cual
+        body = json.loads(response.body)
+        assert body["success"] is True
+        assert [result["data"] for result in body["results"]] == [{"user_id": 7}, [{"id": 1}], []]
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_batch_read_isolates_failed_subrequest(self):
+        """Un 503 en una subpetición queda en su elemento; las demás responden"""
+        import json
+        from fastapi import HTTPException
+        from routes import loyalty_routes
+
+        async def overloaded(user_id):
+            raise HTTPException(status_code=503, detail="Servicio saturado")
+
+        request = loyalty_routes.BatchRequest(requests=[
+            {"op": "profile", "user_id": 7}, {"op": "transactions", "user_id": 7}, {"op": "profile"}
+        ])
+        with patch.object(loyalty_routes, 'get_user_profile', side_effect=overloaded), \
+             patch.object(loyalty_routes, 'get_user_transactions_api', new_callable=AsyncMock,
+                          return_value={"success": True, "data": []}):
+            response = await loyalty_routes.batch_read_api(request)
+
+        results = json.loads(response.body)["results"]
+        assert results[0] == {"success": False, "message": "Servicio saturado", "status": 503}
+        assert results[1] == {"success": True, "data": []}
+        assert results[2]["status"] == 400
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_batch_read_concurrency_bounded_by_pool(self):
+        """Un lote grande no tiene más subpeticiones en vuelo que conexiones el pool"""
+        from config import settings
+        from routes import loyalty_routes
+
+        in_flight = peak = 0
+
+        async def profile(user_id):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            return {"success": True, "data": {"user_id": user_id}}
+
+        request = loyalty_routes.BatchRequest(requests=[{"op": "profile", "user_id": i} for i in range(20)])
+        with patch.object(loyalty_routes, 'get_user_profile', side_effect=profile), \
+             patch.object(settings, "DB_POOL_MAX_SIZE", 3):
+            await loyalty_routes.batch_read_api(request)
+
+        assert peak == 3
+
+    @pytest.mark.performance
+    @pytest.mark.slow
+    def test_response_serialization_fast_path(self):
+        """Micro-benchmark: jsonable_encoder + json.dumps frente a serialización en una pasada"""
+        import json
+        from fastapi.encoders import jsonable_encoder
+        from models.response_models import (
+            ProfileData, ProfileResponse, TransactionItem, TransactionsPageResponse
+        )
+        from utils.serialization import dumps
+
+        now = datetime.now()
+        profile = ProfileResponse.model_construct(data=ProfileData.model_construct(
+            user_name="Ana Pérez", current_points=1500, total_points=1500, current_tier="cafe_plata",
+            score=72.5, progress_percentage=37.5, next_tier="cafe_oro", points_to_next_tier=2500,
+            current_benefits=["1.2 puntos por cada $1 gastado", "Descuento del 10% en cumpleaños"],
+            next_benefits=["1.5 puntos por cada $1 gastado", "Envío gratis"],
+            join_date="2024-01-01", last_visit="2024-06-01 10:00:00", total_visits=12,
+            total_spent=45990.0, rewards_redeemed=3
+        ))
+        rows = [
+            {'id': 1000 - i, 'user_id': 7, 'transaction_type': 'earn', 'points_amount': 50,
+             'order_id': 5000 + i, 'description': f'Compra #{5000 + i}', 'balance_before': 100 * i,
+             'balance_after': 100 * i + 50, 'created_at': now - timedelta(hours=i)}
+            for i in range(50)
+        ]
+        page = TransactionsPageResponse.model_construct(
+            data=[TransactionItem.model_construct(**row) for row in rows], next_cursor="abc"
+        )
+        payloads = [profile, page, {"success": True, "data": rows, "next_cursor": "abc"}]
+        iterations = 500
+
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            slow = [json.dumps(jsonable_encoder(payload)).encode() for payload in payloads]
+        slow_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            fast = [dumps(payload) for payload in payloads]
+        fast_time = time.perf_counter() - start_time
+
+        print(f"\nSerialización: jsonable_encoder {slow_time / iterations * 1e3:.3f} ms/lote, "
+              f"una pasada {fast_time / iterations * 1e3:.3f} ms/lote")
+
+        # Mismo JSON (salvo formato) por ambos caminos
+        assert [json.loads(body) for body in fast] == [json.loads(body) for body in slow]
+        assert fast_time < slow_time
+
+    @pytest.mark.performance
+    @pytest.mark.slow
+    def test_scoring_model_per_user_cost(self):
+        """Micro-benchmark: escalera de recencia y pesos fijos frente al modelo precompilado"""
+        import numpy as np
+        from services.loyalty_engine import LoyaltyEngine
+        
+        engine = LoyaltyEngine()
+        now = datetime.now()
+        users = [
+            {'total_visits': i % 40, 'join_date': now - timedelta(days=30 + i % 300),
+             'total_spent': 150.0 * (i % 90), 'last_visit': now - timedelta(days=i % 120),
+             'product_sketch': i * 2654435761 % (1 << 64), 'referral_count': i % 6}
+            for i in range(2000)
+        ]
+        
+        def legacy_score(user):
+            days = (now - user['last_visit']).days
+            if days <= 1:
+                recency = 100
+            elif days <= 7:
+                recency = 80
+            elif days <= 30:
+                recency = 45
+            elif days <= 90:
+                recency = 20
+            else:
+                recency = 0
+            frequency = engine._calculate_frequency_score(user['total_visits'], (now - user['join_date']).days)
+            amount = engine._calculate_amount_score(user['total_spent'])
+            variety = min(bin(user['product_sketch']).count("1") * 10, 100)
+            referral = engine._calculate_referral_score(user['referral_count'])
+            return round(frequency * 0.3 + amount * 0.3 + recency * 0.2 + variety * 0.1 + referral * 0.1, 2)
+        
+        start_time = time.perf_counter()
+        legacy = [legacy_score(user) for user in users]
+        legacy_time = time.perf_counter() - start_time
+        
+        start_time = time.perf_counter()
+        scalar = [engine.score_from_state(user, now)['total'] for user in users]
+        scalar_time = time.perf_counter() - start_time
+        
+        start_time = time.perf_counter()
+        batch = engine.score_batch(
+            [u['total_visits'] for u in users], [(now - u['join_date']).days for u in users],
+            [u['total_spent'] for u in users], [u['last_visit'] for u in users],
+            [bin(u['product_sketch']).count("1") for u in users],
+            [u['referral_count'] for u in users], now=now
+        )
+        batch_time = time.perf_counter() - start_time
+        
+        print(f"\nScore por usuario: anterior {legacy_time / len(users) * 1e6:.2f} µs, "
+              f"modelo escalar {scalar_time / len(users) * 1e6:.2f} µs, "
+              f"modelo vectorizado {batch_time / len(users) * 1e6:.2f} µs")
+        
+        assert len(legacy) == len(scalar) == len(batch['total'])
+        assert all(0 <= score <= 100 for score in scalar)
+        assert np.all((batch['total'] >= 0) & (batch['total'] <= 100))
+
+
+class _BalanceStore:
+    """
+    Fila de loyalty_users en memoria con la semántica del UPDATE condicional
+    por balance_version. Cada sentencia cede el event loop para que las
+    operaciones concurrentes se intercalen como en la base de datos.
+    """
+
+    def __init__(self, points: int):
+        self.row = {
+            "user_id": 1, "total_points": points, "current_tier": "cafe_oro", "balance_version": 0
+        }
+        self.reward = {
+            "id": 1, "name": "Café gratis", "description": "Un café", "points_cost": 10,
+            "discount_percent": 0.0, "tier_required": "cafe_bronze", "active": True
+        }
+        self.ledger = []
+        self.conflicts = 0
+
+    async def execute_single_query(self, query, params=None, for_update=False):
+        await asyncio.sleep(0)
+        return dict(self.reward if "loyalty_rewards" in query else self.row)
+
+    async def execute_update(self, query, params=None):
+        await asyncio.sleep(0)
+        if params[-1] != self.row["balance_version"]:
+            self.conflicts += 1
+            return 0
+        self.row["total_points"] = params[0]
+        self.row["balance_version"] += 1
+        return 1
+
+    async def execute_insert(self, query, params=None):
+        await asyncio.sleep(0)
+        if "loyalty_transactions" in query:
+            self.ledger.append(params)
+        return len(self.ledger)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+
+class TestBalanceConcurrency:
+    """Benchmark de canjes concurrentes sobre el mismo usuario"""
+
+    @pytest.fixture
+    def loyalty_service(self):
+        from services.loyalty_service import LoyaltyService
+        service = LoyaltyService()
+        with patch.object(service, "_user_written", AsyncMock()):
+            yield service
+
+    @pytest.mark.performance
+    @pytest.mark.slow
+    async def test_no_lost_updates_at_high_parallelism(self, loyalty_service):
+        """500 canjes simultáneos del mismo usuario en un worker: saldo exacto sin conflictos"""
+        from utils.locks import StripedLock
+
+        store = _BalanceStore(points=10 * 500)
+
+        # Tabla de locks nueva: los asyncio.Lock quedan ligados al event loop del test
+        with patch("services.loyalty_service.transaction", store.transaction), \
+             patch("services.loyalty_service.user_locks", StripedLock(1024)):
+            start = time.perf_counter()
+            results = await asyncio.gather(*(loyalty_service.redeem_reward(1, 1) for _ in range(500)))
+            elapsed = time.perf_counter() - start
+
+        print(f"\n500 canjes concurrentes: {elapsed * 1000:.1f} ms, conflictos {store.conflicts}")
+        assert store.row["total_points"] == 0
+        assert store.row["balance_version"] == 500
+        assert len(store.ledger) == 500
+        # El lock por usuario serializa: ningún UPDATE condicional falla
+        assert store.conflicts == 0
+        # Cada canje vio el saldo que dejó el anterior
+        assert sorted(r["new_total_points"] for r in results) == list(range(0, 5000, 10))
+
+    @pytest.mark.performance
+    @pytest.mark.slow
+    async def test_no_lost_updates_across_workers(self, loyalty_service):
+        """Cuatro workers (locks independientes): la versión detecta las carreras y se reintenta"""
+        from config import settings
+        from utils.locks import StripedLock
+
+        store = _BalanceStore(points=10 * 200)
+        worker_locks = [StripedLock(16) for _ in range(4)]
+
+        def locks_of_current_worker(key):
+            return worker_locks[int(asyncio.current_task().get_name())](key)
+
+        with patch("services.loyalty_service.transaction", store.transaction), \
+             patch("services.loyalty_service.user_locks", locks_of_current_worker), \
+             patch.object(settings, "BALANCE_CAS_MAX_RETRIES", 20), \
+             patch.object(settings, "BALANCE_CAS_RETRY_DELAY", 0.0001):
+            tasks = [asyncio.create_task(loyalty_service.redeem_reward(1, 1), name=str(i % 4)) for i in range(200)]
+            results = await asyncio.gather(*tasks)
+
+        print(f"\n200 canjes en 4 workers: conflictos reintentados {store.conflicts}")
+        assert store.row["total_points"] == 0
+        assert len(store.ledger) == 200
+        assert store.conflicts > 0
+        assert sorted(r["new_total_points"] for r in results) == list(range(0, 2000, 10))
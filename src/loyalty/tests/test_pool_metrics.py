@@ -0,0 +1,43 @@
+"""
+Tests unitarios para las métricas del pool de conexiones
+"""
+
+import pytest
+from types import SimpleNamespace
+
+from utils.pool_metrics import LatencyHistogram, PoolMetrics
+
+
+class TestPoolMetrics:
+    """Tests para histogramas y gauges del pool"""
+
+    @pytest.mark.unit
+    def test_histogram_cumulative_buckets(self):
+        """Las cubetas del histograma son acumulativas"""
+        histogram = LatencyHistogram(buckets=(0.01, 0.1, 1.0))
+        for value in (0.005, 0.05, 0.05, 0.5, 2.0):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+        assert snapshot["count"] == 5
+        assert snapshot["buckets"] == {"le_0.01": 1, "le_0.1": 3, "le_1.0": 4, "le_inf": 5}
+        assert snapshot["max_ms"] == 2000.0
+
+    @pytest.mark.unit
+    def test_in_use_gauge_and_pool_sizes(self):
+        """El gauge de conexiones en uso sube y baja con acquire/release"""
+        metrics = PoolMetrics()
+        metrics.record_acquire(0.002)
+        metrics.record_acquire(0.004)
+        metrics.record_release()
+        metrics.record_timeout()
+
+        pool = SimpleNamespace(size=3, freesize=2, minsize=1, maxsize=5)
+        snapshot = metrics.snapshot(pool)
+
+        assert snapshot["in_use"] == 1
+        assert snapshot["max_in_use"] == 2
+        assert snapshot["acquires"] == 2
+        assert snapshot["acquire_timeouts"] == 1
+        assert snapshot["free"] == 2
+        assert snapshot["max_size"] == 5
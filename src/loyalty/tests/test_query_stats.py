@@ -0,0 +1,89 @@
+"""
+Tests unitarios para las estadísticas por sentencia SQL
+"""
+
+import logging
+import pytest
+
+from utils.query_stats import QueryStats, fingerprint
+
+
+class TestQueryStats:
+    """Tests para huellas, percentiles y log de consultas lentas"""
+
+    @pytest.mark.unit
+    def test_fingerprint_normalizes_literals_and_lists(self):
+        """Literales, placeholders y listas de valores se normalizan"""
+        assert fingerprint("SELECT *  FROM loyalty_users\n WHERE user_id = %s") == \
+            "SELECT * FROM loyalty_users WHERE user_id = ?"
+        assert fingerprint("SELECT * FROM t WHERE tier = 'cafe_oro' AND id IN (1, 2, 3)") == \
+            "SELECT * FROM t WHERE tier = ? AND id IN (...)"
+        assert fingerprint("INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)") == \
+            fingerprint("INSERT INTO t (a, b) VALUES (%s, %s)")
+
+    @pytest.mark.unit
+    def test_fingerprint_collapses_case_lists(self):
+        """Un UPDATE por lotes con CASE tiene la misma huella sea cual sea el tamaño del lote"""
+        def batch_update(size):
+            cases = " ".join(["WHEN %s THEN %s"] * size)
+            placeholders = ", ".join(["%s"] * size)
+            return (f"UPDATE loyalty_users SET total_points = total_points + CASE user_id {cases} END, "
+                    f"current_tier = CASE user_id {cases} END WHERE user_id IN ({placeholders})")
+
+        assert fingerprint(batch_update(1)) == fingerprint(batch_update(250))
+        assert fingerprint(batch_update(3)) == (
+            "UPDATE loyalty_users SET total_points = total_points + CASE user_id WHEN ... THEN ... END, "
+            "current_tier = CASE user_id WHEN ... THEN ... END WHERE user_id IN (...)"
+        )
+
+        stats = QueryStats(slow_threshold_ms=0, max_statements=2)
+        for size in range(1, 20):
+            stats.record(batch_update(size), 0.001, rows=size)
+        assert stats.snapshot()["tracked_statements"] == 1
+        assert stats.dropped == 0
+
+    @pytest.mark.unit
+    def test_percentiles_and_rows(self):
+        """Se agregan llamadas, filas y percentiles por sentencia"""
+        stats = QueryStats(slow_threshold_ms=0)
+        for ms in range(1, 101):
+            stats.record("SELECT * FROM loyalty_users WHERE user_id = %s", ms / 1000, rows=1)
+        # rowcount -1 de un cursor sin búfer no suma filas
+        stats.record("SELECT * FROM loyalty_users WHERE user_id = 5", 0.0, rows=-1)
+
+        snapshot = stats.snapshot()
+        assert snapshot["tracked_statements"] == 1
+        statement = snapshot["statements"][0]
+        assert statement["count"] == 101
+        assert statement["rows"] == 100
+        assert statement["p99_ms"] == 99.0
+        assert statement["p95_ms"] == 95.0
+        assert statement["max_ms"] == 100.0
+
+    @pytest.mark.unit
+    def test_slow_query_logs_params_and_call_site(self, caplog):
+        """Las consultas sobre el umbral se registran con parámetros y origen"""
+        stats = QueryStats(slow_threshold_ms=50)
+        with caplog.at_level(logging.WARNING, logger="loyalty.slow_query"):
+            stats.record("SELECT 1 FROM loyalty_users WHERE user_id = %s", 0.010, params=(7,))
+            stats.record("SELECT 1 FROM loyalty_users WHERE user_id = %s", 0.080, params=(42,))
+
+        assert stats.slow_queries == 1
+        assert len(caplog.records) == 1
+        message = caplog.records[0].getMessage()
+        assert "(42,)" in message
+        assert "test_query_stats.py" in message
+
+    @pytest.mark.unit
+    def test_statement_cap_and_reset(self):
+        """Las sentencias nuevas por encima del máximo se descartan"""
+        stats = QueryStats(slow_threshold_ms=0, max_statements=2)
+        stats.record("SELECT a FROM t", 0.001)
+        stats.record("SELECT b FROM t", 0.001)
+        stats.record("SELECT c FROM t", 0.001)
+
+        assert stats.snapshot()["tracked_statements"] == 2
+        assert stats.dropped == 1
+
+        stats.reset()
+        assert stats.snapshot()["statements"] == []
@@ -0,0 +1,94 @@
+"""
+Tests unitarios para el modelo de scoring configurable
+"""
+
+import json
+import pytest
+import numpy as np
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+
+from services import scoring_model
+from services.scoring_model import ScoringModel, get_scoring_model, load_scoring_model, set_scoring_model
+
+
+@pytest.fixture
+def restore_model():
+    """Restaurar el modelo global al terminar el test"""
+    original = get_scoring_model()
+    yield
+    set_scoring_model(original)
+
+
+class TestScoringModel:
+    """Tests para pesos, recencia y coeficientes precompilados"""
+
+    @pytest.mark.unit
+    def test_weights_are_normalized(self):
+        """Los pesos se normalizan para que el total siga en 0-100"""
+        model = ScoringModel({"frequency": 2, "amount": 2}, recency_half_life_days=7)
+        assert model.weight_tuple == (0.5, 0.5, 0.0, 0.0, 0.0)
+        assert model.combine([100, 100, 100, 100, 100]) == pytest.approx(100)
+        assert model.combine_batch(np.full((5, 3), 100.0)).tolist() == pytest.approx([100, 100, 100])
+
+    @pytest.mark.unit
+    def test_recency_halves_every_half_life(self):
+        """La recencia decae a la mitad por cada vida media"""
+        model = ScoringModel({"recency": 1}, recency_half_life_days=10)
+        assert model.recency(0) == pytest.approx(100)
+        assert model.recency(10) == pytest.approx(50)
+        assert model.recency(20) == pytest.approx(25)
+        # Fechas futuras (relojes desfasados) no superan 100
+        assert model.recency(-3) == pytest.approx(100)
+        assert model.recency_batch(np.array([0.0, 10.0, 30.0])).tolist() == pytest.approx([100, 50, 12.5])
+
+    @pytest.mark.unit
+    def test_invalid_models_rejected(self):
+        """Componentes desconocidos, pesos nulos o vida media no positiva"""
+        with pytest.raises(ValueError):
+            ScoringModel({"loyalty": 1}, 7)
+        with pytest.raises(ValueError):
+            ScoringModel({"frequency": 0}, 7)
+        with pytest.raises(ValueError):
+            ScoringModel({"frequency": 1}, 0)
+
+    @pytest.mark.unit
+    def test_engine_uses_injected_model(self):
+        """Un motor con modelo propio pondera con ese modelo"""
+        from services.loyalty_engine import LoyaltyEngine
+
+        now = datetime(2024, 6, 1)
+        engine = LoyaltyEngine(ScoringModel({"recency": 1}, recency_half_life_days=5))
+        state = {"total_visits": 4, "total_spent": 9000, "last_visit": now - timedelta(days=5)}
+
+        assert engine.score_from_state(state, now)['total'] == pytest.approx(50)
+        batch = engine.score_batch([4], [30], [9000], [now - timedelta(days=5)], [0], [0], now=now)
+        assert batch['total'][0] == pytest.approx(50)
+
+
+class TestScoringModelLoading:
+    """Tests para la carga desde loyalty_config"""
+
+    @pytest.mark.unit
+    async def test_load_from_loyalty_config(self, restore_model):
+        """Pesos (JSON) y vida media de loyalty_config reemplazan el modelo"""
+        rows = [
+            {"config_key": "scoring_weights", "config_value": json.dumps({"amount": 3, "recency": 1})},
+            {"config_key": "recency_half_life_days", "config_value": "14"},
+        ]
+        with patch.object(scoring_model, "execute_query", AsyncMock(return_value=rows)):
+            model = await load_scoring_model()
+
+        assert get_scoring_model() is model
+        assert model.weight_tuple == (0.0, 0.75, 0.25, 0.0, 0.0)
+        assert model.recency_half_life_days == 14
+
+    @pytest.mark.unit
+    async def test_load_keeps_model_on_invalid_config(self, restore_model):
+        """Con valores inválidos o error de base de datos se conserva el modelo"""
+        current = get_scoring_model()
+        rows = [{"config_key": "scoring_weights", "config_value": "{no es json"}]
+        with patch.object(scoring_model, "execute_query", AsyncMock(return_value=rows)):
+            assert await load_scoring_model() is current
+        with patch.object(scoring_model, "execute_query", AsyncMock(side_effect=RuntimeError("sin conexión"))):
+            assert await load_scoring_model() is current
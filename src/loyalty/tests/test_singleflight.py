@@ -0,0 +1,98 @@
+"""
+Tests unitarios para la coalescencia de lecturas concurrentes (single-flight)
+"""
+
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+
+from utils.cache import MISSING
+from utils.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    """Tests de la ejecución compartida por clave"""
+
+    @pytest.mark.unit
+    async def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        executions = []
+
+        async def load(value):
+            executions.append(value)
+            await asyncio.sleep(0.01)
+            return {"value": value}
+
+        results = await asyncio.gather(
+            *(flight.do(("rewards",), lambda: load("a")) for _ in range(50)),
+            flight.do(("user", 2), lambda: load("b"))
+        )
+
+        assert executions == ["a", "b"]
+        assert all(result is results[0] for result in results[:50])
+        stats = flight.stats()
+        assert stats["calls"] == 51 and stats["collapsed"] == 49
+        assert stats["operations"]["rewards"]["collapse_ratio"] == 0.98
+        assert stats["in_flight"] == 0
+
+        # Terminada la ejecución, la siguiente llamada vuelve a cargar
+        await flight.do(("rewards",), lambda: load("c"))
+        assert executions[-1] == "c"
+
+    @pytest.mark.unit
+    async def test_errors_shared_and_leader_cancellation_isolated(self):
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def failing():
+            await release.wait()
+            raise RuntimeError("sin conexión")
+
+        leader = asyncio.create_task(flight.do(("stats",), failing))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do(("stats",), failing))
+        await asyncio.sleep(0)
+
+        # Cancelar al primer llamante no cancela la lectura compartida
+        leader.cancel()
+        release.set()
+        with pytest.raises(RuntimeError):
+            await follower
+
+    @pytest.mark.unit
+    async def test_forget_starts_new_flight(self):
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def load(value):
+            await release.wait()
+            return value
+
+        stale = asyncio.create_task(flight.do(("user", 7), lambda: load("antes")))
+        await asyncio.sleep(0)
+        flight.forget(("user", 7))
+        fresh = asyncio.create_task(flight.do(("user", 7), lambda: load("después")))
+        release.set()
+
+        assert await stale == "antes"
+        assert await fresh == "después"
+
+
+class TestCoalescedReads:
+    """Tests de las lecturas del servicio"""
+
+    @pytest.mark.unit
+    async def test_rewards_stampede_runs_one_query(self, loyalty_service):
+        """Cientos de /rewards simultáneos con la caché vacía: una consulta"""
+        async def slow_query(query, params=None, **kwargs):
+            await asyncio.sleep(0.01)
+            return []
+
+        cache = loyalty_service._rewards_cache
+        with patch("services.loyalty_service.single_flight", SingleFlight()), \
+             patch.object(cache, "get", AsyncMock(return_value=MISSING)), \
+             patch.object(cache, "set", AsyncMock()), \
+             patch("services.loyalty_service.execute_query", side_effect=slow_query) as mock_query:
+            await asyncio.gather(*(loyalty_service.get_all_rewards() for _ in range(200)))
+
+        assert mock_query.call_count == 1
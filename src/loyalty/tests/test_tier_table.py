@@ -0,0 +1,121 @@
+"""
+Tests unitarios para la tabla de niveles compilada
+"""
+
+import pytest
+from unittest.mock import AsyncMock, patch
+
+from utils import tier_table
+from utils.tier_table import TierTable, get_tier_table, load_tier_table, set_tier_table
+
+THRESHOLDS = {"cafe_bronze": 0, "cafe_plata": 1000, "cafe_oro": 5000, "cafe_diamante": 15000}
+MULTIPLIERS = {"cafe_bronze": 1.0, "cafe_plata": 1.2, "cafe_oro": 1.5, "cafe_diamante": 2.0}
+
+
+@pytest.fixture
+def table():
+    return TierTable(THRESHOLDS, MULTIPLIERS)
+
+
+@pytest.fixture
+def restore_table():
+    """Restaurar la tabla global al terminar el test"""
+    original = get_tier_table()
+    yield
+    set_tier_table(original)
+
+
+class TestTierTable:
+    """Tests para búsquedas, progreso y comparaciones de niveles"""
+
+    @pytest.mark.unit
+    def test_tier_for_points_boundaries(self, table):
+        """Cada umbral pertenece al nivel que empieza en él"""
+        assert table.tier_for_points(0) == "cafe_bronze"
+        assert table.tier_for_points(999) == "cafe_bronze"
+        assert table.tier_for_points(1000) == "cafe_plata"
+        assert table.tier_for_points(4999) == "cafe_plata"
+        assert table.tier_for_points(5000) == "cafe_oro"
+        assert table.tier_for_points(15000) == "cafe_diamante"
+        assert table.tier_for_points(10 ** 9) == "cafe_diamante"
+        # Saldos negativos caen en el nivel más bajo
+        assert table.tier_for_points(-50) == "cafe_bronze"
+
+    @pytest.mark.unit
+    def test_progress(self, table):
+        """Progreso hacia el siguiente nivel acotado a 0-100"""
+        progress = table.progress("cafe_plata", 3000)
+        assert progress["next_tier"] == "cafe_oro"
+        assert progress["points_needed"] == 2000
+        assert progress["progress_percentage"] == 50.0
+
+        # Puntos por debajo del umbral del nivel actual (p. ej. tras un canje)
+        assert table.progress("cafe_oro", 100)["progress_percentage"] == 0.0
+        assert table.progress("cafe_bronze", 2000)["points_needed"] == 0
+        assert table.progress("cafe_bronze", 2000)["progress_percentage"] == 100.0
+
+    @pytest.mark.unit
+    def test_progress_top_tier(self, table):
+        """En el nivel máximo no hay siguiente nivel"""
+        progress = table.progress("cafe_diamante", 20000)
+        assert progress["next_tier"] is None
+        assert progress["points_needed"] == 0
+        assert progress["progress_percentage"] == 100.0
+
+    @pytest.mark.unit
+    def test_rank_comparisons(self, table):
+        """Subidas de nivel y acceso a recompensas por posición"""
+        assert table.is_upgrade("cafe_bronze", "cafe_oro")
+        assert not table.is_upgrade("cafe_oro", "cafe_plata")
+        assert table.can_access("cafe_oro", "cafe_plata")
+        assert table.can_access("cafe_oro", "cafe_oro")
+        assert not table.can_access("cafe_plata", "cafe_diamante")
+        assert table.next_tier("cafe_oro") == "cafe_diamante"
+        assert table.next_tier("cafe_diamante") is None
+        assert table.multiplier("cafe_oro") == 1.5
+        # Niveles desconocidos cuentan como el más bajo
+        assert table.rank("desconocido") == 0
+
+    @pytest.mark.unit
+    def test_from_rows(self):
+        """Compilar desde filas de loyalty_tier_config en cualquier orden"""
+        table = TierTable.from_rows([
+            {"tier_name": "cafe_oro", "points_required": 25000, "points_multiplier": 1.5},
+            {"tier_name": "cafe_bronze", "points_required": 0, "points_multiplier": None},
+            {"tier_name": "cafe_plata", "points_required": 5000, "points_multiplier": 1.2},
+        ])
+        assert table.names == ("cafe_bronze", "cafe_plata", "cafe_oro")
+        assert table.tier_for_points(5000) == "cafe_plata"
+        assert table.multiplier("cafe_bronze") == 1.0
+
+    @pytest.mark.unit
+    def test_empty_table_rejected(self):
+        """Una tabla sin niveles no se puede compilar"""
+        with pytest.raises(ValueError):
+            TierTable({})
+
+
+class TestTierTableLoading:
+    """Tests para la carga desde loyalty_tier_config"""
+
+    @pytest.mark.unit
+    async def test_load_replaces_table(self, restore_table):
+        """Las filas de la base de datos reemplazan la tabla vigente"""
+        rows = [
+            {"tier_name": "cafe_bronze", "points_required": 0, "points_multiplier": 1.0},
+            {"tier_name": "cafe_plata", "points_required": 5000, "points_multiplier": 1.2},
+        ]
+        with patch.object(tier_table, "execute_query", AsyncMock(return_value=rows)):
+            table = await load_tier_table()
+
+        assert get_tier_table() is table
+        assert table.tier_for_points(4999) == "cafe_bronze"
+
+    @pytest.mark.unit
+    async def test_load_keeps_table_on_empty_or_error(self, restore_table):
+        """Sin filas o con error de base de datos se conserva la tabla vigente"""
+        current = get_tier_table()
+        with patch.object(tier_table, "execute_query", AsyncMock(return_value=[])):
+            assert await load_tier_table() is current
+        with patch.object(tier_table, "execute_query", AsyncMock(side_effect=RuntimeError("sin conexión"))):
+            assert await load_tier_table() is current
@@ -243,4 +243,134 @@ class TestTransactions:
         assert summary['total_purchases'] == 250
         assert summary['total_redemptions'] == 50
         assert summary['total_bonuses'] == 25
-        assert summary['net_points'] == 225 
\ No newline at end of file
+        assert summary['net_points'] == 225
+
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_transaction_summary_is_point_read(self, loyalty_service):
+        """El resumen persistido es una lectura por clave de loyalty_user_summary"""
+        row = {
+            'total_earned': 250, 'total_redeemed': 50, 'total_bonus': 25, 'total_referrals': 0,
+            'total_adjustments': 0, 'net_points': 225, 'redemption_count': 1,
+            'transaction_count': 4, 'last_transaction_id': 40
+        }
+        with patch('services.loyalty_service.execute_single_query', new_callable=AsyncMock,
+                   return_value=row) as mock_query:
+            summary = await loyalty_service.get_transaction_summary(7)
+        
+        query, params = mock_query.call_args.args
+        assert "FROM loyalty_user_summary WHERE user_id = %s" in query
+        assert params == (7,)
+        assert summary == row
+        
+        with patch('services.loyalty_service.execute_single_query', new_callable=AsyncMock, return_value=None):
+            empty = await loyalty_service.get_transaction_summary(8)
+        assert empty['redemption_count'] == 0 and empty['last_transaction_id'] is None
+    
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_rebuild_ledger_summaries_by_user_range(self, loyalty_service):
+        """El recálculo rehace cada bloque de usuarios en una transacción"""
+        users = [{'user_id': user_id} for user_id in (3, 5, 8, 13, 21)]
+        
+        async def fake_stream(query, params=None, chunk_size=None, use_primary=False):
+            for start in range(0, len(users), chunk_size):
+                yield users[start:start + chunk_size]
+        
+        uow = MagicMock()
+        uow.execute_delete = AsyncMock(return_value=0)
+        uow.execute_query = AsyncMock(return_value=[{
+            'user_id': 3, 'total_earned': 100, 'total_redeemed': 0, 'total_bonus': 50,
+            'total_referrals': 0, 'total_adjustments': 0, 'net_points': 150,
+            'redemption_count': 0, 'transaction_count': 2, 'last_transaction_id': 9
+        }])
+        uow.execute_many = AsyncMock(return_value=1)
+        transaction_cm = MagicMock()
+        transaction_cm.return_value.__aenter__ = AsyncMock(return_value=uow)
+        transaction_cm.return_value.__aexit__ = AsyncMock(return_value=False)
+        
+        with patch('services.loyalty_service.stream_query', new=fake_stream), \
+             patch('services.loyalty_service.transaction', transaction_cm):
+            processed = await loyalty_service.rebuild_ledger_summaries(chunk_size=2)
+        
+        assert processed == 5
+        assert transaction_cm.call_count == 3
+        assert [call.args[1] for call in uow.execute_delete.call_args_list] == [(3, 5), (8, 13), (21, 21)]
+        assert uow.execute_many.call_args_list[0].args[1] == [(3, 100, 0, 50, 0, 0, 150, 0, 2, 9)]
+    
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_record_transactions_bulk_uses_single_batch(self, loyalty_service):
+        """Test de registro masivo de transacciones en un solo lote"""
+        transactions = [
+            {
+                'user_id': user_id,
+                'transaction_type': 'earn',
+                'points_amount': 10,
+                'order_id': 1000 + user_id,
+                'description': 'Importación POS',
+                'balance_before': 0,
+                'balance_after': 10
+            }
+            for user_id in range(1, 251)
+        ]
+        
+        with patch('services.loyalty_service.execute_many', new_callable=AsyncMock, return_value=250) as mock_many:
+            inserted = await loyalty_service.record_transactions_bulk(transactions)
+        
+        assert inserted == 250
+        mock_many.assert_awaited_once()
+        rows = mock_many.call_args.args[1]
+        assert len(rows) == 250
+        assert rows[0][:4] == (1, 'earn', 10, 1001)
+    
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_create_coupons_bulk_returns_unique_codes(self, loyalty_service):
+        """Test de creación masiva de cupones con códigos únicos"""
+        coupons = [
+            {
+                'user_id': 1,
+                'discount_type': 'percentage',
+                'discount_value': 10.0,
+                'min_order_amount': 0,
+                'max_uses': 1
+            }
+            for _ in range(100)
+        ]
+        
+        with patch('services.loyalty_service.execute_many', new_callable=AsyncMock, return_value=100):
+            codes = await loyalty_service.create_coupons_bulk(coupons)
+        
+        assert len(codes) == 100
+        assert len(set(codes)) == 100
+    
+    @pytest.mark.asyncio
+    @pytest.mark.unit
+    async def test_earn_points_single_round_trip(self, loyalty_service):
+        """La acumulación de puntos es un único CALL a la base de datos"""
+        result_row = {
+            'balance_before': 900, 'new_balance': 1150, 'previous_tier': 'cafe_bronze',
+            'current_tier': 'cafe_plata', 'points': 250, 'created': 0, 'duplicate': 0
+        }
+        
+        with patch.object(loyalty_service, '_get_config_value', new_callable=AsyncMock, side_effect=[200, 365]), \
+             patch('services.loyalty_service.execute_procedure', new_callable=AsyncMock,
+                   return_value=[result_row]) as mock_call, \
+             patch('services.loyalty_service.execute_update', new_callable=AsyncMock) as mock_update, \
+             patch('services.loyalty_service.execute_insert', new_callable=AsyncMock) as mock_insert:
+            result = await loyalty_service.earn_points(7, 250, None, "Compra", products=["café"],
+                                                       purchase_amount=25000)
+        
+        mock_call.assert_awaited_once()
+        mock_update.assert_not_awaited()
+        mock_insert.assert_not_awaited()
+        query, params = mock_call.call_args.args
+        assert query.startswith("CALL loyalty_earn_points")
+        assert params[:4] == (7, 250, None, "Compra")
+        assert params[4] != 0  # bits de producto para el score
+        assert params[5] == 25000  # importe para total_spent
+        assert params[-1] is None  # sin clave de idempotencia
+        assert result['new_balance'] == 1150
+        assert result['current_tier'] == 'cafe_plata'
+        assert result['tier_status']['new_tier'] == 'cafe_plata'
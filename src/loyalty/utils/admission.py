@@ -0,0 +1,101 @@
+"""
+Control de admisión por prioridad para las rutas de fidelización
+"""
+
+from typing import Any, Dict
+
+from fastapi import HTTPException, status
+
+from config import settings
+from utils.database import get_pool_waiters
+
+
+class AdmissionController:
+    """
+    Limita las peticiones concurrentes por worker reservando capacidad
+    para las operaciones críticas (ganar y canjear puntos).
+
+    Las lecturas no críticas solo entran mientras quede capacidad fuera de
+    la reserva y el pool de conexiones no tenga corrutinas en espera; si no,
+    se rechazan de inmediato con 503 y ``Retry-After``.
+    """
+
+    def __init__(self, max_in_flight: int, reserved_critical: int, retry_after: int):
+        self.max_in_flight = max_in_flight
+        self.reserved_critical = min(reserved_critical, max_in_flight)
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+
+    @property
+    def non_critical_limit(self) -> int:
+        """Capacidad disponible para lecturas no críticas"""
+        return self.max_in_flight - self.reserved_critical
+
+    def try_enter(self, critical: bool) -> bool:
+        """Intentar admitir una petición; devuelve False si debe rechazarse"""
+        if critical:
+            limit = self.max_in_flight
+        else:
+            limit = self.non_critical_limit
+            if get_pool_waiters() > 0:
+                limit = 0
+
+        if self.in_flight >= limit:
+            self.shed += 1
+            return False
+
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def leave(self):
+        """Liberar el cupo de una petición admitida"""
+        self.in_flight -= 1
+
+    def overloaded(self) -> HTTPException:
+        """Respuesta 503 con Retry-After para peticiones rechazadas"""
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Servicio saturado, reintente en unos segundos",
+            headers={"Retry-After": str(self.retry_after)}
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de admisión"""
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "reserved_critical": self.reserved_critical,
+            "admitted": self.admitted,
+            "shed": self.shed
+        }
+
+
+# Instancia global por worker
+admission_controller = AdmissionController(
+    max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT,
+    reserved_critical=settings.ADMISSION_RESERVED_CRITICAL,
+    retry_after=settings.ADMISSION_RETRY_AFTER
+)
+
+
+async def critical_request():
+    """Dependencia FastAPI para operaciones críticas (usan la capacidad reservada)"""
+    if not admission_controller.try_enter(critical=True):
+        raise admission_controller.overloaded()
+    try:
+        yield
+    finally:
+        admission_controller.leave()
+
+
+async def non_critical_request():
+    """Dependencia FastAPI para lecturas no críticas (se descartan primero bajo carga)"""
+    if not admission_controller.try_enter(critical=False):
+        raise admission_controller.overloaded()
+    try:
+        yield
+    finally:
+        admission_controller.leave()
@@ -0,0 +1,436 @@
+"""
+Caché de dos niveles: L1 en memoria por worker (LRU con caducidad por
+entrada) y L2 opcional compartido (Redis) con invalidación por pub/sub
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from .cache_backends import create_backend
+
+logger = logging.getLogger(__name__)
+
+# Centinela para distinguir "no está" de un valor None almacenado
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Caché LRU acotada a `maxsize` entradas que caducan a los `ttl` segundos.
+
+    Pensada para un solo event loop (un worker de uvicorn): no usa locks.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Devolver el valor vigente de `key` o `default` (cuenta acierto/fallo)"""
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > self._clock():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any):
+        """Guardar `value`, desalojando la entrada menos usada si se llena"""
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, self._clock() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """Eliminar `key` si existe"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Vaciar la caché (conserva los contadores)"""
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de la caché"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+
+def _json_default(value: Any) -> Any:
+    """Tipos que devuelve el driver y que `json` no serializa"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Tipo no serializable en caché: {type(value).__name__}")
+
+
+def json_encode(value: Any) -> bytes:
+    """Codificador por defecto para L2"""
+    return json.dumps(value, default=_json_default).encode()
+
+
+def json_decode(data: bytes) -> Any:
+    """Decodificador por defecto para L2"""
+    return json.loads(data)
+
+
+class CacheRegion:
+    """
+    Espacio de nombres de la caché (usuarios, recompensas, configuración...).
+
+    Cada instancia tiene su propio L1; las instancias con el mismo nombre
+    comparten L2 e invalidaciones a través del CacheManager. Las claves deben
+    ser str o int para poder viajar en los mensajes de invalidación.
+    `on_invalidate(keys)` se llama cuando llega una invalidación de otro
+    worker (keys None = región completa).
+
+    Cada invalidación (local o recibida) sube la generación de sus claves,
+    en este worker y en L2: un valor leído de la base de datos se guarda con
+    la generación tomada antes de leerlo (``set(key, value, generation=...)``)
+    y se descarta si una escritura de cualquier worker lo invalidó mientras
+    tanto. En L2 la comprobación y la escritura son atómicas.
+    """
+
+    def __init__(self, manager: "CacheManager", name: str, maxsize: int, ttl: float,
+                 encode: Callable[[Any], bytes] = json_encode,
+                 decode: Callable[[bytes], Any] = json_decode,
+                 on_invalidate: Optional[Callable[[Any], None]] = None):
+        self.manager = manager
+        self.on_invalidate = on_invalidate
+        self.name = name
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.encode = encode
+        self.decode = decode
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.stale_sets = 0
+        # Última invalidación por clave; las más antiguas se olvidan subiendo el suelo
+        self._generations: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._generation_floor = 0
+        self._generation_clock = 0
+
+    def _local_generation(self, key: Hashable) -> int:
+        return self._generations.get(key, self._generation_floor)
+
+    async def generation(self, key: Hashable) -> Tuple[int, Optional[Dict[str, Optional[bytes]]]]:
+        """Generación de invalidación de `key`, local y de L2 (tomarla antes de leer el valor)"""
+        return self._local_generation(key), await self.manager._l2_generation(self.name, key)
+
+    def _bump_generation(self, keys):
+        self._generation_clock += 1
+        if keys is None:
+            self._generations.clear()
+            self._generation_floor = self._generation_clock
+            return
+        for key in keys:
+            self._generations[key] = self._generation_clock
+            self._generations.move_to_end(key)
+        # Olvidar una clave sube el suelo: sus cargas en curso tampoco se guardan
+        while len(self._generations) > max(self.local.maxsize, 1024):
+            _, self._generation_floor = self._generations.popitem(last=False)
+
+    async def get(self, key: Hashable) -> Any:
+        """Buscar en L1 y después en L2; devuelve MISSING si no está en ninguno"""
+        value = self.local.get(key)
+        if value is not MISSING:
+            return value
+
+        data = await self.manager._l2_get(self.name, key)
+        if data is None:
+            if self.manager.backend is not None:
+                self.l2_misses += 1
+            return MISSING
+
+        try:
+            value = self.decode(data)
+        except Exception as e:
+            logger.warning(f"Entrada L2 ilegible en {self.name}:{key}: {e}")
+            return MISSING
+        self.l2_hits += 1
+        self.local.set(key, value)
+        return value
+
+    async def set(self, key: Hashable, value: Any, generation: Optional[tuple] = None):
+        """
+        Guardar en L1 y L2. Con `generation` (la de ``generation(key)`` antes
+        de leer el valor) no se guarda si la clave se invalidó entretanto.
+        """
+        if generation is None:
+            self.local.set(key, value)
+            if self.manager.backend is not None:
+                await self.manager._l2_set(self.name, key, self.encode(value), self.ttl)
+            return
+
+        local_generation, shared_generation = generation
+        if local_generation != self._local_generation(key):
+            self.stale_sets += 1
+            return
+        if self.manager.backend is not None and shared_generation is not None:
+            stored = await self.manager._l2_set_if(
+                self.name, key, self.encode(value), self.ttl, shared_generation
+            )
+            if stored is False:
+                # Otro worker invalidó la clave durante la lectura
+                self.stale_sets += 1
+                return
+        self.local.set(key, value)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Devolver el valor en caché o cargarlo con `loader` y guardarlo"""
+        value = await self.get(key)
+        if value is MISSING:
+            generation = await self.generation(key)
+            value = await loader()
+            await self.set(key, value, generation=generation)
+        return value
+
+    async def invalidate(self, *keys: Hashable):
+        """Invalidar `keys` en este worker, en L2 y en los demás workers"""
+        await self.manager.invalidate(self.name, keys)
+
+    async def clear(self):
+        """Invalidar la región completa en todos los workers"""
+        await self.manager.invalidate(self.name, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de L1 y L2"""
+        stats = self.local.stats()
+        stats.update({"l2_hits": self.l2_hits, "l2_misses": self.l2_misses, "stale_sets": self.stale_sets})
+        return stats
+
+
+class CacheManager:
+    """
+    Coordina las regiones de un worker con el L2 compartido: lecturas y
+    escrituras en L2, y un canal pub/sub por el que cada invalidación local
+    se propaga al L1 de los demás workers.
+    """
+
+    KEY_PREFIX = "loyalty:cache:"
+    # Las generaciones en L2 deben sobrevivir a cualquier lectura en curso
+    GENERATION_TTL_SECONDS = 3600
+
+    def __init__(self, channel: str = "loyalty:cache:invalidate"):
+        self.channel = channel
+        self.instance_id = uuid.uuid4().hex
+        self.backend = None
+        self.l2_errors = 0
+        self.invalidations_sent = 0
+        self.invalidations_received = 0
+        self._regions: Dict[str, "weakref.WeakSet[CacheRegion]"] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    def region(self, name: str, maxsize: int, ttl: float,
+               encode: Callable[[Any], bytes] = json_encode,
+               decode: Callable[[bytes], Any] = json_decode,
+               on_invalidate: Optional[Callable[[Any], None]] = None) -> CacheRegion:
+        """Crear una región con L1 propio registrada para recibir invalidaciones"""
+        region = CacheRegion(self, name, maxsize, ttl, encode, decode, on_invalidate)
+        self._regions.setdefault(name, weakref.WeakSet()).add(region)
+        return region
+
+    async def start(self, url: str = "", backend=None):
+        """Conectar el L2 (por URL o instancia) y empezar a escuchar invalidaciones"""
+        self.backend = backend if backend is not None else create_backend(url)
+        if self.backend is None:
+            logger.info("Caché sin L2: solo memoria local por worker")
+            return
+        self._listener = asyncio.create_task(self._listen())
+        # Dejar que el listener se suscriba antes de servir peticiones
+        await asyncio.sleep(0)
+
+    async def stop(self):
+        """Detener el listener y cerrar el L2"""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self.backend is not None:
+            await self.backend.close()
+            self.backend = None
+
+    def _l2_key(self, region: str, key: Hashable) -> str:
+        return f"{self.KEY_PREFIX}{region}:{key}"
+
+    def _generation_key(self, region: str, key: Hashable = None) -> str:
+        suffix = "" if key is None else f":{key}"
+        return f"{self.KEY_PREFIX}gen:{region}{suffix}"
+
+    async def _l2_generation(self, region: str, key: Hashable) -> Optional[Dict[str, Optional[bytes]]]:
+        """Generaciones de L2 (región y clave) que deben seguir igual al guardar; None si no hay L2"""
+        if self.backend is None:
+            return None
+        guards = [self._generation_key(region), self._generation_key(region, key)]
+        try:
+            return dict(zip(guards, await self.backend.get_many(*guards)))
+        except Exception as e:
+            # Sin generación no se puede escribir en L2 con seguridad: solo L1
+            self.l2_errors += 1
+            logger.warning(f"Error leyendo generación L2 ({region}): {e}")
+            return None
+
+    async def _l2_get(self, region: str, key: Hashable) -> Optional[bytes]:
+        if self.backend is None:
+            return None
+        try:
+            return await self.backend.get(self._l2_key(region, key))
+        except Exception as e:
+            # Un L2 caído degrada a solo L1, nunca rompe la petición
+            self.l2_errors += 1
+            logger.warning(f"Error leyendo L2 ({region}): {e}")
+            return None
+
+    async def _l2_set(self, region: str, key: Hashable, data: bytes, ttl: float):
+        try:
+            await self.backend.set(self._l2_key(region, key), data, ttl)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"Error escribiendo L2 ({region}): {e}")
+
+    async def _l2_set_if(self, region: str, key: Hashable, data: bytes, ttl: float,
+                         guards: Dict[str, Optional[bytes]]) -> Optional[bool]:
+        """Escribir en L2 si las generaciones no cambiaron; None si L2 falló"""
+        try:
+            return await self.backend.set_if(self._l2_key(region, key), data, ttl, guards)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"Error escribiendo L2 ({region}): {e}")
+            return None
+
+    def _evict_local(self, region: str, keys, remote: bool = False):
+        for instance in list(self._regions.get(region, ())):
+            instance._bump_generation(keys)
+            if keys is None:
+                instance.local.clear()
+            else:
+                for key in keys:
+                    instance.local.invalidate(key)
+            if remote and instance.on_invalidate is not None:
+                try:
+                    instance.on_invalidate(keys)
+                except Exception as e:
+                    logger.warning(f"Error en on_invalidate de {region}: {e}")
+
+    def _clear_all_local(self):
+        for name in list(self._regions):
+            self._evict_local(name, None, remote=True)
+
+    async def invalidate(self, region: str, keys):
+        """Invalidar `keys` (None = toda la región) en L1 local, L2 y demás workers"""
+        self._evict_local(region, keys)
+        if self.backend is None:
+            return
+
+        try:
+            # Subir la generación antes de borrar: una lectura anterior ya no puede escribir
+            if keys is None:
+                await self.backend.incr(self._generation_key(region), ttl=self.GENERATION_TTL_SECONDS)
+                await self.backend.delete_prefix(self._l2_key(region, ""))
+            else:
+                await self.backend.incr(*(self._generation_key(region, key) for key in keys),
+                                        ttl=self.GENERATION_TTL_SECONDS)
+                await self.backend.delete(*(self._l2_key(region, key) for key in keys))
+            message = json.dumps({
+                "origin": self.instance_id,
+                "region": region,
+                "keys": None if keys is None else list(keys)
+            })
+            await self.backend.publish(self.channel, message)
+            self.invalidations_sent += 1
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"Error propagando invalidación ({region}): {e}")
+
+    def _handle_message(self, raw: str):
+        try:
+            message = json.loads(raw)
+        except (TypeError, ValueError):
+            logger.warning(f"Mensaje de invalidación ilegible: {raw!r}")
+            return
+        if message.get("origin") == self.instance_id:
+            return
+        self.invalidations_received += 1
+        self._evict_local(message.get("region"), message.get("keys"), remote=True)
+
+    async def _listen(self):
+        delay = 1.0
+        while True:
+            try:
+                async for raw in self.backend.subscribe(self.channel):
+                    delay = 1.0
+                    self._handle_message(raw)
+                reason = "conexión cerrada"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.l2_errors += 1
+                reason = str(e)
+            # Mientras no hay suscripción se pueden perder invalidaciones:
+            # vaciar el L1 local y reintentar con espera exponencial
+            logger.warning(f"Suscripción de invalidaciones caída, reintentando en {delay:.0f}s: {reason}")
+            self._clear_all_local()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas agregadas por región para /health"""
+        regions: Dict[str, Dict[str, Any]] = {}
+        for name, instances in self._regions.items():
+            totals = {"size": 0, "hits": 0, "misses": 0, "evictions": 0, "l2_hits": 0, "l2_misses": 0,
+                      "stale_sets": 0}
+            for instance in list(instances):
+                instance_stats = instance.stats()
+                for field in totals:
+                    totals[field] += instance_stats[field]
+            lookups = totals["hits"] + totals["misses"]
+            totals["hit_ratio"] = round(totals["hits"] / lookups, 4) if lookups else 0.0
+            regions[name] = totals
+
+        return {
+            "l2": type(self.backend).__name__ if self.backend is not None else None,
+            "l2_errors": self.l2_errors,
+            "invalidations_sent": self.invalidations_sent,
+            "invalidations_received": self.invalidations_received,
+            "regions": regions
+        }
+
+
+# Instancia global por worker; main.py la conecta al L2 en el arranque
+cache_manager = CacheManager()
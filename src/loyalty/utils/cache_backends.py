@@ -0,0 +1,156 @@
+"""
+Backends de segundo nivel (L2) para la caché compartida entre workers
+"""
+
+import asyncio
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+class MemoryBackend:
+    """
+    Sustituto en memoria de Redis para tests y desarrollo: varios
+    CacheManager que compartan la misma instancia se comportan como workers
+    que comparten un Redis (valores con TTL y pub/sub).
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[bytes, float]] = {}
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+
+    async def get_many(self, *keys: str) -> List[Optional[bytes]]:
+        return [await self.get(key) for key in keys]
+
+    async def set_if(self, key: str, value: bytes, ttl: float, guards: Dict[str, Optional[bytes]]) -> bool:
+        for guard, expected in guards.items():
+            if await self.get(guard) != expected:
+                return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def incr(self, *keys: str, ttl: float):
+        for key in keys:
+            current = await self.get(key)
+            await self.set(key, str(int(current or 0) + 1).encode(), ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def delete_prefix(self, prefix: str):
+        for key in [k for k in self._data if k.startswith(prefix)]:
+            del self._data[key]
+
+    async def publish(self, channel: str, message: str):
+        for queue in self._subscribers.get(channel, []):
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, []).append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[channel].remove(queue)
+
+    async def close(self):
+        pass
+
+
+# SET de KEYS[1] solo si cada guarda KEYS[i] conserva el valor esperado ARGV[i + 1]
+_SET_IF_SCRIPT = """
+for i = 2, #KEYS do
+    if (redis.call('GET', KEYS[i]) or '') ~= ARGV[i + 1] then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+
+class RedisBackend:
+    """Backend L2 sobre Redis (``redis.asyncio``)"""
+
+    def __init__(self, url: str):
+        # Dependencia opcional: solo se importa si hay REDIS_URL configurada
+        import redis.asyncio as redis
+
+        self._client = redis.from_url(url)
+        self._set_if = self._client.register_script(_SET_IF_SCRIPT)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self._client.set(key, value, px=int(ttl * 1000))
+
+    async def get_many(self, *keys: str) -> List[Optional[bytes]]:
+        return await self._client.mget(keys)
+
+    async def set_if(self, key: str, value: bytes, ttl: float, guards: Dict[str, Optional[bytes]]) -> bool:
+        # Comprobación y escritura atómicas dentro de Redis
+        expected = [current or b"" for current in guards.values()]
+        stored = await self._set_if(keys=[key, *guards], args=[value, int(ttl * 1000), *expected])
+        return bool(stored)
+
+    async def incr(self, *keys: str, ttl: float):
+        async with self._client.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.incr(key)
+                pipe.pexpire(key, int(ttl * 1000))
+            await pipe.execute()
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self._client.delete(*keys)
+
+    async def delete_prefix(self, prefix: str):
+        batch = []
+        async for key in self._client.scan_iter(match=f"{prefix}*", count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                await self._client.delete(*batch)
+                batch = []
+        if batch:
+            await self._client.delete(*batch)
+
+    async def publish(self, channel: str, message: str):
+        await self._client.publish(channel, message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(channel)
+        try:
+            async for message in pubsub.listen():
+                data = message.get("data")
+                yield data.decode() if isinstance(data, bytes) else data
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.close()
+
+    async def close(self):
+        await self._client.close()
+
+
+def create_backend(url: str):
+    """Crear el backend L2 según la URL: vacía = sin L2, ``memory://`` o ``redis://``"""
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    return RedisBackend(url)
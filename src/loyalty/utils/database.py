@@ -3,18 +3,44 @@ Configuración de base de datos para el sistema de fidelización
 """
 
 import aiomysql
+import asyncio
+import functools
 import logging
-from typing import Optional
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Hashable, Iterable, List, Optional, Sequence
 from config import settings
+from .pool_metrics import PoolMetrics, pool_metrics
+from .query_stats import query_stats
 
 logger = logging.getLogger(__name__)
 
 # Variable global para la conexión
 _pool: Optional[aiomysql.Pool] = None
 
+# Pool opcional de la réplica de lectura
+_replica_pool: Optional[aiomysql.Pool] = None
+replica_pool_metrics = PoolMetrics()
+
+# Corrutinas esperando una conexión, por pool
+_waiters = {"primary": 0, "replica": 0}
+
+# Read-your-writes: clave (p.ej. user_id) -> instante hasta el que se lee del primario
+_sticky_until: Dict[Hashable, float] = {}
+
+# Estado de la réplica según el último chequeo de retraso
+_replica_state = {"lag": None, "checked_at": 0.0, "checking": False}
+
+class PoolExhaustedError(RuntimeError):
+    """No hay conexiones disponibles: timeout de adquisición o demasiadas corrutinas en espera"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
 async def init_db():
     """Inicializar la conexión a la base de datos"""
-    global _pool
+    global _pool, _replica_pool
     
     try:
         _pool = await aiomysql.create_pool(
@@ -25,10 +51,27 @@ async def init_db():
             db=settings.DB_NAME,
             charset='utf8mb4',
             autocommit=True,
-            maxsize=20,
-            minsize=5
+            maxsize=settings.DB_POOL_MAX_SIZE,
+            minsize=min(settings.DB_POOL_MIN_SIZE, settings.DB_POOL_MAX_SIZE)
+        )
+        logger.info(
+            f"✅ Pool de conexiones a la base de datos creado "
+            f"(min={_pool.minsize}, max={_pool.maxsize})"
         )
-        logger.info("✅ Pool de conexiones a la base de datos creado")
+        
+        if settings.DB_REPLICA_HOST:
+            _replica_pool = await aiomysql.create_pool(
+                host=settings.DB_REPLICA_HOST,
+                port=settings.DB_REPLICA_PORT,
+                user=settings.DB_REPLICA_USER,
+                password=settings.DB_REPLICA_PASSWORD,
+                db=settings.DB_NAME,
+                charset='utf8mb4',
+                autocommit=True,
+                maxsize=settings.DB_REPLICA_POOL_MAX_SIZE,
+                minsize=min(settings.DB_POOL_MIN_SIZE, settings.DB_REPLICA_POOL_MAX_SIZE)
+            )
+            logger.info(f"✅ Pool de la réplica de lectura creado ({settings.DB_REPLICA_HOST})")
         
         # Verificar conexión
         async with _pool.acquire() as conn:
@@ -44,7 +87,13 @@ async def init_db():
 
 async def close_db():
     """Cerrar la conexión a la base de datos"""
-    global _pool
+    global _pool, _replica_pool
+    
+    if _replica_pool:
+        _replica_pool.close()
+        await _replica_pool.wait_closed()
+        _replica_pool = None
+        logger.info("✅ Pool de la réplica cerrado")
     
     if _pool:
         _pool.close()
@@ -58,37 +107,385 @@ async def get_db():
     
     return _pool
 
-async def execute_query(query: str, params: tuple = None):
-    """Ejecutar una consulta SQL"""
-    async with _pool.acquire() as conn:
+def get_pool_stats() -> Dict[str, Any]:
+    """Métricas del pool: espera de adquisición, conexiones en uso/libres, timeouts y latencia por consulta"""
+    stats = pool_metrics.snapshot(_pool)
+    stats["waiters"] = _waiters["primary"]
+    stats["max_waiters"] = settings.DB_POOL_MAX_WAITERS
+    
+    if _replica_pool:
+        replica_stats = replica_pool_metrics.snapshot(_replica_pool)
+        replica_stats["waiters"] = _waiters["replica"]
+        replica_stats["lag_seconds"] = _replica_state["lag"]
+        stats["replica"] = replica_stats
+    return stats
+
+def get_pool_waiters() -> int:
+    """Número de corrutinas esperando una conexión del primario"""
+    return _waiters["primary"]
+
+def _release_orphan(pool: aiomysql.Pool, task: asyncio.Future):
+    """Devolver al pool una conexión obtenida por una adquisición ya abandonada"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    pool.release(task.result())
+
+@asynccontextmanager
+async def _acquire(timeout: Optional[float] = None, replica: bool = False):
+    """Adquirir una conexión del pool con espera acotada.
+
+    Lanza `PoolExhaustedError` si ya hay ``DB_POOL_MAX_WAITERS`` corrutinas
+    esperando, o si no se obtiene conexión en ``DB_ACQUIRE_TIMEOUT`` segundos,
+    en lugar de encolar indefinidamente. Con ``replica=True`` usa el pool
+    de la réplica de lectura.
+    """
+    role = "replica" if replica else "primary"
+    pool = _replica_pool if replica else _pool
+    metrics = replica_pool_metrics if replica else pool_metrics
+    
+    if not pool:
+        raise RuntimeError("Base de datos no inicializada")
+    
+    if _waiters[role] >= settings.DB_POOL_MAX_WAITERS:
+        metrics.record_rejected()
+        raise PoolExhaustedError("Demasiadas peticiones esperando una conexión a la base de datos")
+    
+    timeout = settings.DB_ACQUIRE_TIMEOUT if timeout is None else timeout
+    started = time.perf_counter()
+    task = asyncio.ensure_future(pool.acquire())
+    _waiters[role] += 1
+    try:
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+    except asyncio.CancelledError:
+        task.add_done_callback(functools.partial(_release_orphan, pool))
+        task.cancel()
+        raise
+    finally:
+        _waiters[role] -= 1
+    
+    if not done:
+        task.add_done_callback(functools.partial(_release_orphan, pool))
+        task.cancel()
+        metrics.record_timeout()
+        raise PoolExhaustedError(f"Timeout de {timeout}s esperando una conexión a la base de datos")
+    
+    conn = task.result()
+    metrics.record_acquire(time.perf_counter() - started)
+    try:
+        yield conn
+    finally:
+        metrics.record_release()
+        pool.release(conn)
+
+def mark_recent_write(key: Hashable):
+    """Registrar una escritura asociada a `key` (normalmente un user_id).
+
+    Durante ``DB_READ_YOUR_WRITES_SECONDS`` las lecturas con ese
+    `sticky_key` se hacen contra el primario, de modo que el usuario ve sus
+    propios cambios aunque la réplica vaya atrasada. La marca es local al
+    worker; entre workers la cota la da ``DB_REPLICA_MAX_LAG_SECONDS``.
+    """
+    if not _replica_pool:
+        return
+    
+    now = time.monotonic()
+    _sticky_until[key] = now + settings.DB_READ_YOUR_WRITES_SECONDS
+    
+    # Purga perezosa de marcas vencidas
+    if len(_sticky_until) > settings.DB_STICKY_MAX_KEYS:
+        for stale_key in [k for k, until in _sticky_until.items() if until <= now]:
+            del _sticky_until[stale_key]
+
+async def _check_replica_lag():
+    """Consultar el retraso de la réplica (SHOW REPLICA/SLAVE STATUS)"""
+    _replica_state["checking"] = True
+    try:
+        async with _acquire(replica=True) as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                try:
+                    await cursor.execute("SHOW REPLICA STATUS")
+                except Exception:
+                    await cursor.execute("SHOW SLAVE STATUS")
+                status = await cursor.fetchone()
+        
+        if not status:
+            # No es réplica de nadie (p.ej. segunda instancia local de pruebas)
+            lag = 0
+        else:
+            lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+        _replica_state["lag"] = lag
+    except Exception as e:
+        logger.warning(f"⚠️  No se pudo consultar el retraso de la réplica: {e}")
+        _replica_state["lag"] = None
+    finally:
+        _replica_state["checked_at"] = time.monotonic()
+        _replica_state["checking"] = False
+
+async def _use_replica(sticky_key: Optional[Hashable], use_primary: bool) -> bool:
+    """Decidir si una lectura puede ir a la réplica"""
+    if use_primary or not _replica_pool:
+        return False
+    
+    now = time.monotonic()
+    if sticky_key is not None and _sticky_until.get(sticky_key, 0) > now:
+        return False
+    
+    if (now - _replica_state["checked_at"] >= settings.DB_REPLICA_LAG_CHECK_INTERVAL
+            and not _replica_state["checking"]):
+        await _check_replica_lag()
+    
+    # Sin dato de retraso (replicación detenida o error) se usa el primario
+    lag = _replica_state["lag"]
+    return lag is not None and lag <= settings.DB_REPLICA_MAX_LAG_SECONDS
+
+async def _run(cursor, query: str, params: tuple = None):
+    """Ejecutar una sentencia en `cursor` registrando su latencia y estadísticas"""
+    started = time.perf_counter()
+    try:
+        await cursor.execute(query, params)
+    except Exception:
+        elapsed = time.perf_counter() - started
+        pool_metrics.record_query(elapsed, failed=True)
+        query_stats.record(query, elapsed, params=params, failed=True)
+        raise
+    elapsed = time.perf_counter() - started
+    pool_metrics.record_query(elapsed)
+    query_stats.record(query, elapsed, rows=cursor.rowcount, params=params)
+
+async def _run_many(cursor, query: str, rows: Sequence[Sequence]):
+    """Ejecutar `executemany` en `cursor` registrando su latencia y estadísticas"""
+    started = time.perf_counter()
+    try:
+        await cursor.executemany(query, rows)
+    except Exception:
+        elapsed = time.perf_counter() - started
+        pool_metrics.record_query(elapsed, failed=True)
+        query_stats.record(query, elapsed, params=f"<{len(rows)} filas>", failed=True)
+        raise
+    elapsed = time.perf_counter() - started
+    pool_metrics.record_query(elapsed)
+    query_stats.record(query, elapsed, rows=cursor.rowcount, params=f"<{len(rows)} filas>")
+
+async def execute_query(query: str, params: tuple = None,
+                        sticky_key: Optional[Hashable] = None, use_primary: bool = False):
+    """Ejecutar una consulta SQL (en la réplica si está disponible y al día)"""
+    replica = await _use_replica(sticky_key, use_primary)
+    async with _acquire(replica=replica) as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute(query, params)
+            await _run(cursor, query, params)
             return await cursor.fetchall()
 
-async def execute_single_query(query: str, params: tuple = None):
-    """Ejecutar una consulta SQL y obtener un solo resultado"""
-    async with _pool.acquire() as conn:
+async def execute_single_query(query: str, params: tuple = None,
+                               sticky_key: Optional[Hashable] = None, use_primary: bool = False):
+    """Ejecutar una consulta SQL y obtener un solo resultado (en la réplica si está disponible y al día)"""
+    replica = await _use_replica(sticky_key, use_primary)
+    async with _acquire(replica=replica) as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute(query, params)
+            await _run(cursor, query, params)
+            return await cursor.fetchone()
+
+async def execute_single_row(query: str, params: tuple = None,
+                             sticky_key: Optional[Hashable] = None, use_primary: bool = False):
+    """
+    Como `execute_single_query` pero con un cursor plano: devuelve la fila
+    como tupla en el orden de las columnas del SELECT, sin construir un dict
+    """
+    replica = await _use_replica(sticky_key, use_primary)
+    async with _acquire(replica=replica) as conn:
+        async with conn.cursor() as cursor:
+            await _run(cursor, query, params)
             return await cursor.fetchone()
 
+async def execute_query_rows(query: str, params: tuple = None,
+                             sticky_key: Optional[Hashable] = None, use_primary: bool = False):
+    """Como `execute_query` pero devolviendo tuplas en el orden del SELECT"""
+    replica = await _use_replica(sticky_key, use_primary)
+    async with _acquire(replica=replica) as conn:
+        async with conn.cursor() as cursor:
+            await _run(cursor, query, params)
+            return await cursor.fetchall()
+
 async def execute_insert(query: str, params: tuple = None):
     """Ejecutar una inserción SQL y obtener el ID insertado"""
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(query, params)
+            await _run(cursor, query, params)
             return cursor.lastrowid
 
 async def execute_update(query: str, params: tuple = None):
     """Ejecutar una actualización SQL"""
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(query, params)
+            await _run(cursor, query, params)
             return cursor.rowcount
 
 async def execute_delete(query: str, params: tuple = None):
     """Ejecutar una eliminación SQL"""
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(query, params)
-            return cursor.rowcount 
\ No newline at end of file
+            await _run(cursor, query, params)
+            return cursor.rowcount
+
+async def execute_procedure(query: str, params: tuple = None):
+    """
+    Ejecutar ``CALL procedimiento(...)`` en el primario y obtener las filas de
+    su primer resultado. El procedimiento gestiona su propia transacción: la
+    operación completa cuesta un solo viaje a la base de datos.
+    """
+    async with _acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            await _run(cursor, query, params)
+            rows = await cursor.fetchall()
+            # Descartar el paquete de estado del CALL antes de devolver la conexión
+            while await cursor.nextset():
+                pass
+            return rows
+
+async def stream_query(query: str, params: tuple = None, chunk_size: Optional[int] = None,
+                       use_primary: bool = False) -> AsyncIterator[Any]:
+    """Ejecutar una consulta SQL con un cursor de servidor sin búfer.
+
+    Las filas se leen del socket a medida que se consumen, por lo que la
+    memoria es constante sin importar el tamaño del resultado. Sin
+    `chunk_size` se entrega fila a fila; con `chunk_size` se entregan
+    listas de hasta ese número de filas.
+
+    La conexión queda ocupada mientras se itera: consumir el generador
+    completo o cerrarlo (``contextlib.aclosing``) si se abandona antes.
+    """
+    fetch_size = chunk_size or settings.DB_STREAM_FETCH_SIZE
+    replica = await _use_replica(None, use_primary)
+    async with _acquire(replica=replica) as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cursor:
+            await _run(cursor, query, params)
+            while True:
+                rows = await cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                if chunk_size:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+
+def _chunked(rows: Iterable[Sequence], chunk_size: int) -> Iterable[List[Sequence]]:
+    """Dividir las filas en bloques de como máximo `chunk_size` elementos"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def _execute_many_on(conn: aiomysql.Connection, query: str, rows: Iterable[Sequence],
+                           chunk_size: Optional[int] = None) -> int:
+    """Ejecutar `query` para todas las filas sobre una conexión ya abierta.
+
+    Para ``INSERT ... VALUES`` el cursor reescribe cada bloque como un
+    único ``INSERT`` multi-fila, partido según ``DB_MAX_STATEMENT_BYTES``
+    para no superar ``max_allowed_packet`` del servidor.
+    """
+    chunk_size = chunk_size or settings.DB_BULK_CHUNK_SIZE
+    affected = 0
+    async with conn.cursor() as cursor:
+        cursor.max_stmt_length = settings.DB_MAX_STATEMENT_BYTES
+        for chunk in _chunked(rows, chunk_size):
+            await _run_many(cursor, query, chunk)
+            affected += cursor.rowcount
+    return affected
+
+async def execute_many(query: str, rows: Iterable[Sequence], chunk_size: Optional[int] = None) -> int:
+    """Ejecutar una inserción/actualización masiva en una sola transacción y obtener las filas afectadas"""
+    async with _acquire() as conn:
+        await conn.begin()
+        try:
+            affected = await _execute_many_on(conn, query, rows, chunk_size)
+        except BaseException:
+            await conn.rollback()
+            raise
+        await conn.commit()
+        return affected
+
+class UnitOfWork:
+    """Unidad de trabajo: una sola conexión y una transacción explícita.
+
+    Expone los mismos helpers que el módulo (``execute_query``,
+    ``execute_single_query``, ``execute_insert``, ``execute_update``,
+    ``execute_delete``) pero todos se ejecutan sobre la misma conexión,
+    de modo que una operación de lectura-modificación-escritura completa
+    se confirma o se revierte en bloque.
+    """
+
+    def __init__(self, conn: aiomysql.Connection):
+        self._conn = conn
+
+    @property
+    def connection(self) -> aiomysql.Connection:
+        """Conexión subyacente de la unidad de trabajo"""
+        return self._conn
+
+    @staticmethod
+    def _lock_clause(query: str, for_update: bool) -> str:
+        """Agregar ``FOR UPDATE`` a la consulta si se solicita bloqueo de filas"""
+        if not for_update:
+            return query
+        return f"{query.rstrip().rstrip(';')} FOR UPDATE"
+
+    async def execute_query(self, query: str, params: tuple = None, for_update: bool = False):
+        """Ejecutar una consulta SQL dentro de la transacción"""
+        async with self._conn.cursor(aiomysql.DictCursor) as cursor:
+            await _run(cursor, self._lock_clause(query, for_update), params)
+            return await cursor.fetchall()
+
+    async def execute_single_query(self, query: str, params: tuple = None, for_update: bool = False):
+        """Ejecutar una consulta SQL dentro de la transacción y obtener un solo resultado"""
+        async with self._conn.cursor(aiomysql.DictCursor) as cursor:
+            await _run(cursor, self._lock_clause(query, for_update), params)
+            return await cursor.fetchone()
+
+    async def execute_insert(self, query: str, params: tuple = None):
+        """Ejecutar una inserción SQL dentro de la transacción y obtener el ID insertado"""
+        async with self._conn.cursor() as cursor:
+            await _run(cursor, query, params)
+            return cursor.lastrowid
+
+    async def execute_update(self, query: str, params: tuple = None):
+        """Ejecutar una actualización SQL dentro de la transacción"""
+        async with self._conn.cursor() as cursor:
+            await _run(cursor, query, params)
+            return cursor.rowcount
+
+    async def execute_delete(self, query: str, params: tuple = None):
+        """Ejecutar una eliminación SQL dentro de la transacción"""
+        return await self.execute_update(query, params)
+
+    async def execute_many(self, query: str, rows: Iterable[Sequence], chunk_size: Optional[int] = None) -> int:
+        """Ejecutar una inserción/actualización masiva dentro de la transacción"""
+        return await _execute_many_on(self._conn, query, rows, chunk_size)
+
+@asynccontextmanager
+async def transaction():
+    """Abrir una unidad de trabajo transaccional.
+
+    Adquiere una única conexión del pool, inicia una transacción explícita
+    y la confirma al salir del bloque; ante cualquier excepción la revierte
+    y relanza el error::
+
+        async with transaction() as uow:
+            user = await uow.execute_single_query(query, (user_id,), for_update=True)
+            await uow.execute_update(update_query, params)
+    """
+    async with _acquire() as conn:
+        await conn.begin()
+        try:
+            yield UnitOfWork(conn)
+        except BaseException:
+            try:
+                await conn.rollback()
+            except Exception as rollback_error:
+                logger.error(f"❌ Error al revertir la transacción: {rollback_error}")
+            raise
+        else:
+            await conn.commit()
@@ -0,0 +1,113 @@
+"""
+Idempotencia de operaciones de puntos: filtro de Bloom y LRU por worker
+delante del índice único de loyalty_request_keys
+"""
+
+import hashlib
+import math
+from typing import Any, Dict, Hashable, List
+
+from config import settings
+from utils.cache import MISSING, TTLCache
+
+
+class BloomFilter:
+    """
+    Filtro de Bloom de tamaño fijo: sin falsos negativos y con una tasa de
+    falsos positivos de `error_rate` hasta `capacity` claves.
+    """
+
+    __slots__ = ("capacity", "size", "hashes", "count", "_bits")
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> List[int]:
+        # Doble hashing (Kirsch-Mitzenmacher) sobre un solo digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class IdempotencyCache:
+    """
+    Claves de operaciones ya confirmadas en este worker.
+
+    - LRU con TTL de ``clave -> respuesta``: un reintento reciente se responde
+      sin consultar la base de datos.
+    - Filtro de Bloom (dos generaciones que rotan al llenarse) de todas las
+      claves vistas: si dice "no" no hace falta buscar la clave en la base de
+      datos antes de ejecutar la operación.
+
+    Es solo un atajo: la garantía la da la clave primaria de
+    loyalty_request_keys dentro de la transacción de cada operación, que
+    también cubre reintentos que llegan a otro worker o tras un reinicio.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, bloom_capacity: int, error_rate: float = 0.01):
+        self.bloom_capacity = bloom_capacity
+        self.error_rate = error_rate
+        self.replayed = 0
+        self._recent = TTLCache(maxsize, ttl)
+        self._current = BloomFilter(bloom_capacity, error_rate)
+        self._previous = BloomFilter(bloom_capacity, error_rate)
+
+    def get(self, key: Hashable) -> Any:
+        """Respuesta cacheada de `key` o MISSING"""
+        response = self._recent.get(key)
+        if response is not MISSING:
+            self.replayed += 1
+        return response
+
+    def maybe_seen(self, key: str) -> bool:
+        """False si este worker no ha visto nunca `key` (sin falsos negativos)"""
+        return key in self._current or key in self._previous
+
+    def remember(self, key: str, response: Any):
+        """Registrar la respuesta de una operación confirmada"""
+        if self._current.count >= self.bloom_capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self.bloom_capacity, self.error_rate)
+        self._current.add(key)
+        self._recent.set(key, response)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores del LRU y ocupación del filtro"""
+        return {
+            **self._recent.stats(),
+            "replayed": self.replayed,
+            "bloom_keys": self._current.count + self._previous.count
+        }
+
+
+def request_key(operation: str, user_id: int, key: str) -> str:
+    """Clave de loyalty_request_keys: por operación y usuario, para que un
+    cliente no pueda reutilizar la de otro"""
+    return f"{operation}:{user_id}:{key}"
+
+
+def order_request_key(user_id: int, order_id: int) -> str:
+    """Clave del abono de puntos de un pedido, la misma en todas las rutas de
+    acumulación para que un pedido no se abone dos veces"""
+    return request_key("earn", user_id, f"order-{order_id}")
+
+
+# Instancia global por worker
+idempotency_cache = IdempotencyCache(
+    maxsize=settings.IDEMPOTENCY_CACHE_SIZE,
+    ttl=settings.IDEMPOTENCY_CACHE_TTL,
+    bloom_capacity=settings.IDEMPOTENCY_BLOOM_CAPACITY
+)
@@ -0,0 +1,69 @@
+"""
+Serialización por usuario dentro de un worker y reintentos de
+actualizaciones optimistas (compare-and-swap sobre balance_version)
+"""
+
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from config import settings
+
+
+class VersionConflict(Exception):
+    """El registro cambió entre la lectura y el UPDATE condicional por versión"""
+
+
+class StripedLock:
+    """
+    Tabla fija de ``asyncio.Lock``: cada clave usa el lock de su franja.
+
+    Las peticiones de un mismo usuario en este worker se ejecutan una tras
+    otra y las de usuarios en otras franjas no se bloquean. Dos usuarios
+    pueden compartir franja; eso solo las serializa, nunca las mezcla. Entre
+    workers la consistencia la da la versión del registro, no este lock.
+    """
+
+    def __init__(self, stripes: int):
+        self.stripes = max(1, stripes)
+        self._locks = [asyncio.Lock() for _ in range(self.stripes)]
+        self.acquisitions = 0
+        self.contended = 0
+
+    def lock_for(self, key: Hashable) -> asyncio.Lock:
+        return self._locks[hash(key) % self.stripes]
+
+    def __call__(self, key: Hashable) -> asyncio.Lock:
+        """``async with user_locks(user_id): ...``"""
+        lock = self.lock_for(key)
+        self.acquisitions += 1
+        if lock.locked():
+            self.contended += 1
+        return lock
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stripes": self.stripes,
+            "acquisitions": self.acquisitions,
+            "contended": self.contended
+        }
+
+
+async def retry_on_conflict(operation: Callable[[], Awaitable[Any]], retries: int,
+                            base_delay: float) -> Any:
+    """
+    Ejecutar `operation` y repetirla si lanza VersionConflict, hasta
+    `retries` intentos con espera exponencial aleatoria entre ellos (tope
+    de 64 veces `base_delay`). Agotados los intentos se propaga el VersionConflict.
+    """
+    for attempt in range(retries):
+        try:
+            return await operation()
+        except VersionConflict:
+            if attempt == retries - 1:
+                raise
+            await asyncio.sleep(random.uniform(0, base_delay * 2 ** min(attempt, 6)))
+
+
+# Locks por usuario compartidos por los servicios de este worker
+user_locks = StripedLock(settings.USER_LOCK_STRIPES)
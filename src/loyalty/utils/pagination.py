@@ -0,0 +1,52 @@
+"""
+Paginación por clave (keyset) sobre ``(created_at, id)`` con cursores opacos
+"""
+
+import base64
+import json
+from datetime import datetime
+from typing import Any, Callable, Optional, Sequence, Tuple
+
+
+class InvalidCursorError(ValueError):
+    """El cursor no es uno emitido por esta API"""
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Cursor opaco (base64 URL-safe) que apunta justo después de la fila dada"""
+    payload = json.dumps([created_at.isoformat(), row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Devolver ``(created_at, id)`` del cursor o lanzar InvalidCursorError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError("Cursor de paginación inválido") from e
+
+
+def keyset_condition(id_column: str, created_column: str = "created_at") -> str:
+    """
+    Filas estrictamente anteriores al cursor en orden ``created_column DESC,
+    id_column DESC``. Se expande la comparación de tuplas para que el
+    optimizador la resuelva como rango sobre el índice compuesto.
+    """
+    return f"({created_column} < %s OR ({created_column} = %s AND {id_column} < %s))"
+
+
+def keyset_params(cursor: str) -> Tuple[datetime, datetime, int]:
+    """Parámetros de keyset_condition para `cursor`"""
+    created_at, row_id = decode_cursor(cursor)
+    return created_at, created_at, row_id
+
+
+def next_cursor(rows: Sequence[Any], limit: int,
+                key: Callable[[Any], Tuple[datetime, int]]) -> Optional[str]:
+    """Cursor de la página siguiente, o None si `rows` no llenó la página"""
+    if len(rows) < limit or not rows:
+        return None
+    created_at, row_id = key(rows[-1])
+    return encode_cursor(created_at, row_id)
@@ -0,0 +1,127 @@
+"""
+Métricas del pool de conexiones a la base de datos
+"""
+
+import bisect
+from typing import Any, Dict, Optional, Sequence
+
+# Cubetas en segundos: de 1 ms a 5 s
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class LatencyHistogram:
+    """Histograma de latencias con cubetas fijas (valores en segundos)"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """Registrar una observación"""
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        """Vaciar el histograma"""
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Foto del histograma con conteos acumulados por cubeta (estilo Prometheus)"""
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            buckets[f"le_{bound}"] = cumulative
+        buckets["le_inf"] = cumulative + self._counts[-1]
+
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "buckets": buckets
+        }
+
+
+class PoolMetrics:
+    """Contadores e histogramas del pool: espera de adquisición, uso y latencia de consultas"""
+
+    def __init__(self):
+        self.acquire_wait = LatencyHistogram()
+        self.query_latency = LatencyHistogram()
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.acquire_rejected = 0
+        self.query_errors = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def record_acquire(self, wait_seconds: float):
+        """Registrar una conexión entregada y cuánto tardó"""
+        self.acquire_wait.observe(wait_seconds)
+        self.acquires += 1
+        self.in_use += 1
+        if self.in_use > self.max_in_use:
+            self.max_in_use = self.in_use
+
+    def record_release(self):
+        """Registrar una conexión devuelta al pool"""
+        self.in_use -= 1
+
+    def record_timeout(self):
+        """Registrar una adquisición que no obtuvo conexión a tiempo"""
+        self.acquire_timeouts += 1
+
+    def record_rejected(self):
+        """Registrar una adquisición rechazada por exceso de corrutinas en espera"""
+        self.acquire_rejected += 1
+
+    def record_query(self, seconds: float, failed: bool = False):
+        """Registrar la latencia de una sentencia"""
+        self.query_latency.observe(seconds)
+        if failed:
+            self.query_errors += 1
+
+    def reset(self):
+        """Reiniciar todas las métricas (conserva el gauge de conexiones en uso)"""
+        self.acquire_wait.reset()
+        self.query_latency.reset()
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.acquire_rejected = 0
+        self.query_errors = 0
+        self.max_in_use = self.in_use
+
+    def snapshot(self, pool: Optional[Any] = None) -> Dict[str, Any]:
+        """Foto de las métricas; si se pasa el pool incluye sus gauges de tamaño"""
+        stats = {
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "acquires": self.acquires,
+            "acquire_timeouts": self.acquire_timeouts,
+            "acquire_rejected": self.acquire_rejected,
+            "query_errors": self.query_errors,
+            "acquire_wait": self.acquire_wait.snapshot(),
+            "query_latency": self.query_latency.snapshot()
+        }
+
+        if pool is not None:
+            stats.update({
+                "size": pool.size,
+                "free": pool.freesize,
+                "min_size": pool.minsize,
+                "max_size": pool.maxsize
+            })
+        return stats
+
+
+# Instancia global usada por utils.database
+pool_metrics = PoolMetrics()
@@ -0,0 +1,182 @@
+"""
+Estadísticas por sentencia SQL y registro de consultas lentas
+"""
+
+import logging
+import os
+import re
+import sys
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence
+
+from config import settings
+
+logger = logging.getLogger("loyalty.slow_query")
+
+# Muestras recientes por sentencia usadas para los percentiles
+DEFAULT_SAMPLE_SIZE = 1024
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|%\(\w+\)s")
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_CASE_LIST = re.compile(r"\bWHEN\s+\?\s+THEN\s+\?(?:\s+WHEN\s+\?\s+THEN\s+\?)*", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+# Módulos cuyos frames se saltan al buscar el punto de llamada
+_INTERNAL_FILES = {
+    os.path.abspath(__file__),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.py")
+}
+
+
+def fingerprint(query: str) -> str:
+    """
+    Normalizar una sentencia: literales y placeholders pasan a ``?``, las
+    listas ``(?, ?), (?, ?)`` se colapsan en ``(...)``, las ramas
+    ``WHEN ? THEN ?`` de los UPDATE por lotes en ``WHEN ... THEN ...`` y los
+    espacios se compactan
+    """
+    normalized = _STRING_LITERAL.sub("?", query)
+    normalized = _PLACEHOLDER.sub("?", normalized)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    normalized = _VALUE_LIST.sub("(...)", normalized)
+    normalized = _CASE_LIST.sub("WHEN ... THEN ...", normalized)
+    return _WHITESPACE.sub(" ", normalized).strip()
+
+
+def _percentile(sorted_samples: Sequence[float], pct: float) -> float:
+    """Percentil por rango más cercano sobre muestras ya ordenadas"""
+    if not sorted_samples:
+        return 0.0
+    index = max(0, min(len(sorted_samples) - 1, int(round(pct / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def _call_site() -> str:
+    """Primer frame fuera de la capa de base de datos (``archivo:línea en función``)"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename not in _INTERNAL_FILES and "contextlib" not in filename:
+            return f"{os.path.basename(filename)}:{frame.f_lineno} en {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "desconocido"
+
+
+class StatementStats:
+    """Acumulado de una sentencia normalizada"""
+
+    __slots__ = ("query", "count", "errors", "rows", "total", "max", "samples")
+
+    def __init__(self, query: str, sample_size: int):
+        self.query = query
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def observe(self, seconds: float, rows: int, failed: bool):
+        self.count += 1
+        self.rows += rows
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if failed:
+            self.errors += 1
+        self.samples.append(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+        return {
+            "query": self.query,
+            "count": self.count,
+            "errors": self.errors,
+            "rows": self.rows,
+            "avg_rows": round(self.rows / self.count, 2) if self.count else 0.0,
+            "total_ms": round(self.total * 1000, 3),
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(_percentile(ordered, 50) * 1000, 3),
+            "p95_ms": round(_percentile(ordered, 95) * 1000, 3),
+            "p99_ms": round(_percentile(ordered, 99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3)
+        }
+
+
+class QueryStats:
+    """
+    Estadísticas por huella de sentencia. Las sentencias que superan
+    ``slow_threshold_ms`` se registran en el logger ``loyalty.slow_query``
+    con sus parámetros y el punto de llamada.
+    """
+
+    def __init__(self, slow_threshold_ms: float, max_statements: int = 500,
+                 sample_size: int = DEFAULT_SAMPLE_SIZE):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.max_statements = max_statements
+        self.sample_size = sample_size
+        self.slow_queries = 0
+        self.dropped = 0
+        self._statements: Dict[str, StatementStats] = {}
+        self._fingerprints: Dict[str, str] = {}
+
+    def _key(self, query: str) -> str:
+        # Las sentencias son cadenas constantes del código: se normalizan una sola vez
+        key = self._fingerprints.get(query)
+        if key is None:
+            key = fingerprint(query)
+            if len(self._fingerprints) < self.max_statements * 4:
+                self._fingerprints[query] = key
+        return key
+
+    def record(self, query: str, seconds: float, rows: int = 0,
+               params: Optional[Any] = None, failed: bool = False):
+        """Registrar una ejecución de `query`"""
+        # Los cursores sin búfer informan -1 o 2**64-1 como rowcount
+        if not 0 <= rows < 2 ** 63:
+            rows = 0
+        key = self._key(query)
+        stats = self._statements.get(key)
+        if stats is None:
+            if len(self._statements) >= self.max_statements:
+                self.dropped += 1
+                return
+            stats = self._statements[key] = StatementStats(key, self.sample_size)
+        stats.observe(seconds, rows, failed)
+
+        if self.slow_threshold_ms and seconds * 1000 >= self.slow_threshold_ms:
+            self.slow_queries += 1
+            logger.warning(
+                "Consulta lenta (%.1f ms, %s filas) desde %s: %s | params=%r",
+                seconds * 1000, rows, _call_site(), key, params
+            )
+
+    def reset(self):
+        """Vaciar las estadísticas acumuladas"""
+        self._statements.clear()
+        self.slow_queries = 0
+        self.dropped = 0
+
+    def snapshot(self, order_by: str = "total_ms", limit: Optional[int] = None) -> Dict[str, Any]:
+        """Foto de las estadísticas ordenada de mayor a menor por `order_by`"""
+        statements: List[Dict[str, Any]] = [s.snapshot() for s in self._statements.values()]
+        statements.sort(key=lambda s: s.get(order_by, 0), reverse=True)
+        if limit:
+            statements = statements[:limit]
+
+        return {
+            "slow_threshold_ms": self.slow_threshold_ms,
+            "slow_queries": self.slow_queries,
+            "tracked_statements": len(self._statements),
+            "dropped": self.dropped,
+            "statements": statements
+        }
+
+
+# Instancia global usada por utils.database
+query_stats = QueryStats(
+    slow_threshold_ms=settings.DB_SLOW_QUERY_MS,
+    max_statements=settings.DB_QUERY_STATS_MAX_STATEMENTS
+)
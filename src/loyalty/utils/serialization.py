@@ -0,0 +1,62 @@
+"""
+Serialización JSON rápida de respuestas: orjson si está instalado (con la
+biblioteca estándar como respaldo) y modelos Pydantic en una sola pasada
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from config import settings
+
+try:
+    # Dependencia opcional: sin ella se usa json de la biblioteca estándar
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    """Tipos que ni orjson ni json serializan por sí mismos"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Tipo no serializable en la respuesta: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    JSON en bytes de `content`. Un modelo Pydantic se serializa directamente
+    con pydantic-core; el resto (dicts de filas con datetime/Decimal) con
+    orjson o, si no está instalado, con json.
+    """
+    if isinstance(content, BaseModel):
+        return content.__pydantic_serializer__.to_json(content)
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que serializa con `dumps` en lugar de json.dumps"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def json_response(content: Any) -> Any:
+    """
+    Respuesta de una ruta. Con LOYALTY_FAST_JSON=1 se serializa aquí en una
+    pasada y FastAPI no recorre el contenido con jsonable_encoder; si no, se
+    devuelve tal cual para que FastAPI lo procese como siempre.
+    """
+    if settings.FAST_JSON:
+        return FastJSONResponse(content)
+    return content
@@ -0,0 +1,79 @@
+"""
+Coalescencia de lecturas concurrentes idénticas (single-flight) por worker
+"""
+
+import asyncio
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """
+    Una sola ejecución en curso por clave: las llamadas que llegan mientras
+    la primera no ha terminado esperan su resultado (o su excepción) en lugar
+    de repetir la consulta. Al terminar la clave se libera; no es una caché.
+
+    Las claves son tuplas ``(operación, *argumentos)``; la operación agrupa
+    las métricas. La ejecución es una tarea propia: si el primer llamante se
+    cancela (cliente desconectado) los demás siguen esperándola.
+    Pensada para un solo event loop (un worker de uvicorn): no usa locks.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self._calls: Counter = Counter()
+        self._collapsed: Counter = Counter()
+
+    async def do(self, key: Tuple[Hashable, ...], loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Resultado de `loader()`, compartido con las llamadas concurrentes de la misma `key`"""
+        operation = key[0]
+        self._calls[operation] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self._collapsed[operation] += 1
+        return await asyncio.shield(task)
+
+    def forget(self, key: Tuple[Hashable, ...]):
+        """
+        Desligar la ejecución en curso de `key` (tras escribir el dato): las
+        llamadas siguientes lanzan una lectura nueva en lugar de unirse a una
+        que empezó antes de la escritura.
+        """
+        self._inflight.pop(key, None)
+
+    def _finished(self, key: Tuple[Hashable, ...], task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Marcar la excepción como recuperada aunque todos los llamantes se cancelaran
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """Llamadas, llamadas resueltas por otra ejecución y su proporción, por operación"""
+        def ratio(collapsed: int, calls: int) -> float:
+            return round(collapsed / calls, 4) if calls else 0.0
+
+        calls = sum(self._calls.values())
+        collapsed = sum(self._collapsed.values())
+        return {
+            "calls": calls,
+            "collapsed": collapsed,
+            "collapse_ratio": ratio(collapsed, calls),
+            "in_flight": len(self._inflight),
+            "operations": {
+                operation: {
+                    "calls": count,
+                    "collapsed": self._collapsed[operation],
+                    "collapse_ratio": ratio(self._collapsed[operation], count)
+                }
+                for operation, count in self._calls.items()
+            }
+        }
+
+
+# Instancia global por worker
+single_flight = SingleFlight()
@@ -0,0 +1,167 @@
+"""
+Tabla de niveles compilada: umbrales, multiplicadores y orden de los niveles
+en una estructura inmutable con búsquedas por bisección
+"""
+
+import asyncio
+import bisect
+import logging
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+
+from config import loyalty_config
+from utils.cache import cache_manager
+from utils.database import execute_query
+
+logger = logging.getLogger(__name__)
+
+
+class TierTable:
+    """
+    Niveles ordenados por puntos requeridos. Inmutable: para cambiar los
+    niveles se compila una tabla nueva y se reemplaza la global.
+    """
+
+    __slots__ = ("names", "thresholds", "multipliers", "_rank")
+
+    def __init__(self, thresholds: Mapping[str, int], multipliers: Optional[Mapping[str, float]] = None):
+        if not thresholds:
+            raise ValueError("La tabla de niveles necesita al menos un nivel")
+        multipliers = multipliers or {}
+        ordered = sorted(thresholds.items(), key=lambda item: item[1])
+
+        self.names: Tuple[str, ...] = tuple(name for name, _ in ordered)
+        self.thresholds: Tuple[int, ...] = tuple(int(points) for _, points in ordered)
+        self.multipliers: Tuple[float, ...] = tuple(float(multipliers.get(name, 1.0)) for name in self.names)
+        self._rank = MappingProxyType({name: index for index, name in enumerate(self.names)})
+
+    @classmethod
+    def from_config(cls) -> "TierTable":
+        """Tabla por defecto desde LoyaltyConfig (antes de leer loyalty_tier_config)"""
+        return cls(
+            loyalty_config.TIER_THRESHOLDS,
+            {tier: benefits["points_multiplier"] for tier, benefits in loyalty_config.TIER_BENEFITS.items()}
+        )
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Mapping[str, Any]]) -> "TierTable":
+        """Compilar desde filas de loyalty_tier_config"""
+        thresholds = {}
+        multipliers = {}
+        for row in rows:
+            thresholds[row["tier_name"]] = row["points_required"]
+            if row.get("points_multiplier") is not None:
+                multipliers[row["tier_name"]] = row["points_multiplier"]
+        return cls(thresholds, multipliers)
+
+    def rank(self, tier: str) -> int:
+        """Posición del nivel (0 = el más bajo); los niveles desconocidos cuentan como el más bajo"""
+        return self._rank.get(tier, 0)
+
+    def tier_for_points(self, points: int) -> str:
+        """Nivel que corresponde a `points`"""
+        index = bisect.bisect_right(self.thresholds, points) - 1
+        return self.names[max(index, 0)]
+
+    def threshold(self, tier: str) -> int:
+        """Puntos requeridos por `tier`"""
+        return self.thresholds[self.rank(tier)]
+
+    def multiplier(self, tier: str) -> float:
+        """Multiplicador de puntos de `tier`"""
+        return self.multipliers[self.rank(tier)]
+
+    def next_tier(self, tier: str) -> Optional[str]:
+        """Nivel siguiente o None si `tier` es el máximo"""
+        index = self.rank(tier) + 1
+        return self.names[index] if index < len(self.names) else None
+
+    def is_upgrade(self, old_tier: str, new_tier: str) -> bool:
+        """True si `new_tier` está por encima de `old_tier`"""
+        return self.rank(new_tier) > self.rank(old_tier)
+
+    def can_access(self, user_tier: str, required_tier: str) -> bool:
+        """True si `user_tier` alcanza el nivel `required_tier`"""
+        return self.rank(user_tier) >= self.rank(required_tier)
+
+    def progress(self, tier: str, points: int) -> Dict[str, Any]:
+        """Progreso de `points` desde `tier` hacia el nivel siguiente"""
+        index = self.rank(tier)
+        if index == len(self.names) - 1:
+            return {
+                'current_tier': tier,
+                'current_points': points,
+                'next_tier': None,
+                'points_needed': 0,
+                'progress_percentage': 100.0
+            }
+
+        current_threshold = self.thresholds[index]
+        next_threshold = self.thresholds[index + 1]
+        progress = (points - current_threshold) / (next_threshold - current_threshold) * 100
+        return {
+            'current_tier': tier,
+            'current_points': points,
+            'next_tier': self.names[index + 1],
+            'points_needed': max(0, next_threshold - points),
+            'progress_percentage': min(max(progress, 0.0), 100.0)
+        }
+
+    def as_dict(self) -> Dict[str, int]:
+        """Umbrales por nivel"""
+        return dict(zip(self.names, self.thresholds))
+
+
+_table = TierTable.from_config()
+_reload_tasks = set()
+
+
+def get_tier_table() -> TierTable:
+    """Tabla de niveles vigente en este worker"""
+    return _table
+
+
+def set_tier_table(table: TierTable):
+    """Reemplazar la tabla vigente (el cambio es atómico: una sola asignación)"""
+    global _table
+    _table = table
+
+
+async def load_tier_table() -> TierTable:
+    """
+    Recompilar la tabla desde loyalty_tier_config. Si la tabla está vacía o
+    la consulta falla se conserva la tabla vigente.
+    """
+    query = """
+        SELECT tier_name, points_required, points_multiplier
+        FROM loyalty_tier_config
+        ORDER BY points_required
+    """
+    try:
+        rows = await execute_query(query, use_primary=True)
+        if rows:
+            set_tier_table(TierTable.from_rows(rows))
+            logger.info(f"Tabla de niveles cargada: {_table.as_dict()}")
+        else:
+            logger.warning("loyalty_tier_config vacía: se mantiene la tabla de niveles actual")
+    except Exception as e:
+        logger.error(f"Error cargando loyalty_tier_config, se mantiene la tabla actual: {e}")
+    return _table
+
+
+def _schedule_reload(keys):
+    """Otro worker cambió los niveles: recargar en segundo plano"""
+    task = asyncio.get_running_loop().create_task(load_tier_table())
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+
+# Región sin datos: solo transporta el aviso de recarga entre workers
+_reload_signal = cache_manager.region("tier_table", maxsize=1, ttl=1, on_invalidate=_schedule_reload)
+
+
+async def reload_tier_table() -> TierTable:
+    """Recargar la tabla en este worker y avisar a los demás para que recarguen"""
+    table = await load_tier_table()
+    await _reload_signal.clear()
+    return table